@@ -0,0 +1,872 @@
+/********************************************************* CPython Buffer Protocol ************************************************************************
+
+# NumPy-style: shape and strides.
+# The logical structure of NumPy-style arrays is defined by itemsize, ndim, shape and strides, and verify_structure()
+# (Python_Buffer_Protocol_Buff_Memory_Block.py) checks that such a layout stays within the bounds of its memory block.
+#
+# This extension module, "mappedarray", exports such buffers straight from a file mapped with mmap(), so an array of any size opens
+# instantly, is paged in on demand and is shared by every process that maps the same file:
+#
+# > create(path, format, shape, strides=None) creates the file and returns a writable Array. strides defaults to a C-contiguous layout;
+#   any other layout (Fortran order, negative strides, padding) gets a data block just large enough for it.
+# > open(path, writable=False) maps an existing file. The header is checked like verify_structure() checks a layout, so a corrupt or
+#   truncated file is rejected before any item is touched.
+# > Array exports the full NumPy-style Py_buffer: format, itemsize, ndim, shape and strides. memoryview(), numpy.asarray() and any
+#   consumer of PyObject_GetBuffer() read and write the mapped pages directly. Consumers that cannot handle strides (PyBUF_SIMPLE,
+#   PyBUF_ND, PyBUF_C_CONTIGUOUS, ...) are served only when the layout is contiguous in the requested order.
+# > array[key] with integers and slices (steps included, negative ones too) returns a sub-view sharing the same mapping: only the offset,
+#   shape and strides change, and every sub-view is checked again with verify_structure() semantics. Integers drop a dimension.
+# > flush() writes dirty pages back with msync(); close() releases the array's reference to the mapping, and raises BufferError while
+#   buffers exported by the array are still alive. The mapping itself is unmapped when the last array or view using it is gone.
+#
+# suboffsets are always NULL: a PIL-style pointer is only meaningful in the address space that wrote it, so a file shared between
+# processes cannot hold one.
+#
+# File layout (native byte order, the format string describes the items):
+#
+#   magic "PYNDMAP1" | header_size uint32 | ndim uint32 | format char[16] | itemsize int64 | offset int64 | shape int64[ndim] |
+#   strides int64[ndim] | zero padding up to header_size (a multiple of 64) | data
+#
+# offset is the position of item [0, ..., 0] in the data block, as in verify_structure().
+#
+# Build:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Buffer_Protocol_C_Mapped_Array.c \
+#       -o mappedarray$(python3-config --extension-suffix)
+
+**********************************************************************************************************************************************************/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define MAX_NDIM 64
+#define FORMAT_SIZE 16
+#define MAGIC "PYNDMAP1"
+#define MAGIC_SIZE 8
+#define PREFIX_SIZE (MAGIC_SIZE + 4 + 4 + FORMAT_SIZE + 8 + 8)
+#define HEADER_ALIGN 64
+
+
+/* Same checks as verify_structure(), with overflow checks for headers
+   read from a file. */
+
+static int
+verify_structure(Py_ssize_t memlen, Py_ssize_t itemsize, int ndim,
+                 const Py_ssize_t *shape, const Py_ssize_t *strides,
+                 Py_ssize_t offset)
+{
+    Py_ssize_t imin = 0, imax = 0, extent;
+    int j;
+
+    if (itemsize <= 0 || offset % itemsize)
+        return 0;
+    if (offset < 0 || offset > memlen - itemsize)
+        return 0;
+    for (j = 0; j < ndim; j++) {
+        if (strides[j] % itemsize || shape[j] < 0)
+            return 0;
+    }
+    if (ndim < 0)
+        return 0;
+    for (j = 0; j < ndim; j++) {
+        if (shape[j] == 0)
+            return 1;
+    }
+    for (j = 0; j < ndim; j++) {
+        if (__builtin_mul_overflow(strides[j], shape[j] - 1, &extent))
+            return 0;
+        if (strides[j] <= 0) {
+            if (__builtin_add_overflow(imin, extent, &imin))
+                return 0;
+        }
+        else if (__builtin_add_overflow(imax, extent, &imax)) {
+            return 0;
+        }
+    }
+    return 0 <= offset + imin && imax <= memlen - itemsize - offset;
+}
+
+
+/* The mapping of one file, shared by an array and all its views. */
+
+typedef struct {
+    PyObject_HEAD
+    char *addr;
+    Py_ssize_t length;
+    char *data;             /* addr + header_size */
+    Py_ssize_t memlen;      /* length - header_size */
+    int readonly;
+    Py_ssize_t itemsize;
+    char format[FORMAT_SIZE];
+} MappingObject;
+
+typedef struct {
+    PyObject_HEAD
+    MappingObject *mapping; /* NULL once closed */
+    Py_ssize_t offset;      /* of item [0, ..., 0] from mapping->data */
+    int ndim;
+    Py_ssize_t exports;
+    Py_ssize_t shape[MAX_NDIM];
+    Py_ssize_t strides[MAX_NDIM];
+} ArrayObject;
+
+static PyTypeObject Mapping_Type;
+static PyTypeObject Array_Type;
+
+
+static void
+Mapping_dealloc(MappingObject *self)
+{
+    if (self->addr != NULL)
+        munmap(self->addr, self->length);
+    PyObject_Free(self);
+}
+
+static PyTypeObject Mapping_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "mappedarray.Mapping",
+    .tp_basicsize = sizeof(MappingObject),
+    .tp_dealloc = (destructor)Mapping_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+};
+
+
+static ArrayObject *
+new_array(MappingObject *mapping, Py_ssize_t offset, int ndim)
+{
+    ArrayObject *self = PyObject_New(ArrayObject, &Array_Type);
+
+    if (self == NULL)
+        return NULL;
+    Py_INCREF(mapping);
+    self->mapping = mapping;
+    self->offset = offset;
+    self->ndim = ndim;
+    self->exports = 0;
+    return self;
+}
+
+static int
+check_open(ArrayObject *self)
+{
+    if (self->mapping == NULL) {
+        PyErr_SetString(PyExc_ValueError, "I/O operation on closed array");
+        return -1;
+    }
+    return 0;
+}
+
+static Py_ssize_t
+array_items(ArrayObject *self)
+{
+    Py_ssize_t n = 1;
+    int i;
+
+    for (i = 0; i < self->ndim; i++)
+        n *= self->shape[i];
+    return n;
+}
+
+static int
+is_contiguous(ArrayObject *self, char order)
+{
+    Py_ssize_t expected = self->mapping->itemsize;
+    int i, d;
+
+    if (array_items(self) == 0)
+        return 1;
+    for (i = 0; i < self->ndim; i++) {
+        d = order == 'C' ? self->ndim - 1 - i : i;
+        if (self->shape[d] > 1 && self->strides[d] != expected)
+            return 0;
+        expected *= self->shape[d];
+    }
+    return 1;
+}
+
+
+/* Map path and return its mapping, checking the header. */
+
+static MappingObject *
+map_file(int fd, int readonly, int *ndim, Py_ssize_t *offset,
+         Py_ssize_t *shape, Py_ssize_t *strides)
+{
+    MappingObject *mapping;
+    struct stat st;
+    uint32_t header_size, count;
+    int64_t value;
+    char *addr;
+    int i;
+
+    if (fstat(fd, &st) < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+    if (st.st_size < PREFIX_SIZE) {
+        PyErr_SetString(PyExc_ValueError, "not a mapped array file: too short");
+        return NULL;
+    }
+    addr = mmap(NULL, st.st_size, readonly ? PROT_READ : PROT_READ | PROT_WRITE,
+                MAP_SHARED, fd, 0);
+    if (addr == MAP_FAILED) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+    mapping = PyObject_New(MappingObject, &Mapping_Type);
+    if (mapping == NULL) {
+        munmap(addr, st.st_size);
+        return NULL;
+    }
+    mapping->addr = addr;
+    mapping->length = st.st_size;
+    mapping->readonly = readonly;
+
+    memcpy(&header_size, addr + MAGIC_SIZE, 4);
+    memcpy(&count, addr + MAGIC_SIZE + 4, 4);
+    if (memcmp(addr, MAGIC, MAGIC_SIZE) != 0) {
+        PyErr_SetString(PyExc_ValueError, "not a mapped array file: bad magic");
+        goto error;
+    }
+    if (count > MAX_NDIM || header_size % HEADER_ALIGN
+        || header_size < PREFIX_SIZE + 16 * count || header_size > st.st_size) {
+        PyErr_SetString(PyExc_ValueError,
+                        "corrupt mapped array header (or other byte order)");
+        goto error;
+    }
+    memcpy(mapping->format, addr + MAGIC_SIZE + 8, FORMAT_SIZE);
+    if (memchr(mapping->format, '\0', FORMAT_SIZE) == NULL) {
+        PyErr_SetString(PyExc_ValueError, "corrupt mapped array header: format");
+        goto error;
+    }
+    memcpy(&value, addr + MAGIC_SIZE + 8 + FORMAT_SIZE, 8);
+    mapping->itemsize = (Py_ssize_t)value;
+    memcpy(&value, addr + MAGIC_SIZE + 16 + FORMAT_SIZE, 8);
+    *offset = (Py_ssize_t)value;
+    *ndim = (int)count;
+    for (i = 0; i < *ndim; i++) {
+        memcpy(&value, addr + PREFIX_SIZE + 8 * i, 8);
+        shape[i] = (Py_ssize_t)value;
+        memcpy(&value, addr + PREFIX_SIZE + 8 * (*ndim + i), 8);
+        strides[i] = (Py_ssize_t)value;
+    }
+    mapping->data = addr + header_size;
+    mapping->memlen = st.st_size - header_size;
+
+    if (PyBuffer_SizeFromFormat(mapping->format) != mapping->itemsize) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_ValueError,
+                            "corrupt mapped array header: itemsize does not "
+                            "match format");
+        goto error;
+    }
+    if (!verify_structure(mapping->memlen, mapping->itemsize, *ndim, shape,
+                          strides, *offset)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "corrupt mapped array header: layout exceeds the data");
+        goto error;
+    }
+    return mapping;
+
+error:
+    Py_DECREF(mapping);
+    return NULL;
+}
+
+static PyObject *
+open_array(PyObject *path, int flags, int readonly)
+{
+    Py_ssize_t shape[MAX_NDIM], strides[MAX_NDIM], offset;
+    MappingObject *mapping;
+    ArrayObject *self;
+    PyObject *bytes;
+    int fd, ndim;
+
+    if (!PyUnicode_FSConverter(path, &bytes))
+        return NULL;
+    Py_BEGIN_ALLOW_THREADS
+    fd = open(PyBytes_AS_STRING(bytes), flags, 0666);
+    Py_END_ALLOW_THREADS
+    if (fd < 0) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        Py_DECREF(bytes);
+        return NULL;
+    }
+    Py_DECREF(bytes);
+
+    /* the mapping stays valid after the descriptor is closed */
+    mapping = map_file(fd, readonly, &ndim, &offset, shape, strides);
+    close(fd);
+    if (mapping == NULL)
+        return NULL;
+
+    self = new_array(mapping, offset, ndim);
+    Py_DECREF(mapping);
+    if (self == NULL)
+        return NULL;
+    memcpy(self->shape, shape, ndim * sizeof(Py_ssize_t));
+    memcpy(self->strides, strides, ndim * sizeof(Py_ssize_t));
+    return (PyObject *)self;
+}
+
+static int
+get_dims(PyObject *obj, Py_ssize_t *values)
+{
+    PyObject *seq;
+    Py_ssize_t n, i;
+
+    seq = PySequence_Fast(obj, "shape and strides must be sequences");
+    if (seq == NULL)
+        return -1;
+    n = PySequence_Fast_GET_SIZE(seq);
+    if (n > MAX_NDIM) {
+        PyErr_Format(PyExc_ValueError, "at most %d dimensions are supported",
+                     MAX_NDIM);
+        Py_DECREF(seq);
+        return -1;
+    }
+    for (i = 0; i < n; i++) {
+        values[i] = PyNumber_AsSsize_t(PySequence_Fast_GET_ITEM(seq, i),
+                                       PyExc_OverflowError);
+        if (values[i] == -1 && PyErr_Occurred()) {
+            Py_DECREF(seq);
+            return -1;
+        }
+    }
+    Py_DECREF(seq);
+    return (int)n;
+}
+
+static PyObject *
+mappedarray_create(PyObject *module, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"path", "format", "shape", "strides", NULL};
+    Py_ssize_t shape[MAX_NDIM], strides[MAX_NDIM];
+    Py_ssize_t itemsize, imin = 0, imax = 0, extent, memlen, offset;
+    PyObject *path, *shape_obj, *strides_obj = Py_None, *bytes;
+    const char *format;
+    char header[PREFIX_SIZE + 16 * MAX_NDIM + HEADER_ALIGN];
+    uint32_t header_size, count;
+    int64_t value;
+    int ndim, i, fd, failed;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OsO|O:create", kwlist,
+                                     &path, &format, &shape_obj, &strides_obj))
+        return NULL;
+
+    if (strlen(format) >= FORMAT_SIZE) {
+        PyErr_Format(PyExc_ValueError, "format longer than %d characters",
+                     FORMAT_SIZE - 1);
+        return NULL;
+    }
+    itemsize = PyBuffer_SizeFromFormat(format);
+    if (itemsize < 0)
+        return NULL;
+    if (itemsize == 0) {
+        PyErr_SetString(PyExc_ValueError, "itemsize must be positive");
+        return NULL;
+    }
+
+    ndim = get_dims(shape_obj, shape);
+    if (ndim < 0)
+        return NULL;
+    for (i = 0; i < ndim; i++) {
+        if (shape[i] < 0) {
+            PyErr_SetString(PyExc_ValueError, "negative dimension");
+            return NULL;
+        }
+    }
+    if (strides_obj == Py_None) {
+        extent = itemsize;
+        for (i = ndim - 1; i >= 0; i--) {
+            strides[i] = extent;
+            if (__builtin_mul_overflow(extent, shape[i] ? shape[i] : 1, &extent))
+                goto too_large;
+        }
+    }
+    else if (get_dims(strides_obj, strides) != ndim) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_ValueError,
+                            "strides must have one value per dimension");
+        return NULL;
+    }
+
+    /* the smallest data block holding the layout, item [0, ..., 0] at -imin */
+    for (i = 0; i < ndim; i++) {
+        if (shape[i] == 0)
+            break;
+        if (__builtin_mul_overflow(strides[i], shape[i] - 1, &extent))
+            goto too_large;
+        if (extent < 0 ? __builtin_add_overflow(imin, extent, &imin)
+                       : __builtin_add_overflow(imax, extent, &imax))
+            goto too_large;
+    }
+    if (i < ndim)
+        imin = imax = 0;
+    offset = -imin;
+    if (__builtin_add_overflow(imax - imin, itemsize, &memlen))
+        goto too_large;
+    if (!verify_structure(memlen, itemsize, ndim, shape, strides, offset)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "strides must be multiples of the itemsize");
+        return NULL;
+    }
+
+    header_size = (PREFIX_SIZE + 16 * ndim + HEADER_ALIGN - 1)
+                  / HEADER_ALIGN * HEADER_ALIGN;
+    count = ndim;
+    memset(header, 0, sizeof(header));
+    memcpy(header, MAGIC, MAGIC_SIZE);
+    memcpy(header + MAGIC_SIZE, &header_size, 4);
+    memcpy(header + MAGIC_SIZE + 4, &count, 4);
+    strcpy(header + MAGIC_SIZE + 8, format);
+    value = itemsize;
+    memcpy(header + MAGIC_SIZE + 8 + FORMAT_SIZE, &value, 8);
+    value = offset;
+    memcpy(header + MAGIC_SIZE + 16 + FORMAT_SIZE, &value, 8);
+    for (i = 0; i < ndim; i++) {
+        value = shape[i];
+        memcpy(header + PREFIX_SIZE + 8 * i, &value, 8);
+        value = strides[i];
+        memcpy(header + PREFIX_SIZE + 8 * (ndim + i), &value, 8);
+    }
+
+    if (!PyUnicode_FSConverter(path, &bytes))
+        return NULL;
+    Py_BEGIN_ALLOW_THREADS
+    fd = open(PyBytes_AS_STRING(bytes), O_RDWR | O_CREAT | O_TRUNC, 0666);
+    /* ftruncate() leaves the data sparse: creating a huge array is instant */
+    failed = (fd < 0
+              || ftruncate(fd, (off_t)header_size + memlen) < 0
+              || pwrite(fd, header, header_size, 0) != (ssize_t)header_size);
+    Py_END_ALLOW_THREADS
+    if (failed) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        if (fd >= 0)
+            close(fd);
+        Py_DECREF(bytes);
+        return NULL;
+    }
+    close(fd);
+    Py_DECREF(bytes);
+
+    return open_array(path, O_RDWR, 0);
+
+too_large:
+    PyErr_SetString(PyExc_OverflowError, "array too large");
+    return NULL;
+}
+
+static PyObject *
+mappedarray_open(PyObject *module, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"path", "writable", NULL};
+    PyObject *path;
+    int writable = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p:open", kwlist,
+                                     &path, &writable))
+        return NULL;
+    return open_array(path, writable ? O_RDWR : O_RDONLY, !writable);
+}
+
+
+/* Array */
+
+static void
+Array_dealloc(ArrayObject *self)
+{
+    Py_XDECREF(self->mapping);
+    PyObject_Free(self);
+}
+
+static int
+Array_getbuffer(ArrayObject *self, Py_buffer *view, int flags)
+{
+    MappingObject *mapping = self->mapping;
+    int contiguous;
+
+    if (mapping == NULL) {
+        PyErr_SetString(PyExc_BufferError, "array is closed");
+        return -1;
+    }
+    if ((flags & PyBUF_WRITABLE) && mapping->readonly) {
+        PyErr_SetString(PyExc_BufferError, "array is read-only");
+        return -1;
+    }
+    if ((flags & PyBUF_F_CONTIGUOUS) == PyBUF_F_CONTIGUOUS)
+        contiguous = is_contiguous(self, 'F');
+    else if ((flags & PyBUF_ANY_CONTIGUOUS) == PyBUF_ANY_CONTIGUOUS)
+        contiguous = is_contiguous(self, 'C') || is_contiguous(self, 'F');
+    else if ((flags & PyBUF_C_CONTIGUOUS) == PyBUF_C_CONTIGUOUS
+             || (flags & PyBUF_STRIDES) != PyBUF_STRIDES)
+        contiguous = is_contiguous(self, 'C');
+    else
+        contiguous = 1;
+    if (!contiguous) {
+        PyErr_SetString(PyExc_BufferError,
+                        "array is not contiguous in the requested order");
+        return -1;
+    }
+
+    view->buf = mapping->data + self->offset;
+    view->obj = (PyObject *)self;
+    Py_INCREF(self);
+    view->len = array_items(self) * mapping->itemsize;
+    view->readonly = mapping->readonly;
+    view->itemsize = mapping->itemsize;
+    view->format = (flags & PyBUF_FORMAT) ? mapping->format : NULL;
+    if ((flags & PyBUF_ND) == PyBUF_ND) {
+        view->ndim = self->ndim;
+        view->shape = self->ndim ? self->shape : NULL;
+    }
+    else {
+        view->ndim = 1;
+        view->shape = NULL;
+    }
+    view->strides = ((flags & PyBUF_STRIDES) == PyBUF_STRIDES && self->ndim
+                     ? self->strides : NULL);
+    view->suboffsets = NULL;
+    view->internal = NULL;
+    self->exports++;
+    return 0;
+}
+
+static void
+Array_releasebuffer(ArrayObject *self, Py_buffer *view)
+{
+    self->exports--;
+}
+
+static PyBufferProcs Array_as_buffer = {
+    (getbufferproc)Array_getbuffer,
+    (releasebufferproc)Array_releasebuffer,
+};
+
+
+static PyObject *
+Array_subscript(ArrayObject *self, PyObject *key)
+{
+    MappingObject *mapping = self->mapping;
+    ArrayObject *result;
+    Py_ssize_t nkeys, offset, start, stop, step, length, index;
+    PyObject *item;
+    int d, out = 0;
+
+    if (check_open(self) < 0)
+        return NULL;
+    nkeys = PyTuple_Check(key) ? PyTuple_GET_SIZE(key) : 1;
+    if (nkeys > self->ndim) {
+        PyErr_Format(PyExc_IndexError,
+                     "too many indices for array: array is %d-dimensional, "
+                     "but %zd were indexed", self->ndim, nkeys);
+        return NULL;
+    }
+
+    result = new_array(mapping, self->offset, 0);
+    if (result == NULL)
+        return NULL;
+    offset = self->offset;
+
+    for (d = 0; d < self->ndim; d++) {
+        if (d >= nkeys) {
+            result->shape[out] = self->shape[d];
+            result->strides[out++] = self->strides[d];
+            continue;
+        }
+        item = PyTuple_Check(key) ? PyTuple_GET_ITEM(key, d) : key;
+        if (PySlice_Check(item)) {
+            if (PySlice_Unpack(item, &start, &stop, &step) < 0)
+                goto error;
+            length = PySlice_AdjustIndices(self->shape[d], &start, &stop, step);
+            /* an empty slice keeps the offset inside the data */
+            if (length)
+                offset += start * self->strides[d];
+            result->shape[out] = length;
+            result->strides[out++] = self->strides[d] * step;
+        }
+        else if (PyIndex_Check(item)) {
+            index = PyNumber_AsSsize_t(item, PyExc_IndexError);
+            if (index == -1 && PyErr_Occurred())
+                goto error;
+            if (index < 0)
+                index += self->shape[d];
+            if (index < 0 || index >= self->shape[d]) {
+                PyErr_Format(PyExc_IndexError,
+                             "index out of range for dimension %d", d);
+                goto error;
+            }
+            offset += index * self->strides[d];
+        }
+        else {
+            PyErr_Format(PyExc_TypeError,
+                         "array indices must be integers or slices, not %.200s",
+                         Py_TYPE(item)->tp_name);
+            goto error;
+        }
+    }
+    result->offset = offset;
+    result->ndim = out;
+
+    if (!verify_structure(mapping->memlen, mapping->itemsize, result->ndim,
+                          result->shape, result->strides, result->offset)) {
+        PyErr_SetString(PyExc_SystemError, "sub-view outside of the mapping");
+        goto error;
+    }
+    return (PyObject *)result;
+
+error:
+    Py_DECREF(result);
+    return NULL;
+}
+
+static Py_ssize_t
+Array_length(ArrayObject *self)
+{
+    if (check_open(self) < 0)
+        return -1;
+    if (self->ndim == 0) {
+        PyErr_SetString(PyExc_TypeError, "len() of a 0-d array");
+        return -1;
+    }
+    return self->shape[0];
+}
+
+static PyMappingMethods Array_as_mapping = {
+    (lenfunc)Array_length,
+    (binaryfunc)Array_subscript,
+    NULL,
+};
+
+
+static PyObject *
+Array_close(ArrayObject *self, PyObject *unused)
+{
+    if (self->exports > 0) {
+        PyErr_SetString(PyExc_BufferError,
+                        "cannot close array: exported buffers exist");
+        return NULL;
+    }
+    Py_CLEAR(self->mapping);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Array_flush(ArrayObject *self, PyObject *unused)
+{
+    MappingObject *mapping = self->mapping;
+    int result = 0;
+
+    if (check_open(self) < 0)
+        return NULL;
+    if (!mapping->readonly) {
+        Py_BEGIN_ALLOW_THREADS
+        result = msync(mapping->addr, mapping->length, MS_SYNC);
+        Py_END_ALLOW_THREADS
+    }
+    if (result < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Array_enter(ArrayObject *self, PyObject *unused)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    Py_INCREF(self);
+    return (PyObject *)self;
+}
+
+static PyObject *
+Array_exit(ArrayObject *self, PyObject *args)
+{
+    return Array_close(self, NULL);
+}
+
+static PyMethodDef Array_methods[] = {
+    {"close", (PyCFunction)Array_close, METH_NOARGS,
+     "Release the mapping; raise BufferError while buffers are exported."},
+    {"flush", (PyCFunction)Array_flush, METH_NOARGS,
+     "Write the dirty pages of the mapping back to the file."},
+    {"__enter__", (PyCFunction)Array_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction)Array_exit, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static PyObject *
+dims_tuple(int ndim, const Py_ssize_t *values)
+{
+    PyObject *result = PyTuple_New(ndim);
+    PyObject *value;
+    int i;
+
+    if (result == NULL)
+        return NULL;
+    for (i = 0; i < ndim; i++) {
+        value = PyLong_FromSsize_t(values[i]);
+        if (value == NULL) {
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(result, i, value);
+    }
+    return result;
+}
+
+static PyObject *
+Array_get_shape(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return dims_tuple(self->ndim, self->shape);
+}
+
+static PyObject *
+Array_get_strides(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return dims_tuple(self->ndim, self->strides);
+}
+
+static PyObject *
+Array_get_ndim(ArrayObject *self, void *closure)
+{
+    return PyLong_FromLong(self->ndim);
+}
+
+static PyObject *
+Array_get_format(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return PyUnicode_FromString(self->mapping->format);
+}
+
+static PyObject *
+Array_get_itemsize(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return PyLong_FromSsize_t(self->mapping->itemsize);
+}
+
+static PyObject *
+Array_get_nbytes(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return PyLong_FromSsize_t(array_items(self) * self->mapping->itemsize);
+}
+
+static PyObject *
+Array_get_offset(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return PyLong_FromSsize_t(self->offset);
+}
+
+static PyObject *
+Array_get_readonly(ArrayObject *self, void *closure)
+{
+    if (check_open(self) < 0)
+        return NULL;
+    return PyBool_FromLong(self->mapping->readonly);
+}
+
+static PyObject *
+Array_get_closed(ArrayObject *self, void *closure)
+{
+    return PyBool_FromLong(self->mapping == NULL);
+}
+
+static PyGetSetDef Array_getset[] = {
+    {"shape", (getter)Array_get_shape, NULL, "Items per dimension.", NULL},
+    {"strides", (getter)Array_get_strides, NULL, "Bytes between items per dimension.", NULL},
+    {"ndim", (getter)Array_get_ndim, NULL, "Number of dimensions.", NULL},
+    {"format", (getter)Array_get_format, NULL, "struct format of an item.", NULL},
+    {"itemsize", (getter)Array_get_itemsize, NULL, "Size of an item in bytes.", NULL},
+    {"nbytes", (getter)Array_get_nbytes, NULL, "Size of the items in bytes.", NULL},
+    {"offset", (getter)Array_get_offset, NULL, "Offset of the first item in the data block.", NULL},
+    {"readonly", (getter)Array_get_readonly, NULL, "True for a read-only mapping.", NULL},
+    {"closed", (getter)Array_get_closed, NULL, "True once close() was called.", NULL},
+    {NULL}
+};
+
+static PyObject *
+Array_repr(ArrayObject *self)
+{
+    PyObject *shape, *result;
+
+    if (self->mapping == NULL)
+        return PyUnicode_FromString("<mappedarray.Array closed>");
+    shape = dims_tuple(self->ndim, self->shape);
+    if (shape == NULL)
+        return NULL;
+    result = PyUnicode_FromFormat("<mappedarray.Array format='%s' shape=%R%s>",
+                                  self->mapping->format, shape,
+                                  self->mapping->readonly ? " read-only" : "");
+    Py_DECREF(shape);
+    return result;
+}
+
+static PyTypeObject Array_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "mappedarray.Array",
+    .tp_basicsize = sizeof(ArrayObject),
+    .tp_dealloc = (destructor)Array_dealloc,
+    .tp_repr = (reprfunc)Array_repr,
+    .tp_as_mapping = &Array_as_mapping,
+    .tp_as_buffer = &Array_as_buffer,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "N-D array over a memory-mapped file; create() and open() return one.",
+    .tp_methods = Array_methods,
+    .tp_getset = Array_getset,
+};
+
+
+static PyMethodDef mappedarray_methods[] = {
+    {"create", (PyCFunction)(void (*)(void))mappedarray_create,
+     METH_VARARGS | METH_KEYWORDS,
+     "create(path, format, shape, strides=None)\n\nCreate an array file and map it writable."},
+    {"open", (PyCFunction)(void (*)(void))mappedarray_open,
+     METH_VARARGS | METH_KEYWORDS,
+     "open(path, writable=False)\n\nMap an existing array file."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef mappedarray_module = {
+    PyModuleDef_HEAD_INIT,
+    "mappedarray",
+    "N-D arrays over memory-mapped files, exported with the buffer protocol.",
+    -1,
+    mappedarray_methods,
+};
+
+PyMODINIT_FUNC
+PyInit_mappedarray(void)
+{
+    PyObject *module;
+
+    if (PyType_Ready(&Mapping_Type) < 0 || PyType_Ready(&Array_Type) < 0)
+        return NULL;
+    module = PyModule_Create(&mappedarray_module);
+    if (module == NULL)
+        return NULL;
+    Py_INCREF(&Array_Type);
+    if (PyModule_AddObject(module, "Array", (PyObject *)&Array_Type) < 0) {
+        Py_DECREF(&Array_Type);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
@@ -0,0 +1,53 @@
+# Python Buffer Protocol
+# NumPy-style: shape and strides
+# The logical structure of NumPy-style arrays is defined by itemsize, ndim, shape and strides; verify_structure()
+# (Python_Buffer_Protocol_Buff_Memory_Block.py) checks such a layout against the bounds of its memory block.
+#
+# Python_Buffer_Protocol_C_Mapped_Array.c builds the "mappedarray" extension module, whose Array type exports that layout straight from a
+# memory-mapped file: a small header holds the format, shape and strides, the items follow. Opening a file of any size maps it without
+# reading it, every process that opens the same file shares the same pages, and array[key] slices into sub-views without copying.
+# memoryview() and numpy.asarray() consume an Array directly.
+#
+# Build it next to this file with:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Buffer_Protocol_C_Mapped_Array.c \
+#       -o mappedarray$(python3-config --extension-suffix)
+#
+# Example:
+#
+
+import mappedarray
+
+from Python_Buffer_Protocol_Buff_Memory_Block import verify_structure
+
+# a 4 x 6 C array of 8-byte integers, stored in a file
+
+table = mappedarray.create("table.nd", "q", (4, 6))
+
+rows = memoryview(table)
+
+for i in range(4):
+    for j in range(6):
+        rows[i, j] = i * 6 + j  # writes go to the mapped pages
+
+table.flush()
+
+# every other column of the last two rows, in reverse order: a sub-view of the same mapping
+
+view = table[2:, ::-2]
+
+print(view, view.strides)  # prints <mappedarray.Array format='q' shape=(2, 3)> (48, -16)
+
+print(memoryview(view).tolist())  # prints [[17, 15, 13], [23, 21, 19]]
+
+print(verify_structure(4 * 6 * 8, view.itemsize, view.ndim, view.shape, view.strides, view.offset))  # prints True
+
+# another process (or this one) maps the same file read-only, without reading it
+
+shared = mappedarray.open("table.nd")
+
+print(memoryview(shared[3]).tolist())  # prints [18, 19, 20, 21, 22, 23]
+
+rows.release()
+
+table.close()
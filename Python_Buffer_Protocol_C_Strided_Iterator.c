@@ -0,0 +1,480 @@
+/********************************************************* CPython Buffer Protocol ************************************************************************
+
+# PIL-style: shape, strides and suboffsets.
+# In addition to the regular items, PIL-style arrays can contain pointers that must be followed in order to get to the next element in a dimension.
+# get_item_pointer() in Python_Buffer_Protocol_C_N-D_Array.c resolves one N-dimensional index at a time, walking every dimension and following
+# every suboffset on each call, so a full scan redoes the same pointer chasing for every element.
+#
+# This extension module, "strided", scans such buffers once:
+#
+# > runs(obj) returns an iterator over the contiguous inner runs of any buffer (NumPy-style strides, PIL-style suboffsets or plain C arrays).
+#   The pointer of each outer dimension is resolved once, when its index changes, and kept on a small stack; only the last dimension is
+#   walked per run. Each run is yielded as a zero-copy memoryview with the exporter's format and itemsize; the memoryview keeps the exporter
+#   alive. A C-contiguous buffer without suboffsets is yielded as a single run; a last dimension that is not unit-stride (a transposed array)
+#   is yielded as one strided 1-D run per row, and only a last dimension with suboffsets is yielded item by item.
+#
+# > gather(src, indices, dest) copies the items of src at the given N-D indices into the contiguous writable buffer dest in one pass.
+#   scatter(src, indices, dest) does the reverse, writing the contiguous items of src into dest at the given indices.
+#   indices is either a buffer of n * ndim native Py_ssize_t values (array.array('q'), a NumPy int64 array) or a sequence of index tuples.
+#   Both return the number of items copied.
+#
+# Build:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Buffer_Protocol_C_Strided_Iterator.c \
+#       -o strided$(python3-config --extension-suffix)
+
+**********************************************************************************************************************************************************/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+#define MAX_NDIM 64
+
+
+/* Same walk as get_item_pointer(), with suboffsets allowed to be NULL. */
+
+static char *
+get_item_pointer(int ndim, char *buf, Py_ssize_t *strides,
+                 Py_ssize_t *suboffsets, Py_ssize_t *indices)
+{
+    char *pointer = buf;
+    int i;
+
+    for (i = 0; i < ndim; i++) {
+        pointer += strides[i] * indices[i];
+        if (suboffsets != NULL && suboffsets[i] >= 0) {
+            pointer = *((char **)pointer) + suboffsets[i];
+        }
+    }
+    return pointer;
+}
+
+
+/*
+  Iterator state: the exporter's buffer, the current outer index and the
+  resolved pointer of each outer dimension.  ptrs[d] is the address of
+  the first item of the sub-array selected by index[0..d-1], with the
+  suboffsets of dimensions 0..d-1 already followed.
+*/
+
+typedef struct {
+    PyObject_HEAD
+    Py_buffer view;
+    int ndim;
+    int single;             /* whole buffer is one contiguous run */
+    int done;
+    Py_ssize_t shape[MAX_NDIM];
+    Py_ssize_t strides[MAX_NDIM];
+    Py_ssize_t suboffsets[MAX_NDIM];
+    Py_ssize_t index[MAX_NDIM];
+    char *ptrs[MAX_NDIM + 1];
+} RunsObject;
+
+
+/* A run is a tiny exporter over memory owned by a RunsObject. */
+
+typedef struct {
+    PyObject_HEAD
+    RunsObject *owner;
+    char *ptr;
+    Py_ssize_t shape;
+    Py_ssize_t stride;
+} RunObject;
+
+static PyTypeObject Runs_Type;
+static PyTypeObject Run_Type;
+
+
+static void
+Run_dealloc(RunObject *self)
+{
+    Py_XDECREF(self->owner);
+    PyObject_Free(self);
+}
+
+static int
+Run_getbuffer(RunObject *self, Py_buffer *view, int flags)
+{
+    Py_buffer *base = &self->owner->view;
+
+    if ((flags & PyBUF_WRITABLE) && base->readonly) {
+        PyErr_SetString(PyExc_BufferError, "run is read-only");
+        return -1;
+    }
+    if (self->stride != base->itemsize
+        && (flags & PyBUF_STRIDES) != PyBUF_STRIDES) {
+        PyErr_SetString(PyExc_BufferError, "run is not contiguous");
+        return -1;
+    }
+    view->buf = self->ptr;
+    view->obj = (PyObject *)self;
+    Py_INCREF(self);
+    view->len = self->shape * base->itemsize;
+    view->readonly = base->readonly;
+    view->itemsize = base->itemsize;
+    view->format = (flags & PyBUF_FORMAT) ? base->format : NULL;
+    view->ndim = 1;
+    view->shape = (flags & PyBUF_ND) == PyBUF_ND ? &self->shape : NULL;
+    view->strides = (flags & PyBUF_STRIDES) == PyBUF_STRIDES ? &self->stride : NULL;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+    return 0;
+}
+
+static PyBufferProcs Run_as_buffer = {
+    (getbufferproc)Run_getbuffer,
+    NULL,
+};
+
+static PyTypeObject Run_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "strided.Run",
+    .tp_basicsize = sizeof(RunObject),
+    .tp_dealloc = (destructor)Run_dealloc,
+    .tp_as_buffer = &Run_as_buffer,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+};
+
+
+static PyObject *
+new_run(RunsObject *owner, char *ptr, Py_ssize_t shape, Py_ssize_t stride)
+{
+    RunObject *run;
+    PyObject *result;
+
+    run = PyObject_New(RunObject, &Run_Type);
+    if (run == NULL)
+        return NULL;
+    Py_INCREF(owner);
+    run->owner = owner;
+    run->ptr = ptr;
+    run->shape = shape;
+    run->stride = stride;
+
+    result = PyMemoryView_FromObject((PyObject *)run);
+    Py_DECREF(run);
+    return result;
+}
+
+
+/* Resolve ptrs[d + 1 .. ndim - 1] from ptrs[d]. */
+
+static void
+resolve_from(RunsObject *self, int d)
+{
+    int last = self->ndim - 1;
+
+    for (; d < last; d++) {
+        char *pointer = self->ptrs[d] + self->strides[d] * self->index[d];
+        if (self->suboffsets[d] >= 0)
+            pointer = *((char **)pointer) + self->suboffsets[d];
+        self->ptrs[d + 1] = pointer;
+    }
+}
+
+static PyObject *
+strided_runs(PyObject *module, PyObject *obj)
+{
+    RunsObject *self;
+    int i;
+
+    self = PyObject_New(RunsObject, &Runs_Type);
+    if (self == NULL)
+        return NULL;
+    if (PyObject_GetBuffer(obj, &self->view, PyBUF_FULL_RO) < 0) {
+        self->view.obj = NULL;
+        Py_DECREF(self);
+        return NULL;
+    }
+    if (self->view.ndim > MAX_NDIM) {
+        PyErr_Format(PyExc_ValueError, "at most %d dimensions are supported",
+                     MAX_NDIM);
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    self->ndim = self->view.ndim;
+    self->done = 0;
+    self->single = (self->view.suboffsets == NULL
+                    && PyBuffer_IsContiguous(&self->view, 'C'));
+
+    for (i = 0; i < self->ndim; i++) {
+        self->shape[i] = self->view.shape[i];
+        self->strides[i] = self->view.strides[i];
+        self->suboffsets[i] = (self->view.suboffsets != NULL
+                               ? self->view.suboffsets[i] : -1);
+        self->index[i] = 0;
+        if (self->shape[i] == 0)
+            self->done = 1;
+    }
+    self->ptrs[0] = (char *)self->view.buf;
+    if (!self->single && self->ndim > 0 && !self->done)
+        resolve_from(self, 0);
+    return (PyObject *)self;
+}
+
+static PyObject *
+Runs_next(RunsObject *self)
+{
+    int last = self->ndim - 1;
+    Py_ssize_t itemsize = self->view.itemsize;
+    PyObject *run;
+    char *row;
+    int d;
+
+    if (self->done)
+        return NULL;
+
+    if (self->single || self->ndim == 0) {
+        self->done = 1;
+        return new_run(self, (char *)self->view.buf,
+                       self->view.len / itemsize, itemsize);
+    }
+
+    row = self->ptrs[last];
+
+    if (self->suboffsets[last] >= 0) {
+        /* indirect last dimension: one item per run */
+        char *pointer = row + self->strides[last] * self->index[last];
+        pointer = *((char **)pointer) + self->suboffsets[last];
+        run = new_run(self, pointer, 1, itemsize);
+        if (++self->index[last] < self->shape[last])
+            return run;
+        self->index[last] = 0;
+    }
+    else {
+        /* the whole row, strided if the last dimension is */
+        run = new_run(self, row, self->shape[last], self->strides[last]);
+    }
+
+    /* advance the outer index, re-resolving only the dimensions below
+       the one that changed */
+    for (d = last - 1; d >= 0; d--) {
+        if (++self->index[d] < self->shape[d]) {
+            resolve_from(self, d);
+            return run;
+        }
+        self->index[d] = 0;
+    }
+    self->done = 1;
+    return run;
+}
+
+static void
+Runs_dealloc(RunsObject *self)
+{
+    if (self->view.obj != NULL)
+        PyBuffer_Release(&self->view);
+    PyObject_Free(self);
+}
+
+static PyTypeObject Runs_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "strided.Runs",
+    .tp_basicsize = sizeof(RunsObject),
+    .tp_dealloc = (destructor)Runs_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_iter = PyObject_SelfIter,
+    .tp_iternext = (iternextfunc)Runs_next,
+};
+
+
+/*
+  Index sets for gather/scatter: either a buffer of n * ndim Py_ssize_t or
+  a sequence of n tuples.  On success *indices points to n * ndim values
+  allocated with PyMem_New, to be released with PyMem_Del.
+
+  The values are always copied, even from a buffer: they are validated here
+  with the GIL held and used later without it, when another thread (or the
+  scatter itself, if the index buffer aliases the destination) could change
+  the caller's buffer between the check and the copy.
+*/
+
+static int
+get_indices(PyObject *obj, Py_buffer *src, Py_ssize_t **indices, Py_ssize_t *n)
+{
+    int ndim = src->ndim;
+    Py_ssize_t i, count;
+    int d;
+
+    *indices = NULL;
+
+    if (PyObject_CheckBuffer(obj)) {
+        Py_buffer index_view;
+        if (PyObject_GetBuffer(obj, &index_view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+            return -1;
+        if (index_view.itemsize != sizeof(Py_ssize_t)
+            || strchr("nqlNQL", index_view.format[strlen(index_view.format) - 1]) == NULL) {
+            PyErr_SetString(PyExc_TypeError,
+                            "index buffer must hold native Py_ssize_t values");
+            PyBuffer_Release(&index_view);
+            return -1;
+        }
+        count = index_view.len / sizeof(Py_ssize_t);
+        if (ndim == 0 || count % ndim) {
+            PyErr_SetString(PyExc_ValueError,
+                            "index buffer length is not a multiple of ndim");
+            PyBuffer_Release(&index_view);
+            return -1;
+        }
+        *indices = PyMem_New(Py_ssize_t, count + 1);
+        if (*indices == NULL) {
+            PyBuffer_Release(&index_view);
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(*indices, index_view.buf, count * sizeof(Py_ssize_t));
+        PyBuffer_Release(&index_view);
+        *n = count / ndim;
+    }
+    else {
+        PyObject *seq = PySequence_Fast(obj, "indices must be a buffer or a sequence");
+        if (seq == NULL)
+            return -1;
+        count = PySequence_Fast_GET_SIZE(seq);
+        *indices = PyMem_New(Py_ssize_t, count * ndim + 1);
+        if (*indices == NULL) {
+            Py_DECREF(seq);
+            PyErr_NoMemory();
+            return -1;
+        }
+        for (i = 0; i < count; i++) {
+            PyObject *item = PySequence_Fast(PySequence_Fast_GET_ITEM(seq, i),
+                                             "each index must be a sequence");
+            if (item == NULL || PySequence_Fast_GET_SIZE(item) != ndim) {
+                if (item != NULL)
+                    PyErr_Format(PyExc_ValueError,
+                                 "each index must have %d values", ndim);
+                Py_XDECREF(item);
+                Py_DECREF(seq);
+                goto error;
+            }
+            for (d = 0; d < ndim; d++) {
+                Py_ssize_t value = PyNumber_AsSsize_t(
+                    PySequence_Fast_GET_ITEM(item, d), PyExc_IndexError);
+                if (value == -1 && PyErr_Occurred()) {
+                    Py_DECREF(item);
+                    Py_DECREF(seq);
+                    goto error;
+                }
+                (*indices)[i * ndim + d] = value;
+            }
+            Py_DECREF(item);
+        }
+        Py_DECREF(seq);
+        *n = count;
+    }
+
+    for (i = 0; i < *n * ndim; i++) {
+        Py_ssize_t value = (*indices)[i];
+        if (value < 0 || value >= src->shape[i % ndim]) {
+            PyErr_Format(PyExc_IndexError,
+                         "index %zd out of range for dimension %d",
+                         value, (int)(i % ndim));
+            goto error;
+        }
+    }
+    return 0;
+
+error:
+    PyMem_Del(*indices);
+    *indices = NULL;
+    return -1;
+}
+
+static PyObject *
+copy_items(PyObject *args, int scatter)
+{
+    PyObject *src_obj, *indices_obj, *dest_obj;
+    Py_buffer nd, flat;
+    Py_ssize_t *indices, n, i;
+    int ndim;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "OOO", &src_obj, &indices_obj, &dest_obj))
+        return NULL;
+
+    /* nd is the N-D side, flat the contiguous side */
+    if (PyObject_GetBuffer(scatter ? dest_obj : src_obj, &nd,
+                           scatter ? PyBUF_FULL : PyBUF_FULL_RO) < 0)
+        return NULL;
+    if (PyObject_GetBuffer(scatter ? src_obj : dest_obj, &flat,
+                           scatter ? PyBUF_SIMPLE : PyBUF_WRITABLE) < 0) {
+        PyBuffer_Release(&nd);
+        return NULL;
+    }
+    if (nd.ndim == 0) {
+        PyErr_SetString(PyExc_ValueError, "N-D buffer must have ndim >= 1");
+        goto done;
+    }
+    if (get_indices(indices_obj, &nd, &indices, &n) < 0)
+        goto done;
+
+    if (flat.len < n * nd.itemsize) {
+        PyErr_Format(PyExc_ValueError,
+                     "contiguous buffer too small: %zd bytes for %zd items",
+                     flat.len, n);
+    }
+    else {
+        char *pointer = (char *)flat.buf;
+        ndim = nd.ndim;
+        Py_BEGIN_ALLOW_THREADS
+        for (i = 0; i < n; i++) {
+            char *item = get_item_pointer(ndim, (char *)nd.buf, nd.strides,
+                                          nd.suboffsets, indices + i * ndim);
+            if (scatter)
+                memcpy(item, pointer, nd.itemsize);
+            else
+                memcpy(pointer, item, nd.itemsize);
+            pointer += nd.itemsize;
+        }
+        Py_END_ALLOW_THREADS
+        result = PyLong_FromSsize_t(n);
+    }
+
+    PyMem_Del(indices);
+done:
+    PyBuffer_Release(&flat);
+    PyBuffer_Release(&nd);
+    return result;
+}
+
+static PyObject *
+strided_gather(PyObject *module, PyObject *args)
+{
+    return copy_items(args, 0);
+}
+
+static PyObject *
+strided_scatter(PyObject *module, PyObject *args)
+{
+    return copy_items(args, 1);
+}
+
+
+static PyMethodDef strided_methods[] = {
+    {"runs", strided_runs, METH_O,
+     "runs(obj)\n\nIterate over the contiguous inner runs of a buffer as memoryviews."},
+    {"gather", strided_gather, METH_VARARGS,
+     "gather(src, indices, dest)\n\nCopy the items of src at indices into the contiguous buffer dest."},
+    {"scatter", strided_scatter, METH_VARARGS,
+     "scatter(src, indices, dest)\n\nCopy the contiguous items of src into dest at indices."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef strided_module = {
+    PyModuleDef_HEAD_INIT,
+    "strided",
+    "Strided and suboffset buffer iteration, gather and scatter.",
+    -1,
+    strided_methods,
+};
+
+PyMODINIT_FUNC
+PyInit_strided(void)
+{
+    if (PyType_Ready(&Run_Type) < 0 || PyType_Ready(&Runs_Type) < 0)
+        return NULL;
+    return PyModule_Create(&strided_module);
+}
@@ -0,0 +1,56 @@
+# Python Buffer Protocol
+# PIL-style: shape, strides and suboffsets
+# In addition to the regular items, PIL-style arrays can contain pointers that must be followed in order to get to the next element in a dimension.
+# get_item_pointer() (Python_Buffer_Protocol_C_N-D_Array.c) follows those pointers again for every element it is asked for.
+#
+# Python_Buffer_Protocol_C_Strided_Iterator.c builds the "strided" extension module, which resolves the pointer of each outer dimension once
+# and hands out contiguous inner runs as zero-copy memoryviews, plus a one-pass gather/scatter over an arbitrary index set.
+#
+# Build it next to this file with:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Buffer_Protocol_C_Strided_Iterator.c \
+#       -o strided$(python3-config --extension-suffix)
+#
+# Example:
+#
+
+import array
+
+import strided
+
+# a 4 x 6 C array of 8-byte integers
+
+block = array.array("q", range(24))
+rows = memoryview(block).cast("B").cast("q", shape=[4, 6])
+
+# iterate over the contiguous runs of the buffer without copying;
+# a C-contiguous buffer like this one is a single run, a strided or PIL-style one yields one run per row
+
+for run in strided.runs(rows):
+    print(run.tolist())
+
+# a transposed array is not C-contiguous: its last dimension has a stride of one row, and each of its rows is a strided run
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    a = numpy.arange(24).reshape(4, 6)
+
+    runs = [run.tolist() for run in strided.runs(a.T)]
+
+    print(len(runs))  # prints 6: one run per row of a.T, not one per item
+
+    print(runs == a.T.tolist())  # prints True
+
+    print([run.tolist() for run in strided.runs(a[:, ::-2])] == a[:, ::-2].tolist())  # prints True
+
+# copy the items at arbitrary (row, column) indices into a contiguous buffer in one pass
+
+dest = array.array("q", bytes(8 * 3))
+
+strided.gather(rows, [(0, 0), (2, 3), (3, 5)], dest)
+
+print(dest)  # prints array('q', [0, 15, 23])
@@ -0,0 +1,124 @@
+# Python Buffer Protocol
+# Certain objects available in Python wrap access to an underlying memory array or buffer.
+# Buffer structures can be used as a zero-copy slicing mechanism: a sliced or strided sub-view of a memory block is just another
+# (buf, shape, strides) triple over the same block.
+#
+# NumPy-style: shape and strides.
+# The logical structure of NumPy-style arrays is defined by itemsize, ndim, shape and strides.
+#
+# ptr = (char *)buf + indices[0] * strides[0] + ... + indices[n-1] * strides[n-1] item = *((typeof(item) *)ptr);
+#
+# verify_structure() in Python_Buffer_Protocol_Buff_Memory_Block.py checks one layout at a time. When many sub-views of the same block are
+# exported, verify_structures() checks a whole batch of layouts sharing memlen, itemsize and ndim in one vectorized pass:
+# > shapes and strides are 2-D NumPy arrays of shape (n, ndim), or flat sequences (array.array, list) of n * ndim integers,
+# > offsets is a sequence of n integers, offsets[i] = (char *)buf[i] - mem.
+#
+# It returns (valid, imin, imax): a list of bools, True for the layouts verify_structure() accepts, and the lowest and highest byte offsets
+# each layout can reach relative to its buf, as array.array('q') objects, so callers can reuse them for bounds checks. Empty layouts (a 0 in
+# shape) reach no element and get imin = imax = 0.
+#
+# NumPy is used when it is installed; otherwise the same checks run in a plain Python loop. The results have the same types either way.
+#
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _verify_structures_numpy(memlen, itemsize, ndim, shapes, strides, offsets):
+    offsets = numpy.asarray(offsets, dtype=numpy.int64).reshape(-1)
+    n = len(offsets)
+    shapes = numpy.asarray(shapes, dtype=numpy.int64).reshape(n, ndim)
+    strides = numpy.asarray(strides, dtype=numpy.int64).reshape(n, ndim)
+
+    valid = ((offsets % itemsize == 0)
+             & (offsets >= 0) & (offsets + itemsize <= memlen)
+             & ~(strides % itemsize).any(axis=1))
+
+    empty = (shapes == 0).any(axis=1)
+    extents = strides * (shapes - 1)
+    imin = numpy.where(strides <= 0, extents, 0).sum(axis=1)
+    imax = numpy.where(strides > 0, extents, 0).sum(axis=1)
+    imin[empty] = 0
+    imax[empty] = 0
+
+    valid &= empty | ((offsets + imin >= 0)
+                      & (offsets + imax + itemsize <= memlen))
+    return (valid.tolist(), array.array("q", imin.tobytes()),
+            array.array("q", imax.tobytes()))
+
+
+def _flatten(values):
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    values = list(values)
+    if values and isinstance(values[0], (list, tuple)):
+        return [v for row in values for v in row]
+    return values
+
+
+def _verify_structures_python(memlen, itemsize, ndim, shapes, strides, offsets):
+    n = len(offsets)
+    valid = [False] * n
+    imin = array.array("q", bytes(8 * n))
+    imax = array.array("q", bytes(8 * n))
+
+    for i in range(n):
+        offset = offsets[i]
+        shape = shapes[i * ndim:(i + 1) * ndim]
+        stride = strides[i * ndim:(i + 1) * ndim]
+
+        if 0 in shape:
+            low = high = 0
+        else:
+            low = sum(stride[j] * (shape[j] - 1) for j in range(ndim)
+                      if stride[j] <= 0)
+            high = sum(stride[j] * (shape[j] - 1) for j in range(ndim)
+                       if stride[j] > 0)
+        imin[i] = low
+        imax[i] = high
+
+        if offset % itemsize or offset < 0 or offset + itemsize > memlen:
+            continue
+        if any(v % itemsize for v in stride):
+            continue
+        valid[i] = bool(0 in shape
+                        or (0 <= offset + low and offset + high + itemsize <= memlen))
+
+    return valid, imin, imax
+
+
+def verify_structures(memlen, itemsize, ndim, shapes, strides, offsets):
+    """Verify a batch of layouts over the same memory block, see
+       verify_structure().  Return (valid, imin, imax).
+    """
+
+    if ndim < 0:
+        raise ValueError("ndim must be >= 0")
+
+    if numpy is not None:
+        return _verify_structures_numpy(memlen, itemsize, ndim,
+                                        shapes, strides, offsets)
+
+    return _verify_structures_python(memlen, itemsize, ndim,
+                                     _flatten(shapes), _flatten(strides),
+                                     _flatten(offsets))
+
+
+if __name__ == "__main__":
+
+    # a 10 x 10 block of 8-byte items and three sub-views of it:
+    # the whole block, every other column, and a reversed row running past the start
+
+    memlen = 10 * 10 * 8
+
+    valid, imin, imax = verify_structures(
+        memlen, 8, 2,
+        shapes=array.array("q", [10, 10, 10, 5, 1, 10]),
+        strides=array.array("q", [80, 8, 80, 16, 80, -8]),
+        offsets=array.array("q", [0, 0, 40]))
+
+    print(valid, imin.tolist(), imax.tolist())  # prints [True, True, False] [0, 0, -72] [792, 784, 0]
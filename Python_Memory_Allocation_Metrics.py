@@ -0,0 +1,315 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Per-block allocation metrics.
+#
+# The display scripts report one total at one moment. measure() attributes memory to a named block of code instead, without taking a
+# snapshot: used as a context manager or a decorator, it records for every run of the block
+# > allocated: net bytes allocated (tracemalloc.get_traced_memory() current size, after minus before),
+# > peak: the highest traced size reached inside the block, above the size at entry (tracemalloc.reset_peak() on entry),
+# > blocks: net memory blocks allocated (sys.getallocatedblocks(), after minus before),
+# > seconds: elapsed wall time.
+#
+# Runs are added to a MetricsRegistry as sums and histograms (peak bytes and seconds). Every thread updates its own shard of the registry,
+# so recording takes no lock; shards are merged when the registry is exported with to_prometheus() (Prometheus text format) or
+# to_json_lines(), and the shards of threads that have exited are folded into one on the way, so a thread-per-request server does not keep
+# a shard per request. The net allocated bytes and blocks can go down, so Prometheus gets them as gauges, not counters.
+#
+# measure() decorates coroutine functions too: the block then spans the whole coroutine, awaits included.
+#
+# The tracemalloc peak is process-wide: nested blocks on one thread are accounted correctly, but blocks running concurrently on other threads
+# (or in other asyncio tasks) can raise each other's peak. Memory figures are 0 while tracemalloc is not tracing.
+#
+
+import bisect
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))     # 1 KiB .. 1 GiB
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class _Series:
+    __slots__ = ("count", "allocated", "peak", "blocks", "seconds",
+                 "peak_buckets", "seconds_buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.allocated = 0
+        self.peak = 0
+        self.blocks = 0
+        self.seconds = 0.0
+        self.peak_buckets = [0] * (len(BYTES_BUCKETS) + 1)
+        self.seconds_buckets = [0] * (len(SECONDS_BUCKETS) + 1)
+
+    def add(self, allocated, peak, blocks, seconds):
+        self.count += 1
+        self.allocated += allocated
+        self.peak += peak
+        self.blocks += blocks
+        self.seconds += seconds
+        self.peak_buckets[bisect.bisect_left(BYTES_BUCKETS, peak)] += 1
+        self.seconds_buckets[bisect.bisect_left(SECONDS_BUCKETS, seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.allocated += other.allocated
+        self.peak += other.peak
+        self.blocks += other.blocks
+        self.seconds += other.seconds
+        for index, value in enumerate(other.peak_buckets):
+            self.peak_buckets[index] += value
+        for index, value in enumerate(other.seconds_buckets):
+            self.seconds_buckets[index] += value
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []      # (weak reference to the thread, shard)
+        self._retired = {}     # the shards of exited threads, merged
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._retire()
+                self._shards.append((weakref.ref(threading.current_thread()),
+                                     shard))
+            return shard
+
+    def _retire(self):
+        # called with the lock held: an exited thread no longer writes to
+        # its shard, so it can be merged into _retired and dropped
+        live = []
+        for ref, shard in self._shards:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                live.append((ref, shard))
+                continue
+            for name, series in shard.items():
+                try:
+                    total = self._retired[name]
+                except KeyError:
+                    total = self._retired[name] = _Series()
+                total.merge(series)
+        self._shards = live
+
+    def record(self, name, allocated, peak, blocks, seconds):
+        shard = self._shard()
+        try:
+            series = shard[name]
+        except KeyError:
+            series = shard[name] = _Series()
+        series.add(allocated, peak, blocks, seconds)
+
+    def collect(self):
+        """Merge the shards; return {name: series}."""
+
+        merged = {}
+        with self._shards_lock:
+            self._retire()
+            shards = [shard for ref, shard in self._shards]
+            for name, series in self._retired.items():
+                total = merged[name] = _Series()
+                total.merge(series)
+        for shard in shards:
+            for name, series in list(shard.items()):
+                try:
+                    total = merged[name]
+                except KeyError:
+                    total = merged[name] = _Series()
+                total.merge(series)
+        return merged
+
+    def clear(self):
+        with self._shards_lock:
+            for ref, shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+    def to_json_lines(self):
+        lines = []
+        for name, series in sorted(self.collect().items()):
+            lines.append(json.dumps({
+                "block": name,
+                "count": series.count,
+                "allocated_bytes": series.allocated,
+                "peak_bytes_sum": series.peak,
+                "blocks": series.blocks,
+                "seconds_sum": series.seconds,
+                "peak_bytes_buckets": dict(zip(
+                    [str(bound) for bound in BYTES_BUCKETS] + ["+Inf"],
+                    series.peak_buckets)),
+                "seconds_buckets": dict(zip(
+                    [str(bound) for bound in SECONDS_BUCKETS] + ["+Inf"],
+                    series.seconds_buckets)),
+            }, sort_keys=True))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def to_prometheus(self, prefix="python_memory_block"):
+        collected = sorted(self.collect().items())
+        lines = []
+
+        def histogram(metric, help_text, bounds, attribute, total):
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s histogram" % metric)
+            for name, series in collected:
+                label = _label(name)
+                cumulative = 0
+                for bound, value in zip(list(bounds) + ["+Inf"],
+                                        getattr(series, attribute)):
+                    cumulative += value
+                    lines.append('%s_bucket{block="%s",le="%s"} %s'
+                                 % (metric, label, bound, cumulative))
+                lines.append('%s_sum{block="%s"} %s'
+                             % (metric, label, getattr(series, total)))
+                lines.append('%s_count{block="%s"} %s'
+                             % (metric, label, series.count))
+
+        def gauge(metric, help_text, attribute):
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s gauge" % metric)
+            for name, series in collected:
+                lines.append('%s{block="%s"} %s'
+                             % (metric, _label(name), getattr(series, attribute)))
+
+        histogram(prefix + "_peak_bytes",
+                  "Traced memory peak above the size at block entry.",
+                  BYTES_BUCKETS, "peak_buckets", "peak")
+        histogram(prefix + "_seconds", "Elapsed time of the block.",
+                  SECONDS_BUCKETS, "seconds_buckets", "seconds")
+        gauge(prefix + "_allocated_bytes",
+              "Net traced bytes allocated by the block, over all its runs.",
+              "allocated")
+        gauge(prefix + "_allocated_blocks",
+              "Net memory blocks allocated by the block, over all its runs.",
+              "blocks")
+        return "\n".join(lines) + "\n"
+
+
+def _label(name):
+    return name.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = MetricsRegistry()
+
+# per-thread stack of the peaks seen by the enclosing blocks, because
+# reset_peak() in a nested block forgets the peak of the outer one
+_stack = threading.local()
+
+
+class measure:
+    """Record allocation metrics of a block under name:
+
+        with measure("handler"):
+            ...
+
+        @measure("handler")
+        def handler(request):
+            ...
+    """
+
+    def __init__(self, name, registry=None):
+        self.name = name
+        self.registry = registry if registry is not None else REGISTRY
+        self._entries = threading.local()
+
+    def __enter__(self):
+        try:
+            frames = _stack.frames
+        except AttributeError:
+            frames = _stack.frames = []
+        try:
+            entries = self._entries.list
+        except AttributeError:
+            entries = self._entries.list = []
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if frames:
+                frames[-1][0] = max(frames[-1][0], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        frame = [current, current, sys.getallocatedblocks(), tracing,
+                 time.perf_counter()]
+        frames.append(frame)
+        entries.append(frame)
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter()
+        frame = self._entries.list.pop()
+        frames = _stack.frames
+        frames.remove(frame)
+        seen_peak, start, start_blocks, tracing, started = frame
+        seconds -= started
+
+        if tracing and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, seen_peak)
+            if frames:
+                frames[-1][0] = max(frames[-1][0], peak)
+            allocated = current - start
+            peak -= start
+        else:
+            allocated = peak = 0
+
+        self.registry.record(self.name, allocated, peak,
+                             sys.getallocatedblocks() - start_blocks, seconds)
+        return False
+
+    def __call__(self, function):
+        # a fresh measure per call keeps recursive and concurrent calls apart
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with measure(self.name, self.registry):
+                    return await function(*args, **kwargs)
+            return wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(self.name, self.registry):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start()
+
+    @measure("build_strings")
+    def build_strings(n):
+        return [str(i) * 10 for i in range(n)]
+
+    with measure("request"):
+
+        # ... run your application ...
+
+        data = build_strings(10000)
+        del data
+
+    print(REGISTRY.to_prometheus())
+
+    print(REGISTRY.to_json_lines())
@@ -0,0 +1,274 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Non-blocking reports for asyncio services.
+#
+# take_snapshot() followed by display_top() or compare_to() runs the capture, the filtering, the grouping and the formatting in one go on the
+# event loop. take_report() is a coroutine that only does the capture on the loop: a single tracemalloc._get_traces() call, the C copy of
+# the traces that take_snapshot() starts with. Everything else runs in an executor, one chunk of chunk_size traces per job, and the
+# coroutine awaits every job, so the loop serves other tasks between chunks:
+# > the traces are summed per domain and traceback with fold_traces() (Python_Memory_Trace_Fold.py),
+# > the filters (DEFAULT_FILTERS: <frozen importlib._bootstrap>, <unknown> and tracemalloc itself) are evaluated by a FilterSet, once per
+#   domain and traceback,
+# > the tracebacks are grouped by key_type, sorted into Statistic instances, compared with the previous report (StatisticDiff instances,
+#   like compare_to()) and formatted like display_top().
+#
+# ReportServer serves the latest report on a Unix socket, without HTTP. A client sends one command line and reads the report until EOF:
+#   latest    the last report (built on the first request),
+#   refresh   build a new report first, compared with the previous one,
+# for example: echo refresh | socat - UNIX-CONNECT:/tmp/memory.sock, or python Python_Memory_Async_Report.py /tmp/memory.sock refresh
+#
+
+import asyncio
+import contextlib
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+from Python_Memory_Frame_Render import format_top, split_top
+from Python_Memory_Snapshot_Sampler import DEFAULT_FILTERS
+from Python_Memory_Trace_Fold import compile_filters, fold_traces
+
+
+class Report:
+    """A finished report: stats are sorted Statistic instances, diffs the
+    StatisticDiff instances against the previous report (or None)."""
+
+    __slots__ = ("timestamp", "capture_time", "build_time", "key_type",
+                 "stats", "diffs", "text")
+
+    def __init__(self, timestamp, capture_time, key_type):
+        self.timestamp = timestamp
+        self.capture_time = capture_time
+        self.build_time = 0.0
+        self.key_type = key_type
+        self.stats = []
+        self.diffs = None
+        self.text = ""
+
+
+def _group_chunk(totals, key_type, cumulative, filter_set, stats):
+    # same grouping as Snapshot._group_by()
+    Traceback = tracemalloc.Traceback
+    for trace, size, count in totals:
+        if filter_set and not filter_set.match_trace(trace):
+            continue
+        frames = trace[2]
+        if key_type == 'traceback':
+            keys = (Traceback(frames),)
+        elif cumulative:
+            if key_type == 'lineno':
+                keys = [Traceback((frame,)) for frame in frames]
+            else:
+                keys = [Traceback(((frame[0], 0),)) for frame in frames]
+        elif key_type == 'lineno':
+            keys = (Traceback(frames[:1]),)
+        else:
+            keys = (Traceback(((frames[0][0], 0),)),)
+        for key in keys:
+            try:
+                stat = stats[key]
+                stat[0] += size
+                stat[1] += count
+            except KeyError:
+                stats[key] = [size, count]
+
+
+def _finish(report, stats, previous, limit):
+    Statistic = tracemalloc.Statistic
+    report.stats = [Statistic(key, size, count)
+                    for key, (size, count) in stats.items()]
+    report.stats.sort(reverse=True, key=Statistic._sort_key)
+
+    if previous is not None:
+        old = {stat.traceback: stat for stat in previous.stats}
+        diffs = []
+        for stat in report.stats:
+            before = old.pop(stat.traceback, None)
+            if before is None:
+                diffs.append(tracemalloc.StatisticDiff(
+                    stat.traceback, stat.size, stat.size, stat.count, stat.count))
+            else:
+                diffs.append(tracemalloc.StatisticDiff(
+                    stat.traceback, stat.size, stat.size - before.size,
+                    stat.count, stat.count - before.count))
+        for before in old.values():
+            diffs.append(tracemalloc.StatisticDiff(
+                before.traceback, 0, -before.size, 0, -before.count))
+        diffs.sort(reverse=True, key=tracemalloc.StatisticDiff._sort_key)
+        report.diffs = diffs
+
+    report.text = format_report(report, limit)
+
+
+def format_report(report, limit=10):
+    """Format report like display_top(), then the top differences."""
+
+    lines = format_top(*split_top(report.stats, limit), limit, report.key_type)
+
+    if report.diffs is not None:
+        lines.append("")
+        lines.append("[ Top %s differences ]" % limit)
+        lines.extend(str(diff) for diff in report.diffs[:limit])
+    return "\n".join(lines) + "\n"
+
+
+async def take_report(key_type='lineno', cumulative=False, limit=10,
+                      filters=DEFAULT_FILTERS, previous=None,
+                      chunk_size=50000, executor=None):
+    """Capture the traces and build a Report without blocking the loop
+    for more than one chunk at a time."""
+
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("the tracemalloc module must be tracing memory "
+                           "allocations to take a report")
+    if key_type not in ('traceback', 'filename', 'lineno'):
+        raise ValueError("unknown key_type: %r" % (key_type,))
+    if cumulative and key_type not in ('lineno', 'filename'):
+        raise ValueError("cumulative mode cannot by used "
+                         "with key type %r" % key_type)
+
+    loop = asyncio.get_running_loop()
+
+    start = time.perf_counter()
+    traces = tracemalloc._get_traces()
+    report = Report(time.time(), time.perf_counter() - start, key_type)
+
+    by_id = {}
+    for first in range(0, len(traces), chunk_size):
+        await loop.run_in_executor(executor, fold_traces,
+                                   traces[first:first + chunk_size], by_id)
+    del traces
+
+    filter_set = compile_filters(filters)
+    totals = list(by_id.values())
+    del by_id
+    stats = {}
+    for first in range(0, len(totals), chunk_size):
+        await loop.run_in_executor(executor, _group_chunk,
+                                   totals[first:first + chunk_size], key_type,
+                                   cumulative, filter_set, stats)
+    del totals
+
+    await loop.run_in_executor(executor, _finish, report, stats, previous, limit)
+    report.build_time = time.perf_counter() - start
+    return report
+
+
+class ReportServer:
+    """Serve the latest report on the Unix socket at path."""
+
+    def __init__(self, path, interval=None, **options):
+        self.path = path
+        self.interval = interval
+        self.options = options
+        self.report = None
+        self._building = asyncio.Lock()
+        self._server = None
+        self._refresher = None
+
+    async def refresh(self):
+        async with self._building:
+            self.report = await take_report(previous=self.report, **self.options)
+        return self.report
+
+    async def latest(self):
+        if self.report is None:
+            return await self.refresh()
+        return self.report
+
+    async def _refresh_forever(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def _handle(self, reader, writer):
+        try:
+            command = (await reader.readline()).decode("ascii", "replace").strip()
+            if command in ("", "latest"):
+                report = await self.latest()
+            elif command == "refresh":
+                report = await self.refresh()
+            else:
+                writer.write(b"unknown command %s\n"
+                             % command.encode("ascii", "replace"))
+                await writer.drain()
+                return
+            writer.write(report.text.encode("utf-8", "surrogateescape"))
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+        if self.interval is not None:
+            self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+        self._server.close()
+        await self._server.wait_closed()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+
+def fetch_report(path, command="latest", timeout=60.0):
+    """Blocking client: return the text served by a ReportServer."""
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(command.encode("ascii") + b"\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b"".join(chunks).decode("utf-8", "surrogateescape")
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        # python Python_Memory_Async_Report.py /tmp/memory.sock [latest|refresh]
+
+        sys.stdout.write(fetch_report(sys.argv[1],
+                                      sys.argv[2] if len(sys.argv) > 2 else "latest"))
+        sys.exit(0)
+
+    async def main():
+        tracemalloc.start()
+
+        server = ReportServer("memory.sock", interval=60.0)
+        await server.start()
+
+        # ... run your application ...
+
+        data = [str(i) * 10 for i in range(100000)]
+
+        reader, writer = await asyncio.open_unix_connection("memory.sock")
+        writer.write(b"refresh\n")
+        print((await reader.read()).decode())
+        writer.close()
+
+        await server.close()
+
+    asyncio.run(main())
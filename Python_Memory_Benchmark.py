@@ -0,0 +1,505 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+#
+# Memory benchmark suite.
+#
+# Times the memory patterns shown in this repository next to their faster alternatives, over a range of payload sizes:
+# > alloc:   malloc()/free() and PyMem_Malloc()/PyMem_Free() of one I/O buffer (called through ctypes; PyMem_New() is a macro over
+#            PyMem_Malloc()), a fresh bytearray per I/O call, and a buffer reused from the bufferpool extension when it is built,
+# > io:      read() into a new bytes object, against readinto() a preallocated buffer,
+# > view:    slicing a bytes object (a copy), against slicing a memoryview (zero-copy),
+# > verify:  verify_structure() called once per layout, against one verify_structures() call for the whole batch (one layout per 64
+#            bytes of size),
+# > mmap:    file read()/write() at an offset, against slices of a memory-mapped file.
+#
+# Every case runs in a forked child: it is calibrated, timed in batches (latency percentiles are per operation), then run once more under
+# tracemalloc for its peak; the peak RSS comes from the child's rusage. Results are saved as JSON and two runs can be compared:
+#
+#   python Python_Memory_Benchmark.py run -o before.json
+#   python Python_Memory_Benchmark.py run -o after.json --filter mmap --sizes 4096 1048576
+#   python Python_Memory_Benchmark.py compare before.json after.json
+#
+# Everything runs offline, from the standard library; the bufferpool extension and numpy (used by verify_structures()) are optional.
+#
+
+import argparse
+import array
+import ctypes
+import io
+import json
+import mmap
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from Python_Buffer_Protocol_Buff_Memory_Block import verify_structure
+from Python_Buffer_Protocol_Verify_Batch import verify_structures
+
+try:
+    import bufferpool
+except ImportError:
+    bufferpool = None
+
+DEFAULT_SIZES = (64, 4096, 65536, 1 << 20)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a case: a function of size returning (operation, cleanup)."""
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# alloc
+
+_libc = ctypes.CDLL(None)
+_libc.malloc.restype = ctypes.c_void_p
+_libc.malloc.argtypes = [ctypes.c_size_t]
+_libc.free.argtypes = [ctypes.c_void_p]
+_pymem_malloc = ctypes.pythonapi.PyMem_Malloc
+_pymem_malloc.restype = ctypes.c_void_p
+_pymem_malloc.argtypes = [ctypes.c_size_t]
+_pymem_free = ctypes.pythonapi.PyMem_Free
+_pymem_free.argtypes = [ctypes.c_void_p]
+
+
+@benchmark("alloc.malloc")
+def _alloc_malloc(size):
+    malloc, free = _libc.malloc, _libc.free
+
+    def operation():
+        free(malloc(size))
+    return operation, None
+
+
+@benchmark("alloc.pymem_malloc")
+def _alloc_pymem(size):
+    malloc, free = _pymem_malloc, _pymem_free
+
+    def operation():
+        free(malloc(size))
+    return operation, None
+
+
+def _source(size):
+    # one spare byte: BytesIO.read() of the whole buffer returns it uncopied
+    return io.BytesIO(b"x" * (size + 1))
+
+
+@benchmark("alloc.bytearray")
+def _alloc_bytearray(size):
+    source = _source(size)
+
+    def operation():
+        source.seek(0)
+        buf = bytearray(size)
+        source.readinto(buf)
+        return bytes(buf)
+    return operation, None
+
+
+@benchmark("alloc.bufferpool")
+def _alloc_bufferpool(size):
+    if bufferpool is None:
+        return None
+    pool = bufferpool.BufferPool()
+    source = _source(size)
+
+    def operation():
+        source.seek(0)
+        with pool.acquire(size) as buf:
+            view = memoryview(buf)
+            source.readinto(view[:size])
+            view.release()
+    return operation, None
+
+
+# io
+
+@benchmark("io.read")
+def _io_read(size):
+    source = _source(size)
+
+    def operation():
+        source.seek(0)
+        return source.read(size)
+    return operation, None
+
+
+@benchmark("io.readinto")
+def _io_readinto(size):
+    source = _source(size)
+    buf = bytearray(size)
+
+    def operation():
+        source.seek(0)
+        source.readinto(buf)
+    return operation, None
+
+
+# view
+
+@benchmark("view.bytes_slice")
+def _view_bytes(size):
+    data = b"x" * (2 * size)
+
+    def operation():
+        return data[size // 2:size // 2 + size]
+    return operation, None
+
+
+@benchmark("view.memoryview_slice")
+def _view_memoryview(size):
+    data = memoryview(b"x" * (2 * size))
+
+    def operation():
+        return data[size // 2:size // 2 + size]
+    return operation, None
+
+
+# verify: one 2-D layout over a 64 KiB block per 64 bytes of size
+
+def _layouts(size):
+    count = max(1, size // 64)
+    shapes, strides, offsets = [], [], []
+    for i in range(count):
+        rows, columns = 1 + i % 32, 1 + i % 16
+        shapes.append((rows, columns))
+        strides.append((8 * 64, -8 if i % 3 == 0 else 8))
+        offsets.append(8 * (i % 64) + (8 * (columns - 1) if i % 3 == 0 else 0))
+    return shapes, strides, offsets
+
+
+@benchmark("verify.structure")
+def _verify_single(size):
+    shapes, strides, offsets = _layouts(size)
+    layouts = list(zip(shapes, strides, offsets))
+
+    def operation():
+        for shape, stride, offset in layouts:
+            verify_structure(65536, 8, 2, shape, stride, offset)
+    return operation, None
+
+
+@benchmark("verify.structures")
+def _verify_batch(size):
+    shapes, strides, offsets = _layouts(size)
+    shapes = array.array("q", [n for shape in shapes for n in shape])
+    strides = array.array("q", [n for stride in strides for n in stride])
+    offsets = array.array("q", offsets)
+
+    def operation():
+        verify_structures(65536, 8, 2, shapes, strides, offsets)
+    return operation, None
+
+
+# mmap: a 16-slot file, each operation touches the next slot
+
+def _slot_file(size):
+    fd, path = tempfile.mkstemp(prefix="membench-")
+    os.ftruncate(fd, 16 * size)
+    os.close(fd)
+    return path
+
+
+@benchmark("mmap.file_read")
+def _file_read(size):
+    path = _slot_file(size)
+    f = open(path, "r+b", buffering=0)
+    slot = [0]
+
+    def operation():
+        slot[0] = (slot[0] + 1) % 16
+        return os.pread(f.fileno(), size, slot[0] * size)
+
+    def cleanup():
+        f.close()
+        os.remove(path)
+    return operation, cleanup
+
+
+@benchmark("mmap.mmap_read")
+def _mmap_read(size):
+    path = _slot_file(size)
+    f = open(path, "r+b")
+    mm = mmap.mmap(f.fileno(), 0)
+    slot = [0]
+
+    def operation():
+        slot[0] = (slot[0] + 1) % 16
+        return mm[slot[0] * size:(slot[0] + 1) * size]
+
+    def cleanup():
+        mm.close()
+        f.close()
+        os.remove(path)
+    return operation, cleanup
+
+
+@benchmark("mmap.file_write")
+def _file_write(size):
+    path = _slot_file(size)
+    f = open(path, "r+b", buffering=0)
+    data = b"x" * size
+    slot = [0]
+
+    def operation():
+        slot[0] = (slot[0] + 1) % 16
+        os.pwrite(f.fileno(), data, slot[0] * size)
+
+    def cleanup():
+        f.close()
+        os.remove(path)
+    return operation, cleanup
+
+
+@benchmark("mmap.mmap_write")
+def _mmap_write(size):
+    path = _slot_file(size)
+    f = open(path, "r+b")
+    mm = mmap.mmap(f.fileno(), 0)
+    data = b"x" * size
+    slot = [0]
+
+    def operation():
+        slot[0] = (slot[0] + 1) % 16
+        mm[slot[0] * size:(slot[0] + 1) * size] = data
+
+    def cleanup():
+        mm.close()
+        f.close()
+        os.remove(path)
+    return operation, cleanup
+
+
+# runner
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(operation, size, duration=0.2, samples=100):
+    """Time operation; return a result dict without the RSS field."""
+
+    perf_counter = time.perf_counter
+
+    # calibrate: enough operations per sample for samples to fill duration
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = perf_counter() - start
+        if elapsed >= duration / samples or number >= 1 << 24:
+            break
+        number *= 2
+
+    latencies = []
+    for _ in range(samples):
+        start = perf_counter()
+        for _ in range(number):
+            operation()
+        latencies.append((perf_counter() - start) / number)
+    latencies.sort()
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    operation()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    mean = sum(latencies) / len(latencies)
+    return {
+        "operations": number * samples,
+        "mean": mean,
+        "p50": _percentile(latencies, 0.50),
+        "p90": _percentile(latencies, 0.90),
+        "p99": _percentile(latencies, 0.99),
+        "throughput": size / mean if mean else 0.0,
+        "tracemalloc_peak": peak,
+    }
+
+
+def _run_case(name, size, duration, samples):
+    case = BENCHMARKS[name](size)
+    if case is None:
+        return None
+    operation, cleanup = case
+    try:
+        return measure(operation, size, duration, samples)
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+
+def run_case(name, size, duration=0.2, samples=100, fork=True):
+    """Run one case, in a forked child unless fork is false.
+
+    Return a result dict, or None if the case is not available here.
+    """
+
+    if not fork:
+        result = _run_case(name, size, duration, samples)
+        if result is not None:
+            import resource
+            result["max_rss"] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024
+        return result
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:  # In the child process
+        os.close(read_fd)
+        status = 0
+        try:
+            result = _run_case(name, size, duration, samples)
+            with os.fdopen(write_fd, "w") as pipe:
+                json.dump(result, pipe)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        data = pipe.read()
+    _, status, rusage = os.wait4(pid, 0)
+    if status or not data:
+        raise RuntimeError("benchmark %s (size %s) failed" % (name, size))
+    result = json.loads(data)
+    if result is not None:
+        result["max_rss"] = rusage.ru_maxrss * 1024
+    return result
+
+
+def run(names=None, sizes=DEFAULT_SIZES, duration=0.2, samples=100, fork=True,
+        out=sys.stdout):
+    """Run the cases in names (None: all); return the JSON document."""
+
+    results = []
+    for name in sorted(BENCHMARKS) if names is None else names:
+        for size in sizes:
+            result = run_case(name, size, duration, samples, fork)
+            if result is None:
+                print("%-24s skipped (not available)" % name, file=out)
+                break
+            result.update(benchmark=name, size=size)
+            results.append(result)
+            print("%-24s %9s  p50 %s  p99 %s  %s/s  peak %s"
+                  % (name, size, _format_time(result["p50"]),
+                     _format_time(result["p99"]),
+                     _format_size(result["throughput"]),
+                     _format_size(result["tracemalloc_peak"])), file=out)
+    return {
+        "meta": {
+            "python": sys.version,
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "timestamp": time.time(),
+            "duration": duration,
+            "samples": samples,
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, threshold=0.10, out=sys.stdout):
+    """Print the p50 latency change of every case found in both runs;
+    return the list of regressions (slower by more than threshold)."""
+
+    old_results = {(r["benchmark"], r["size"]): r for r in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        key = (result["benchmark"], result["size"])
+        if key not in old_results:
+            continue
+        before, after = old_results[key]["p50"], result["p50"]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append((key, change))
+        elif change < -threshold:
+            flag = "  faster"
+        print("%-24s %9s  %s -> %s  %+.1f%%%s"
+              % (key[0], key[1], _format_time(before), _format_time(after),
+                 change * 100, flag), file=out)
+    return regressions
+
+
+def _format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.2f %s" % (seconds / scale, unit)
+    return "%.0f ns" % (seconds / 1e-9)
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GiB" % size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory benchmark suite.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", help="save the results as JSON")
+    run_parser.add_argument("--filter", action="append", default=[],
+                            help="only run cases whose name contains this")
+    run_parser.add_argument("--sizes", type=int, nargs="+",
+                            default=list(DEFAULT_SIZES))
+    run_parser.add_argument("--duration", type=float, default=0.2,
+                            help="seconds of timing per case and size")
+    run_parser.add_argument("--samples", type=int, default=100)
+    run_parser.add_argument("--no-fork", action="store_true",
+                            help="run in this process (peak RSS is cumulative)")
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        names = [name for name in sorted(BENCHMARKS)
+                 if not args.filter or any(f in name for f in args.filter)]
+        if not names:
+            parser.error("no benchmark matches --filter %s"
+                         % " ".join(args.filter))
+        document = run(names, args.sizes, args.duration, args.samples,
+                       not args.no_fork)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(document, f, indent=1)
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    return 1 if compare(old, new, args.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
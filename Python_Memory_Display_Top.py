@@ -10,10 +10,10 @@
 # Pretty top.
 # Code to display the 10 lines allocating the most memory with a pretty output, ignoring <frozen importlib._bootstrap> and <unknown> files:
  
-import linecache
-import os
 import tracemalloc
 
+from Python_Memory_Frame_Render import format_top, split_top
+
 def display_top(snapshot, key_type='lineno', limit=10):
 
     snapshot = snapshot.filter_traces((
@@ -23,32 +23,9 @@ def display_top(snapshot, key_type='lineno', limit=10):
 
     top_stats = snapshot.statistics(key_type)
 
-    print("Top %s lines" % limit)
-
-    for index, stat in enumerate(top_stats[:limit], 1):
-        frame = stat.traceback[0]
-
-        # replace "/path/to/module/file.py" with "module/file.py"
-
-        filename = os.sep.join(frame.filename.split(os.sep)[-2:])
-
-        print("#%s: %s:%s: %.1f KiB"
-              % (index, filename, frame.lineno, stat.size / 1024))
-
-        line = linecache.getline(frame.filename, frame.lineno).strip()
-
-        if line:
-            print('    %s' % line)
-
-    other = top_stats[limit:]
-
-    if other:
-        size = sum(stat.size for stat in other)
-
-        print("%s other: %.1f KiB" % (len(other), size / 1024))
-    total = sum(stat.size for stat in top_stats)
+    # "Top 10 lines", then "#1: module/file.py:12: 4.2 KiB" with its source line, "N other" and the total
 
-    print("Total allocated size: %.1f KiB" % (total / 1024))
+    print("\n".join(format_top(*split_top(top_stats, limit), limit, key_type)))
 
 tracemalloc.start()
 
@@ -0,0 +1,194 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Compiled filter sets and lazy filtered views.
+#
+# snapshot.filter_traces(filters) copies every trace that passes into a new Snapshot, and matches the filename patterns of every filter
+# against every trace on the way (fnmatch() on the same few hundred filenames, millions of times). Reports per package or per team repeat
+# that copy for each filter combination.
+#
+# > FilterSet(filters) (Python_Memory_Trace_Fold.py) compiles a sequence of Filter and DomainFilter objects once; it can be kept and reused
+#   for every snapshot,
+# > TraceIndex(snapshot) sums the traces per domain and traceback with fold_traces(), in a single pass over the traces. It is built once
+#   per snapshot.
+# > index.view(filters) returns a FilteredView: no trace is copied, the filters are evaluated once per traceback when statistics() groups
+#   the traces, and view.filter(filters) narrows a view further, like calling filter_traces() again.
+# > statistics_many(views) groups several views of the same index together: one pass over the tracebacks, each key computed once, each
+#   view adding the tracebacks it accepts.
+#
+
+import tracemalloc
+
+from Python_Memory_Frame_Render import format_top, split_top
+from Python_Memory_Trace_Fold import FilterSet, compile_filters, fold_traces
+
+
+class TraceIndex:
+    """The traces of a snapshot (the live traces if None), summed per
+    traceback and domain in one pass."""
+
+    def __init__(self, snapshot=None):
+        traces = None if snapshot is None else snapshot.traces._traces
+        # [trace, size, count]
+        self.totals = list(fold_traces(traces).values())
+
+    def view(self, filters=()):
+        return FilteredView(self, (compile_filters(filters),) if filters else ())
+
+
+class FilteredView:
+    """The traces of an index that pass all the filter sets, evaluated
+    when the view is aggregated."""
+
+    def __init__(self, index, filter_sets=()):
+        self.index = index
+        self.filter_sets = tuple(filter_sets)
+
+    def filter(self, filters):
+        """Return a view narrowed by filters, like Snapshot.filter_traces()."""
+
+        if not filters:
+            return self
+        return FilteredView(self.index,
+                            self.filter_sets + (compile_filters(filters),))
+
+    def _accepts(self, domain, frames):
+        for filter_set in self.filter_sets:
+            if not filter_set.match(domain, frames):
+                return False
+        return True
+
+    def totals(self):
+        """Return (size, count) of the traces in the view."""
+
+        size = count = 0
+        for trace, total_size, total_count in self.index.totals:
+            if self._accepts(trace[0], trace[2]):
+                size += total_size
+                count += total_count
+        return size, count
+
+    def statistics(self, key_type='lineno', cumulative=False):
+        """Same result as snapshot.filter_traces(...).statistics()."""
+
+        return statistics_many([self], key_type, cumulative)[0]
+
+
+def statistics_many(views, key_type='lineno', cumulative=False):
+    """Group several views of one TraceIndex in a single pass; return one
+    sorted Statistic list per view."""
+
+    if key_type not in ('traceback', 'filename', 'lineno'):
+        raise ValueError("unknown key_type: %r" % (key_type,))
+    if cumulative and key_type not in ('lineno', 'filename'):
+        raise ValueError("cumulative mode cannot by used "
+                         "with key type %r" % key_type)
+    if not views:
+        return []
+    index = views[0].index
+    for view in views:
+        if view.index is not index:
+            raise ValueError("views must share the same TraceIndex")
+
+    Traceback = tracemalloc.Traceback
+    tracebacks = {}
+    stats = [{} for view in views]
+
+    for trace, size, count in index.totals:
+        domain, frames = trace[0], trace[2]
+        accepted = [view_stats for view, view_stats in zip(views, stats)
+                    if view._accepts(domain, frames)]
+        if not accepted:
+            continue
+
+        # same keys as Snapshot._group_by(); cumulative counts a frame
+        # repeated in one traceback once per occurrence, like it
+        if key_type == 'traceback':
+            sources = (frames,)
+        elif cumulative:
+            sources = frames
+        else:
+            sources = (frames[0],)
+        keys = []
+        for source in sources:
+            try:
+                keys.append(tracebacks[source])
+            except KeyError:
+                if key_type == 'traceback':
+                    key = Traceback(source)
+                elif key_type == 'lineno':
+                    key = Traceback((source,))
+                else:
+                    key = Traceback(((source[0], 0),))
+                tracebacks[source] = key
+                keys.append(key)
+
+        for view_stats in accepted:
+            for key in keys:
+                try:
+                    stat = view_stats[key]
+                    stat[0] += size
+                    stat[1] += count
+                except KeyError:
+                    view_stats[key] = [size, count]
+
+    results = []
+    for view_stats in stats:
+        result = [tracemalloc.Statistic(key, size, count)
+                  for key, (size, count) in view_stats.items()]
+        result.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+        results.append(result)
+    return results
+
+
+def display_top(view, key_type='lineno', limit=10):
+    """display_top() over a FilteredView."""
+
+    top_stats = view.statistics(key_type)
+
+    print("\n".join(format_top(*split_top(top_stats, limit), limit, key_type)))
+
+
+if __name__ == "__main__":
+
+    import json
+
+    # compiled once, reused for every snapshot
+
+    common = FilterSet((
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+    teams = {
+        "json": FilterSet((tracemalloc.Filter(True, json.__file__.replace("__init__.py", "*")),)),
+        "main": FilterSet((tracemalloc.Filter(True, __file__),)),
+    }
+
+    tracemalloc.start()
+
+    # ... run your application ...
+
+    data = [str(i) * 10 for i in range(100000)]
+
+    decoded = [json.loads('{"id": %d}' % i) for i in range(10000)]
+
+    index = TraceIndex(tracemalloc.take_snapshot())
+
+    everything = index.view(common)
+
+    display_top(everything, limit=3)
+
+    # one pass for all the teams
+
+    views = [everything.filter(filter_set) for filter_set in teams.values()]
+
+    for name, top_stats in zip(teams, statistics_many(views, 'filename')):
+        print("%s: %.1f KiB" % (name, sum(stat.size for stat in top_stats) / 1024))
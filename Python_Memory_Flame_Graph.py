@@ -0,0 +1,295 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Memory flame graphs.
+#
+# Python_Memory_Traceback.py prints the traceback of the biggest block only. This module folds every traceback into the collapsed-stack
+# format ("root;caller;...;allocating line weight", one line per distinct stack, as read by flamegraph.pl and speedscope) and renders it as
+# an interactive SVG or HTML flame graph, weighted by bytes ('size') or by memory blocks ('count'):
+# > fold() makes a single pass over the raw traces, summing them per domain and traceback with fold_traces() (Python_Memory_Trace_Fold.py),
+#   and converts each distinct traceback once into a stack of interned frame labels, so millions of traces cost one dictionary update each,
+# > fold_file() does the same over a file written by Python_Memory_Snapshot_Export.py, record by record,
+# > a traceback cut by the tracemalloc frame limit starts with a "[truncated]" frame, so it is not mistaken for a root,
+# > frames are labelled "filename:lineno" with the full filename, so two files with the same name in different packages stay apart; the
+#   SVG shows the labels shortened to "module/file.py:lineno" and the full label in the tooltip,
+# > in the SVG, hovering a frame shows its size and share, clicking it zooms into it and clicking the background zooms out.
+#
+# Use tracemalloc.start(25) to get stacks deep enough to be useful.
+#
+
+import html
+import os
+import sys
+import tempfile
+import tracemalloc
+import zlib
+
+from Python_Memory_Frame_Render import short_filename
+from Python_Memory_Snapshot_Export import SnapshotReader, MAGIC
+from Python_Memory_Trace_Fold import fold_traces
+
+TRUNCATED = "[truncated]"
+
+
+class _Labels(dict):
+    """(filename, lineno) -> interned "filename:lineno" label."""
+
+    def __missing__(self, frame):
+        label = self[frame] = sys.intern("%s:%s" % frame)
+        return label
+
+
+def _short_label(label):
+    # "/path/to/module/file.py:12" -> "module/file.py:12"
+    filename, colon, lineno = label.rpartition(":")
+    if not colon:
+        return label
+    return "%s:%s" % (short_filename(filename), lineno)
+
+
+def _stack(labels, frames, total_nframe):
+    stack = tuple(labels[frame] for frame in reversed(frames))
+    if total_nframe > len(frames):
+        stack = (TRUNCATED,) + stack
+    return stack
+
+
+def fold(traces=None, weight='size'):
+    """Fold raw traces (the live traces if None, else e.g.
+    snapshot.traces._traces) into {stack: weight}, stacks root first."""
+
+    if weight not in ('size', 'count'):
+        raise ValueError("weight must be 'size' or 'count'")
+
+    labels = _Labels()
+    folded = {}
+    index = 1 if weight == 'size' else 2
+    for total in fold_traces(traces).values():
+        trace = total[0]
+        stack = _stack(labels, trace[2], trace[3])
+        folded[stack] = folded.get(stack, 0) + total[index]
+    return folded
+
+
+def fold_snapshot(snapshot, weight='size'):
+    return fold(snapshot.traces._traces, weight)
+
+
+def fold_file(filename, weight='size'):
+    """Fold a file written by Python_Memory_Snapshot_Export.py."""
+
+    if weight not in ('size', 'count'):
+        raise ValueError("weight must be 'size' or 'count'")
+
+    totals = {}
+    with open(filename, "rb") as fp:
+        reader = SnapshotReader(fp)
+        for traceback_id, domain, count, size in reader.iter_records():
+            totals[traceback_id] = (totals.get(traceback_id, 0)
+                                    + (size if weight == 'size' else count))
+
+        labels = _Labels()
+        folded = {}
+        for traceback_id, value in totals.items():
+            total_nframe = reader.tracebacks[traceback_id][0]
+            stack = _stack(labels, reader._traceback_frames(traceback_id),
+                           total_nframe)
+            folded[stack] = folded.get(stack, 0) + value
+    return folded
+
+
+def write_collapsed(folded, fp):
+    for stack, value in sorted(folded.items()):
+        if value:
+            fp.write("%s %s\n" % (";".join(stack), value))
+
+
+# Rendering
+
+FRAME_HEIGHT = 16
+WIDTH = 1200
+MARGIN = 10
+TOP = 40
+
+_SCRIPT = """
+var svg = document.getElementById("flamegraph"), info = document.getElementById("info");
+var frames = svg.querySelectorAll("g.frame"), width = %(width)d, margin = %(margin)d;
+function fit(g, x, w) {
+  var rect = g.querySelector("rect"), text = g.querySelector("text");
+  rect.setAttribute("x", margin + x * width); rect.setAttribute("width", Math.max(w * width - 1, 0));
+  text.setAttribute("x", margin + x * width + 3);
+  var label = g.getAttribute("data-label"), chars = Math.floor((w * width - 6) / 7);
+  text.textContent = chars < 3 ? "" : (label.length <= chars ? label : label.slice(0, chars - 2) + "..");
+}
+function zoom(target) {
+  var l = +target.getAttribute("data-l"), w = +target.getAttribute("data-w"), d = +target.getAttribute("data-d");
+  frames.forEach(function (g) {
+    var gl = +g.getAttribute("data-l"), gw = +g.getAttribute("data-w"), gd = +g.getAttribute("data-d");
+    if (gd < d && gl <= l + 1e-12 && gl + gw >= l + w - 1e-12) { g.style.display = ""; fit(g, 0, 1); g.style.opacity = 0.6; }
+    else if (gd >= d && gl >= l - 1e-12 && gl + gw <= l + w + 1e-12) { g.style.display = ""; g.style.opacity = 1; fit(g, (gl - l) / w, gw / w); }
+    else { g.style.display = "none"; }
+  });
+}
+frames.forEach(function (g) {
+  fit(g, +g.getAttribute("data-l"), +g.getAttribute("data-w"));
+  g.addEventListener("click", function (event) { zoom(g); event.stopPropagation(); });
+  g.addEventListener("mouseover", function () { info.textContent = g.querySelector("title").textContent; });
+  g.addEventListener("mouseout", function () { info.textContent = " "; });
+});
+svg.addEventListener("click", function () {
+  frames.forEach(function (g) { g.style.display = ""; g.style.opacity = 1; fit(g, +g.getAttribute("data-l"), +g.getAttribute("data-w")); });
+});
+"""
+
+
+def _tree(folded):
+    root = [0, {}]
+    for stack, value in folded.items():
+        root[0] += value
+        node = root
+        for label in stack:
+            children = node[1]
+            try:
+                node = children[label]
+            except KeyError:
+                node = children[label] = [0, {}]
+            node[0] += value
+    return root
+
+
+def _color(label):
+    # stable per label, in a green-blue "memory" palette
+    value = zlib.crc32(label.encode("utf-8", "surrogateescape"))
+    return "rgb(%d,%d,%d)" % (40 + value % 60, 150 + (value >> 8) % 80,
+                              120 + (value >> 16) % 100)
+
+
+def _format_value(value, weight):
+    if weight == 'size':
+        return tracemalloc._format_size(value, False)
+    return "%s blocks" % value
+
+
+def flame_graph_svg(folded, weight='size', title="Memory flame graph",
+                    min_width=0.5):
+    """Render folded stacks as an interactive SVG document (a string).
+
+    Frames narrower than min_width pixels are left out."""
+
+    root = _tree(folded)
+    total = root[0] or 1
+    rows = []
+    depth_max = [0]
+
+    def walk(node, label, left, depth):
+        value = node[0]
+        if value * WIDTH / total < min_width:
+            return
+        depth_max[0] = max(depth_max[0], depth)
+        rows.append((label, left / total, value / total, depth, value))
+        offset = left
+        for child_label, child in sorted(node[1].items()):
+            walk(child, child_label, offset, depth + 1)
+            offset += child[0]
+
+    walk(root, "all", 0, 0)
+
+    height = TOP + (depth_max[0] + 1) * FRAME_HEIGHT + 2 * MARGIN
+    out = ['<svg id="flamegraph" version="1.1" width="%d" height="%d" '
+           'xmlns="http://www.w3.org/2000/svg" font-family="monospace" '
+           'font-size="12">' % (WIDTH + 2 * MARGIN, height),
+           '<rect width="100%" height="100%" fill="#f8f8f8"/>',
+           '<text x="%d" y="20" font-size="16">%s (%s, %s)</text>'
+           % (MARGIN, html.escape(title), weight,
+              html.escape(_format_value(root[0], weight))),
+           '<text id="info" x="%d" y="%d"> </text>' % (MARGIN, height - 4)]
+
+    for label, left, width, depth, value in rows:
+        y = height - MARGIN - 16 - (depth + 1) * FRAME_HEIGHT
+        description = "%s: %s, %.2f%%" % (label, _format_value(value, weight),
+                                         width * 100)
+        short = _short_label(label)
+        # laid out here too, so the SVG reads without scripts
+        chars = int((width * WIDTH - 6) / 7)
+        text = ("" if chars < 3 else
+                short if len(short) <= chars else short[:chars - 2] + "..")
+        out.append(
+            '<g class="frame" data-label="%s" data-l="%r" data-w="%r" '
+            'data-d="%d"><title>%s</title>'
+            '<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s" rx="2"/>'
+            '<text x="%.1f" y="%d">%s</text></g>'
+            % (html.escape(short), left, width, depth,
+               html.escape(description), MARGIN + left * WIDTH, y,
+               max(width * WIDTH - 1, 0), FRAME_HEIGHT - 1, _color(label),
+               MARGIN + left * WIDTH + 3, y + FRAME_HEIGHT - 4,
+               html.escape(text)))
+
+    out.append('<script type="text/ecmascript"><![CDATA[%s]]></script>'
+               % (_SCRIPT % {"width": WIDTH, "margin": MARGIN}))
+    out.append('</svg>')
+    return "\n".join(out)
+
+
+def flame_graph_html(folded, weight='size', title="Memory flame graph",
+                     min_width=0.5):
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s'
+            '</title></head><body>\n%s\n</body></html>\n'
+            % (html.escape(title),
+               flame_graph_svg(folded, weight, title, min_width)))
+
+
+def _load(filename, weight):
+    with open(filename, "rb") as fp:
+        magic = fp.read(len(MAGIC))
+    if magic == MAGIC:
+        return fold_file(filename, weight)
+    return fold_snapshot(tracemalloc.Snapshot.load(filename), weight)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        # python Python_Memory_Flame_Graph.py snapshot [size|count] [out.svg|out.html|out.txt]
+        # snapshot: a Snapshot.dump() file or a Python_Memory_Snapshot_Export.py file
+
+        weight = sys.argv[2] if len(sys.argv) > 2 else 'size'
+        output = sys.argv[3] if len(sys.argv) > 3 else None
+        folded = _load(sys.argv[1], weight)
+
+        if output is None:
+            write_collapsed(folded, sys.stdout)
+        else:
+            with open(output, "w", encoding="utf-8") as f:
+                if output.endswith(".svg"):
+                    f.write(flame_graph_svg(folded, weight, title=sys.argv[1]))
+                elif output.endswith((".html", ".htm")):
+                    f.write(flame_graph_html(folded, weight, title=sys.argv[1]))
+                else:
+                    write_collapsed(folded, f)
+        sys.exit(0)
+
+    tracemalloc.start(25)
+
+    # ... run your application ...
+
+    data = [str(i) * 10 for i in range(10000)]
+
+    snapshot = tracemalloc.take_snapshot()
+
+    folded = fold_snapshot(snapshot, 'size')
+
+    path = os.path.join(tempfile.gettempdir(), "memory.svg")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(flame_graph_svg(folded, 'size'))
+
+    print("flame graph written to %s" % path)
+
+    write_collapsed(folded, sys.stdout)
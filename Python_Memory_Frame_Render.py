@@ -0,0 +1,139 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Frame rendering.
+#
+# display_top() calls linecache.getline() and splits frame.filename by os.sep for every row, and Traceback.format() calls linecache.getline()
+# again for every frame. With tracemalloc.start(25) and thousands of rows, a report renders the same few hundred frames over and over.
+#
+# This module is the shared rendering layer used by the report scripts:
+# > short_filename() replaces "/path/to/module/file.py" with an interned "module/file.py",
+# > source_line() returns the stripped source line of (filename, lineno),
+# > format_frame() returns the formatted lines of one frame,
+# each memoised in a bounded LRU cache keyed by (filename, lineno), so memory use stays predictable however large the report is.
+# format_traceback() produces the same lines as Traceback.format(); format_tracebacks() renders a batch of tracebacks at once.
+# format_top() produces the lines display_top() prints, for every report that prints a top: split_top() cuts a sorted list of Statistic
+# instances into its arguments, and reports that compute the top without a full list (Python_Memory_Top_K.py) pass their totals directly.
+#
+
+import functools
+import linecache
+import os
+import sys
+
+CACHE_SIZE = 4096
+
+_TITLES = {'lineno': "lines", 'filename': "files", 'traceback': "tracebacks"}
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def short_filename(filename):
+    """Return the last two path components of filename, interned."""
+
+    return sys.intern(os.sep.join(filename.split(os.sep)[-2:]))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def source_line(filename, lineno):
+    """Return the stripped source line, or an empty string."""
+
+    return linecache.getline(filename, lineno).strip()
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def format_frame(filename, lineno):
+    """Return the lines Traceback.format() produces for one frame."""
+
+    line = source_line(filename, lineno)
+    if line:
+        return ('  File "%s", line %s' % (filename, lineno),
+                '    %s' % line)
+    return ('  File "%s", line %s' % (filename, lineno),)
+
+
+def format_traceback(traceback, limit=None, most_recent_first=False):
+    """Format a tracemalloc.Traceback like Traceback.format()."""
+
+    if limit is not None:
+        if limit > 0:
+            frames = traceback[-limit:]
+        else:
+            frames = traceback[:limit]
+    else:
+        frames = traceback
+
+    if most_recent_first:
+        frames = reversed(frames)
+
+    lines = []
+    for frame in frames:
+        lines.extend(format_frame(frame.filename, frame.lineno))
+    return lines
+
+
+def format_tracebacks(tracebacks, limit=None, most_recent_first=False):
+    """Format a batch of tracebacks; return one list of lines per traceback."""
+
+    return [format_traceback(traceback, limit, most_recent_first)
+            for traceback in tracebacks]
+
+
+def split_top(stats, limit=10):
+    """Split sorted Statistic instances into the (top_stats, other_count,
+    other_size, total) arguments of format_top()."""
+
+    top_stats = stats[:limit]
+    top_size = sum(stat.size for stat in top_stats)
+    total = sum(stat.size for stat in stats)
+    return top_stats, len(stats) - len(top_stats), total - top_size, total
+
+
+def format_top(top_stats, other_count, other_size, total, limit=10,
+               key_type='lineno', details=None):
+    """Return the lines display_top() prints for the limit biggest sites
+    top_stats; details(stat), if given, returns more lines for a site."""
+
+    lines = ["Top %s %s" % (limit, _TITLES[key_type])]
+
+    for index, stat in enumerate(top_stats, 1):
+        # the most recent frame, the only one for lineno and filename keys
+        frame = stat.traceback[-1]
+
+        if key_type == 'filename':
+            lines.append("#%s: %s: %.1f KiB"
+                         % (index, short_filename(frame.filename),
+                            stat.size / 1024))
+        else:
+            lines.append("#%s: %s:%s: %.1f KiB"
+                         % (index, short_filename(frame.filename),
+                            frame.lineno, stat.size / 1024))
+
+            line = source_line(frame.filename, frame.lineno)
+
+            if line:
+                lines.append('    %s' % line)
+
+        if details is not None:
+            lines.extend(details(stat))
+
+    if other_count:
+        lines.append("%s other: %.1f KiB" % (other_count, other_size / 1024))
+
+    lines.append("Total allocated size: %.1f KiB" % (total / 1024))
+    return lines
+
+
+def clear_cache():
+    """Forget cached lines, e.g. after source files changed on disk."""
+
+    short_filename.cache_clear()
+    source_line.cache_clear()
+    format_frame.cache_clear()
+    linecache.clearcache()
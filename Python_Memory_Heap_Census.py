@@ -0,0 +1,308 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Heap census by object type.
+#
+# tracemalloc groups memory by file and line; the interpreter manages ints, strings, tuples and dicts with their own allocation policies,
+# so knowing which types fill a line matters as much as the line. HeapCensus walks the objects tracked by the garbage collector
+# (gc.get_objects()) and the untracked objects they refer to (gc.get_referents(): strings, numbers, untracked tuples and dicts), each object
+# once, and reports:
+# > per type: the number of objects, their shallow size (sys.getsizeof()) and an approximate deep size, where every untracked object is
+#   charged to the first tracked object found referring to it,
+# > the top dominator roots: a referent with a single referrer is dominated by it, so the deep sizes are summed up those single-referrer
+#   chains; the objects at the top of a chain (no tracked referrer, or several) are the roots, ranked by the size they retain. This is
+#   exact for trees and a lower bound when sharing is involved,
+# > per allocation line, when tracemalloc is tracing: the types of the objects allocated there (tracemalloc.get_object_traceback()), so
+#   display_top_types() can print a display_top() report with the types that inflate each line. Take its snapshot before running the
+#   census: the census's own bookkeeping (and the free lists it fills) is not the application's memory.
+#
+# The walk does not stop the world: steps() is a generator that does step objects per iteration, and run(budget) runs it for at most budget
+# seconds, so a service can spread a census over many short pauses. Objects created or released in between may be missed or counted
+# twice; the census is an estimate of a moving heap.
+#
+
+import gc
+import reprlib
+import sys
+import time
+import tracemalloc
+
+from Python_Memory_Frame_Render import format_top, split_top
+
+_MULTI = -1    # referred to by several tracked objects
+
+
+def type_name(cls):
+    module = getattr(cls, "__module__", None)
+    if module in (None, "builtins"):
+        return cls.__qualname__
+    return "%s.%s" % (module, cls.__qualname__)
+
+
+class TypeStats:
+    __slots__ = ("name", "count", "size", "deep_size")
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.size = 0
+        self.deep_size = 0
+
+    def __repr__(self):
+        return ('<TypeStats %s count=%i size=%i deep_size=%i>'
+                % (self.name, self.count, self.size, self.deep_size))
+
+
+class Root:
+    __slots__ = ("type", "address", "retained", "objects", "description")
+
+    def __init__(self, type, address, retained, objects, description=None):
+        self.type = type
+        self.address = address
+        self.retained = retained
+        self.objects = objects
+        self.description = description
+
+    def __str__(self):
+        return ("%s at %#x: retains %s in %i objects%s"
+                % (self.type, self.address,
+                   tracemalloc._format_size(self.retained, False), self.objects,
+                   ": %s" % self.description if self.description else ""))
+
+
+class HeapCensus:
+
+    def __init__(self, step=2000, roots=True, lines=None, top_roots=10):
+        self.step = step
+        self.track_roots = roots
+        self.track_lines = tracemalloc.is_tracing() if lines is None else lines
+        self.top_roots = top_roots
+        self.types = {}
+        self.lines = {}        # {(filename, lineno): {type name: [count, size]}}
+        self.roots = []
+        self.objects = 0
+        self.done = False
+        self._steps = None
+
+    def _account(self, obj, size, deep_size):
+        cls = type(obj)
+        try:
+            stats = self.types[cls]
+        except KeyError:
+            stats = self.types[cls] = TypeStats(type_name(cls))
+        stats.count += 1
+        stats.size += size
+        stats.deep_size += deep_size
+
+        if self.track_lines:
+            traceback = tracemalloc.get_object_traceback(obj)
+            if traceback is not None:
+                # sorted from the oldest frame to the most recent
+                frame = traceback[-1]
+                by_type = self.lines.setdefault((frame.filename, frame.lineno), {})
+                try:
+                    entry = by_type[stats.name]
+                except KeyError:
+                    entry = by_type[stats.name] = [0, 0]
+                entry[0] += 1
+                entry[1] += size
+
+    def steps(self):
+        """Walk the heap; yield after every step objects."""
+
+        getsizeof = sys.getsizeof
+        get_referents = gc.get_referents
+        is_tracked = gc.is_tracked
+        step = self.step
+
+        objects = gc.get_objects()
+        seen = set()           # ids of the untracked objects already counted
+        deep_sizes = {}        # tracked object id -> deep size
+        parents = {}           # tracked object id -> sole referrer id or _MULTI
+        kinds = {}             # tracked object id -> type
+        own = {id(objects), id(seen), id(deep_sizes), id(parents), id(kinds),
+               id(self.__dict__), id(self.types), id(self.lines)}
+
+        for index in range(len(objects)):
+            obj = objects[index]
+            objects[index] = None
+            oid = id(obj)
+            if oid in own:
+                continue
+
+            size = getsizeof(obj)
+            deep_size = size
+            pending = get_referents(obj)
+            while pending:
+                ref = pending.pop()
+                rid = id(ref)
+                if is_tracked(ref):
+                    if self.track_roots and rid != oid:
+                        parent = parents.get(rid)
+                        if parent is None:
+                            parents[rid] = oid
+                        elif parent != oid:
+                            parents[rid] = _MULTI
+                elif rid not in seen:
+                    seen.add(rid)
+                    ref_size = getsizeof(ref)
+                    deep_size += ref_size
+                    self._account(ref, ref_size, ref_size)
+                    self.objects += 1
+                    # untracked containers hold untracked objects only
+                    pending.extend(get_referents(ref))
+
+            self._account(obj, size, deep_size)
+            self.objects += 1
+            if self.track_roots:
+                deep_sizes[oid] = deep_size
+                kinds[oid] = type(obj)
+            if index % step == step - 1:
+                yield
+        del objects, seen
+
+        if self.track_roots:
+            yield from self._dominators(deep_sizes, parents, kinds)
+        self.done = True
+
+    def _dominators(self, deep_sizes, parents, kinds):
+        step = self.step
+
+        children = {}
+        for index, (oid, parent) in enumerate(parents.items()):
+            if parent != _MULTI and parent in deep_sizes and oid in deep_sizes:
+                children.setdefault(parent, []).append(oid)
+            if index % step == step - 1:
+                yield
+
+        roots = []
+        for index, oid in enumerate(deep_sizes):
+            parent = parents.get(oid)
+            if parent is None or parent == _MULTI or parent not in deep_sizes:
+                retained = count = 0
+                stack = [oid]
+                while stack:
+                    node = stack.pop()
+                    retained += deep_sizes[node]
+                    count += 1
+                    stack.extend(children.get(node, ()))
+                roots.append((retained, count, oid))
+            if index % step == step - 1:
+                yield
+        roots.sort(reverse=True)
+
+        self.roots = [Root(type_name(kinds[oid]), oid, retained, count)
+                      for retained, count, oid in roots[:self.top_roots]]
+        yield from self._describe_roots(kinds)
+
+    def _describe_roots(self, kinds):
+        step = self.step
+        wanted = {root.address: root for root in self.roots}
+        if not wanted:
+            return
+        for index, obj in enumerate(gc.get_objects()):
+            if index % step == step - 1:
+                yield
+            root = wanted.get(id(obj))
+            if root is None or type(obj) is not kinds[root.address]:
+                continue
+            if isinstance(obj, dict) and isinstance(obj.get("__name__"), str):
+                root.description = "namespace of %s" % obj["__name__"]
+            else:
+                try:
+                    root.description = reprlib.repr(obj)
+                except Exception:
+                    pass
+
+    def run(self, budget=None):
+        """Run the census for at most budget seconds (to the end if None).
+
+        Return True once the census is complete."""
+
+        if self.done:
+            return True
+        if self._steps is None:
+            self._steps = self.steps()
+        deadline = None if budget is None else time.perf_counter() + budget
+        for _ in self._steps:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+        self._steps = None
+        return True
+
+    def statistics(self, sort='size'):
+        """Return the TypeStats, biggest first by 'size', 'deep_size' or 'count'."""
+
+        return sorted(self.types.values(),
+                      key=lambda stats: getattr(stats, sort), reverse=True)
+
+
+def display_types(census, limit=10, sort='size'):
+    print("Top %s types" % limit)
+    for index, stats in enumerate(census.statistics(sort)[:limit], 1):
+        print("#%s: %s: %i objects, %.1f KiB (deep %.1f KiB)"
+              % (index, stats.name, stats.count, stats.size / 1024,
+                 stats.deep_size / 1024))
+
+
+def display_roots(census):
+    print("Top %s dominator roots" % len(census.roots))
+    for index, root in enumerate(census.roots, 1):
+        print("#%s: %s" % (index, root))
+
+
+def display_top_types(census, snapshot, limit=10, types=3):
+    """display_top() of snapshot by line, with the top types of each line.
+
+    Take the snapshot before running the census, so that the census's own
+    allocations are not in it.
+    """
+
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+    top_stats = snapshot.statistics('lineno')
+
+    def top_types(stat):
+        frame = stat.traceback[0]
+        by_type = census.lines.get((frame.filename, frame.lineno), {})
+        return ["      %s: %i objects, %.1f KiB" % (name, count, size / 1024)
+                for name, (count, size) in sorted(by_type.items(),
+                                                  key=lambda item: item[1][1],
+                                                  reverse=True)[:types]]
+
+    print("\n".join(format_top(*split_top(top_stats, limit), limit,
+                               details=top_types)))
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start()
+
+    # ... run your application ...
+
+    points = [{"x": i, "y": i} for i in range(20000)]   # dicts: a __slots__ class candidate
+
+    # before the census, which allocates too
+    snapshot = tracemalloc.take_snapshot()
+
+    census = HeapCensus()
+
+    # a little work at a time, letting the application run in between
+
+    while not census.run(budget=0.005):
+        time.sleep(0.001)
+
+    display_types(census, limit=5)
+
+    display_roots(census)
+
+    display_top_types(census, snapshot, limit=3)
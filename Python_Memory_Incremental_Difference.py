@@ -0,0 +1,168 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Incremental differences.
+#
+# snapshot2.compare_to(snapshot1, 'lineno') groups both snapshots from scratch: it builds a Traceback and a Statistic object per key for each
+# snapshot, then a StatisticDiff per key, then sorts all of them, so its cost grows with the whole heap.
+#
+# IncrementalDiff keeps a persistent index instead:
+# > the per-traceback totals of the previous snapshot ({raw traceback: (size, count)}),
+# > a cache mapping each raw traceback to its grouping key(s) (filename, lineno or traceback),
+# > the per-key totals ({Traceback: [size, count]}).
+#
+# update() folds the new traces into per-traceback totals in a single pass with fold_traces() (Python_Memory_Trace_Fold.py), compares them
+# with the previous totals, and applies only the deltas of the tracebacks that changed to the per-key index. StatisticDiff objects are
+# built and sorted only for the keys that changed, so after the trace pass the cost is proportional to what changed rather than to the heap
+# size.
+#
+# Unlike compare_to(), update() leaves unchanged keys out of its result; statistics() returns the full current totals.
+#
+
+import tracemalloc
+
+from Python_Memory_Trace_Fold import fold_traces
+
+
+class IncrementalDiff:
+
+    def __init__(self, key_type='lineno', cumulative=False):
+        if key_type not in ('traceback', 'filename', 'lineno'):
+            raise ValueError("unknown key_type: %r" % (key_type,))
+        if cumulative and key_type not in ('lineno', 'filename'):
+            raise ValueError("cumulative mode cannot by used "
+                             "with key type %r" % key_type)
+        self.key_type = key_type
+        self.cumulative = cumulative
+        self._traceback_totals = {}
+        self._keys = {}
+        self._stats = {}
+
+    def _traceback_keys(self, traceback):
+        # same grouping as Snapshot._group_by()
+        try:
+            return self._keys[traceback]
+        except KeyError:
+            pass
+
+        if self.key_type == 'traceback':
+            keys = (tracemalloc.Traceback(traceback),)
+        elif self.cumulative:
+            if self.key_type == 'lineno':
+                keys = tuple(tracemalloc.Traceback((frame,))
+                             for frame in traceback)
+            else:
+                keys = tuple(tracemalloc.Traceback(((frame[0], 0),))
+                             for frame in traceback)
+        elif self.key_type == 'lineno':
+            keys = (tracemalloc.Traceback(traceback[:1]),)
+        else:
+            keys = (tracemalloc.Traceback(((traceback[0][0], 0),)),)
+
+        self._keys[traceback] = keys
+        return keys
+
+    def _fold(self, traces):
+        totals = {}
+        for trace, size, count in fold_traces(traces).values():
+            traceback = trace[2]
+            try:
+                old = totals[traceback]
+                totals[traceback] = (old[0] + size, old[1] + count)
+            except KeyError:
+                totals[traceback] = (size, count)
+        return totals
+
+    def update(self, snapshot=None):
+        """Apply a new snapshot (the live traces if snapshot is None).
+
+        Return StatisticDiff instances for the keys whose size or count
+        changed since the previous update, sorted like compare_to().
+        """
+
+        if snapshot is None:
+            traces = tracemalloc._get_traces()
+        else:
+            traces = snapshot.traces._traces
+        new_totals = self._fold(traces)
+        old_totals = self._traceback_totals
+
+        deltas = {}
+        for traceback, (size, count) in new_totals.items():
+            old_size, old_count = old_totals.get(traceback, (0, 0))
+            if size != old_size or count != old_count:
+                deltas[traceback] = (size - old_size, count - old_count)
+        if len(new_totals) - len(deltas) != len(old_totals):
+            for traceback, (old_size, old_count) in old_totals.items():
+                if traceback not in new_totals:
+                    deltas[traceback] = (-old_size, -old_count)
+        self._traceback_totals = new_totals
+
+        stats = self._stats
+        changed = {}
+        for traceback, (size_diff, count_diff) in deltas.items():
+            for key in self._traceback_keys(traceback):
+                try:
+                    stat = stats[key]
+                except KeyError:
+                    stat = stats[key] = [0, 0]
+                stat[0] += size_diff
+                stat[1] += count_diff
+                try:
+                    diff = changed[key]
+                    diff[0] += size_diff
+                    diff[1] += count_diff
+                except KeyError:
+                    changed[key] = [size_diff, count_diff]
+
+        for traceback in deltas:
+            if traceback not in new_totals:
+                del self._keys[traceback]
+
+        diffs = []
+        for key, (size_diff, count_diff) in changed.items():
+            size, count = stats[key]
+            if not count:
+                del stats[key]
+            if size_diff or count_diff:
+                diffs.append(tracemalloc.StatisticDiff(
+                    key, size, size_diff, count, count_diff))
+        diffs.sort(reverse=True, key=tracemalloc.StatisticDiff._sort_key)
+        return diffs
+
+    def statistics(self):
+        """Return the current totals as sorted Statistic instances."""
+
+        statistics = [tracemalloc.Statistic(key, size, count)
+                      for key, (size, count) in self._stats.items()]
+        statistics.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+        return statistics
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start()
+
+    diff = IncrementalDiff('lineno')
+
+    # ... start your application ...
+
+    diff.update(tracemalloc.take_snapshot())
+
+    # ... call the function leaking memory ...
+
+    leak = [str(i) for i in range(10000)]
+
+    top_stats = diff.update(tracemalloc.take_snapshot())
+
+    print("[ Top 10 differences ]")
+
+    for stat in top_stats[:10]:
+        print(stat)
@@ -0,0 +1,257 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Leak detection over a series of snapshots.
+#
+# Python_Memory_Difference.py compares exactly two snapshots, so a warming cache or a batch that happens to be in flight looks just like a
+# leak. LeakDetector takes a series of snapshots (or of per-site aggregates, see add_statistics()) and fits a growth trend for every
+# allocation site:
+# > slope: the least-squares regression slope of the site's size, in bytes per sample,
+# > r2: how well a straight line fits the series (1.0: perfectly steady growth),
+# > monotonic: the fraction of the site's changes that were increases,
+# > score = slope * r2 * monotonic ranks the suspects; a site needs min_increases increases before it is reported.
+#
+# Snapshots go through IncrementalDiff, which returns only the sites that changed. The regression sums of a site are updated only when it
+# changes: the samples in between, where its size stayed the same, are added in closed form, so adding a snapshot costs O(changed sites)
+# after the trace pass. The first warmup samples only set the baseline. A site whose blocks are all freed is forgotten.
+#
+# Every snapshot is filtered first (filters=DEFAULT_FILTERS): the detector's own trends and IncrementalDiff's index are allocated in this
+# module and in Python_Memory_Incremental_Difference.py, and they grow with the number of sites, so they would rank as suspects; tracemalloc
+# itself is left out too. The filters apply to the most recent frame, so code calling the detector is still traced.
+#
+# print_suspects() prints every top suspect with its traceback, formatted like Traceback.format(); use key_type='traceback' (the default)
+# and tracemalloc.start(25) to get full tracebacks.
+#
+
+import copy
+import sys
+import tracemalloc
+
+from Python_Memory_Frame_Render import format_traceback
+from Python_Memory_Incremental_Difference import IncrementalDiff
+
+# trend fields: first sample, last sample, last size, samples, sums of x, y, x*x, x*y, y*y (x counted from the first sample),
+# increases, decreases
+_START, _LAST, _VALUE, _N, _SX, _SY, _SXX, _SXY, _SYY, _UP, _DOWN = range(11)
+
+DEFAULT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, sys.modules[IncrementalDiff.__module__].__file__),
+)
+
+
+def _sum_range(a, b):
+    return (a + b) * (b - a + 1) // 2
+
+
+def _sum_squares(n):
+    return n * (n + 1) * (2 * n + 1) // 6
+
+
+class Suspect:
+    """A site growing over the series."""
+
+    __slots__ = ("traceback", "size", "count", "slope", "r2", "monotonic",
+                 "increases", "score")
+
+    def __init__(self, traceback, size, count, slope, r2, monotonic,
+                 increases):
+        self.traceback = traceback
+        self.size = size
+        self.count = count
+        self.slope = slope
+        self.r2 = r2
+        self.monotonic = monotonic
+        self.increases = increases
+        self.score = slope * r2 * monotonic
+
+    def __str__(self):
+        return ("%s: size=%s, count=%i, %+.1f B/sample, r2=%.2f, "
+                "monotonic=%.0f%%"
+                % (self.traceback, tracemalloc._format_size(self.size, False),
+                   self.count, self.slope, self.r2, self.monotonic * 100))
+
+    def __repr__(self):
+        return ('<Suspect traceback=%r size=%i slope=%.1f score=%.1f>'
+                % (self.traceback, self.size, self.slope, self.score))
+
+
+class LeakDetector:
+
+    def __init__(self, key_type='traceback', cumulative=False, warmup=1,
+                 min_increases=3, filters=DEFAULT_FILTERS):
+        self._diff = IncrementalDiff(key_type, cumulative)
+        self.filters = filters
+        self.warmup = warmup
+        self.min_increases = min_increases
+        self.samples = 0
+        self._previous = {}    # add_statistics() totals: {Traceback: (size, count)}
+        self._counts = {}
+        self._trends = {}
+
+    def _catch_up(self, trend, sample):
+        # add the samples after trend[_LAST] up to sample, all at trend[_VALUE]
+        first = trend[_LAST] + 1
+        if first > sample:
+            return
+        value = trend[_VALUE]
+        a = first - trend[_START]
+        b = sample - trend[_START]
+        sx = _sum_range(a, b)
+        k = b - a + 1
+        trend[_N] += k
+        trend[_SX] += sx
+        trend[_SY] += k * value
+        trend[_SXX] += _sum_squares(b) - _sum_squares(a - 1)
+        trend[_SXY] += value * sx
+        trend[_SYY] += k * value * value
+        trend[_LAST] = sample
+
+    def _apply(self, changes):
+        sample = self.samples
+        self.samples += 1
+        if sample < self.warmup:
+            return
+        trends = self._trends
+        counts = self._counts
+        start = self.warmup
+
+        for key, size, size_diff, count in changes:
+            if not count:
+                # every block freed: forget the site
+                trends.pop(key, None)
+                counts.pop(key, None)
+                continue
+            counts[key] = count
+            try:
+                trend = trends[key]
+            except KeyError:
+                trend = trends[key] = [start, start - 1, size - size_diff,
+                                       0, 0, 0, 0, 0, 0, 0, 0]
+            self._catch_up(trend, sample - 1)
+            x = sample - trend[_START]
+            trend[_N] += 1
+            trend[_SX] += x
+            trend[_SY] += size
+            trend[_SXX] += x * x
+            trend[_SXY] += x * size
+            trend[_SYY] += size * size
+            if size_diff > 0:
+                trend[_UP] += 1
+            elif size_diff < 0:
+                trend[_DOWN] += 1
+            trend[_VALUE] = size
+            trend[_LAST] = sample
+
+    def add_snapshot(self, snapshot=None):
+        """Add a snapshot (the live traces if snapshot is None)."""
+
+        if self.filters:
+            if snapshot is None:
+                snapshot = tracemalloc.take_snapshot()
+            snapshot = snapshot.filter_traces(self.filters)
+        self._apply((diff.traceback, diff.size, diff.size_diff, diff.count)
+                    for diff in self._diff.update(snapshot))
+
+    def add_statistics(self, statistics):
+        """Add per-site aggregates: Statistic instances, e.g. the list
+        merge_files() returns, or a {Traceback: (size, count)} dict."""
+
+        if isinstance(statistics, dict):
+            totals = {key: (value[0], value[1])
+                      for key, value in statistics.items()}
+        else:
+            totals = {stat.traceback: (stat.size, stat.count)
+                      for stat in statistics}
+        previous = self._previous
+
+        changes = []
+        for key, (size, count) in totals.items():
+            old_size = previous.get(key, (0, 0))[0]
+            if size != old_size:
+                changes.append((key, size, size - old_size, count))
+        for key, (old_size, old_count) in previous.items():
+            if key not in totals and old_size:
+                changes.append((key, 0, -old_size, 0))
+        self._previous = totals
+        self._apply(changes)
+
+    def suspects(self, limit=None):
+        """Return the growing sites as Suspect instances, best score first."""
+
+        last = self.samples - 1
+        suspects = []
+        for key, trend in self._trends.items():
+            if trend[_UP] < self.min_increases:
+                continue
+            self._catch_up(trend, last)
+            n = trend[_N]
+            sx, sy = trend[_SX], trend[_SY]
+            sxx_n = n * trend[_SXX] - sx * sx
+            sxy_n = n * trend[_SXY] - sx * sy
+            syy_n = n * trend[_SYY] - sy * sy
+            if sxx_n <= 0 or syy_n <= 0 or sxy_n <= 0:
+                continue
+            slope = sxy_n / sxx_n
+            r2 = sxy_n * sxy_n / (sxx_n * syy_n)
+            monotonic = trend[_UP] / (trend[_UP] + trend[_DOWN])
+            suspects.append(Suspect(key, trend[_VALUE], self._counts[key],
+                                    slope, r2, monotonic, trend[_UP]))
+        suspects.sort(key=lambda suspect: suspect.score, reverse=True)
+        return suspects[:limit] if limit is not None else suspects
+
+
+def print_suspects(detector, limit=10, file=sys.stdout):
+    suspects = detector.suspects(limit)
+    print("[ Top %s leak suspects over %s samples ]"
+          % (len(suspects), detector.samples), file=file)
+    for index, suspect in enumerate(suspects, 1):
+        print("#%s: %s" % (index, suspect), file=file)
+        for line in format_traceback(suspect.traceback):
+            print(line, file=file)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        # python Python_Memory_Leak_Detector.py snapshot1.pickle snapshot2.pickle ...
+        # (files written by Snapshot.dump(), in time order)
+
+        detector = LeakDetector(warmup=0)
+        for filename in sys.argv[1:]:
+            detector.add_snapshot(tracemalloc.Snapshot.load(filename))
+        print_suspects(detector)
+        sys.exit(0)
+
+    tracemalloc.start(25)
+
+    # the first requests fill the cache: leave them out of the trends
+    detector = LeakDetector(warmup=5)
+
+    # ... start your application ...
+    # (its allocations must come from another module: this one is filtered out with the detector, so the
+    # demo allocates through copy.deepcopy())
+
+    record = {"user": "guido", "tags": ["python", "tracemalloc"] * 10}
+
+    cache = {}
+    leak = []
+
+    for request in range(20):
+
+        # ... handle a request: fill a bounded cache, leak a little ...
+
+        cache[request % 5] = [copy.deepcopy(record["tags"]) for _ in range(50)]
+        leak.append(copy.deepcopy(record))
+
+        detector.add_snapshot()
+
+    print_suspects(detector, limit=3)
@@ -0,0 +1,586 @@
+/********************************************************* CPython Memory Management ***********************************************************************
+
+# It is required to use the same memory API family for a given memory block, so that the risk of mixing different allocators is reduced to a
+# minimum (see Python_Memory_Management_C_Malloc.c). Nothing in the interpreter checks it: a block allocated with PyObject_Malloc() and
+# released with PyMem_Free(), or allocated with PyMem_Malloc() and released with PyMem_RawFree(), is silently handed to the wrong allocator.
+#
+# This extension module, "allocguard", checks it. install() wraps the three allocator domains (PYMEM_DOMAIN_RAW, PYMEM_DOMAIN_MEM,
+# PYMEM_DOMAIN_OBJ) with PyMem_SetAllocator() hooks that forward every call to the previous allocator and:
+#
+# > tag each tracked block with the family that allocated it, in a compact side table: an open-addressing hash keyed by pointer (linear
+#   probing, backward-shift deletion, grown with the wrapped raw allocator so the hooks never re-enter themselves, and with the table lock
+#   released, as that allocator may take the GIL),
+# > on free, look the pointer up; when the family does not match, the block is not handed to the wrong allocator: it is quarantined and
+#   later released by its own family,
+# > on realloc with the wrong family, the call is routed to the family that owns the block and reported.
+#
+# mismatches() returns the reports collected so far, one dict per mismatch with the allocating and releasing functions, the block size and,
+# when tracemalloc is tracing, the traceback where the block was allocated. The traceback is looked up while the block is still quarantined,
+# so call tracemalloc.start(25) before install() for the tracemalloc hooks to sit below ours.
+#
+# install(sample=N) tracks only one allocation in N; frees of untracked blocks cost one lookup in a small table, so the guard can stay on for
+# canary hosts. stats() returns the counters.
+#
+# Frees done with the C library free() do not go through PyMem_SetAllocator() hooks, so the "Fatal" line of the Malloc example (free() of a
+# PyMem_New() block) is caught only once the block is released through a PyMem/PyObject function.
+#
+# Build:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Memory_Management_C_Allocator_Guard.c \
+#       -o allocguard$(python3-config --extension-suffix)
+
+**********************************************************************************************************************************************************/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <sched.h>
+#include <stdatomic.h>
+#include <stdint.h>
+#include <string.h>
+
+#define NDOMAINS 3
+#define QUARANTINE_SIZE 1024
+
+static const char *alloc_names[NDOMAINS] = {
+    "PyMem_RawMalloc", "PyMem_Malloc", "PyObject_Malloc"
+};
+static const char *free_names[NDOMAINS] = {
+    "PyMem_RawFree", "PyMem_Free", "PyObject_Free"
+};
+static const char *realloc_names[NDOMAINS] = {
+    "PyMem_RawRealloc", "PyMem_Realloc", "PyObject_Realloc"
+};
+
+typedef struct {
+    uintptr_t key;          /* 0: empty slot */
+    size_t size;
+    int domain;
+} Entry;
+
+typedef struct {
+    void *ptr;              /* quarantined block, NULL for a realloc report */
+    size_t size;
+    int alloc_domain;
+    int free_domain;
+    int realloc;
+} Report;
+
+static PyMemAllocatorEx original[NDOMAINS];
+static int installed = 0;
+
+static atomic_flag lock = ATOMIC_FLAG_INIT;
+static Entry *table = NULL;
+static size_t capacity = 0;     /* power of two */
+static atomic_size_t count = 0;
+
+static size_t sample_every = 1;
+static atomic_size_t allocations = 0;
+static atomic_size_t sampled = 0;
+static size_t mismatch_count = 0;
+static size_t dropped_reports = 0;
+
+static Report reports[QUARANTINE_SIZE];
+static size_t nreports = 0;
+
+
+static void
+table_lock(void)
+{
+    while (atomic_flag_test_and_set_explicit(&lock, memory_order_acquire))
+        sched_yield();
+}
+
+static void
+table_unlock(void)
+{
+    atomic_flag_clear_explicit(&lock, memory_order_release);
+}
+
+static size_t
+slot_of(uintptr_t key)
+{
+    return (size_t)(((uint64_t)(key >> 4) * 0x9E3779B97F4A7C15ULL) >> 17)
+           & (capacity - 1);
+}
+
+static void *
+raw_malloc(size_t size)
+{
+    return original[PYMEM_DOMAIN_RAW].malloc(original[PYMEM_DOMAIN_RAW].ctx, size);
+}
+
+static void
+raw_free(void *ptr)
+{
+    original[PYMEM_DOMAIN_RAW].free(original[PYMEM_DOMAIN_RAW].ctx, ptr);
+}
+
+/* called with the lock held */
+static void
+table_put(uintptr_t key, size_t size, int domain)
+{
+    size_t i = slot_of(key);
+
+    while (table[i].key != 0 && table[i].key != key)
+        i = (i + 1) & (capacity - 1);
+    if (table[i].key == 0)
+        atomic_fetch_add(&count, 1);
+    table[i].key = key;
+    table[i].size = size;
+    table[i].domain = domain;
+}
+
+/* called with the lock held; moves the entries into grown and returns the
+   old table, to be released once the lock is dropped */
+static Entry *
+table_rehash(Entry *grown, size_t grown_capacity)
+{
+    Entry *old = table;
+    size_t old_capacity = capacity, i;
+
+    memset(grown, 0, grown_capacity * sizeof(Entry));
+    table = grown;
+    capacity = grown_capacity;
+    atomic_store(&count, 0);
+    for (i = 0; i < old_capacity; i++) {
+        if (old[i].key != 0)
+            table_put(old[i].key, old[i].size, old[i].domain);
+    }
+    return old;
+}
+
+/* Track ptr, growing the table to keep the load factor under 1/2; return 1
+   if ptr is tracked.
+
+   The lock is never held across raw_malloc() or raw_free(): the allocator
+   below ours may be tracemalloc's, which calls PyGILState_Ensure(), while the
+   thread holding the GIL may be spinning on the lock in one of our hooks.
+   The table is allocated with the lock released and the size is checked
+   again once it is retaken, as another thread may have grown the table (or
+   uninstall() dropped it) in between. */
+static int
+track(void *ptr, size_t size, int domain)
+{
+    Entry *grown = NULL, *old = NULL;
+    size_t grown_capacity = 0;
+    int tracked = 0;
+
+    table_lock();
+    while (table != NULL && 2 * (atomic_load(&count) + 1) > capacity) {
+        if (grown != NULL && grown_capacity > capacity) {
+            old = table_rehash(grown, grown_capacity);
+            grown = NULL;
+            break;
+        }
+        grown_capacity = capacity * 2;
+        table_unlock();
+        if (grown != NULL)
+            raw_free(grown);
+        grown = raw_malloc(grown_capacity * sizeof(Entry));
+        table_lock();
+        if (grown == NULL)
+            break;
+    }
+    if (table != NULL && 2 * (atomic_load(&count) + 1) <= capacity) {
+        table_put((uintptr_t)ptr, size, domain);
+        tracked = 1;
+    }
+    table_unlock();
+
+    if (grown != NULL)
+        raw_free(grown);
+    if (old != NULL)
+        raw_free(old);
+    return tracked;
+}
+
+/* Remove ptr from the table; return 1 and fill *entry if it was tracked. */
+static int
+untrack(void *ptr, Entry *entry)
+{
+    uintptr_t key = (uintptr_t)ptr;
+    size_t i, j, k;
+    int found = 0;
+
+    if (atomic_load_explicit(&count, memory_order_relaxed) == 0)
+        return 0;
+
+    table_lock();
+    if (table == NULL)
+        goto done;
+    i = slot_of(key);
+    while (table[i].key != 0 && table[i].key != key)
+        i = (i + 1) & (capacity - 1);
+    if (table[i].key == 0)
+        goto done;
+
+    *entry = table[i];
+    found = 1;
+    atomic_fetch_sub(&count, 1);
+
+    /* backward-shift deletion */
+    j = i;
+    for (;;) {
+        table[i].key = 0;
+        for (;;) {
+            j = (j + 1) & (capacity - 1);
+            if (table[j].key == 0)
+                goto done;
+            k = slot_of(table[j].key);
+            /* move table[j] into the hole unless its home slot lies
+               cyclically in (i, j] */
+            if (i <= j ? (i < k && k <= j) : (i < k || k <= j))
+                continue;
+            break;
+        }
+        table[i] = table[j];
+        i = j;
+    }
+
+done:
+    table_unlock();
+    return found;
+}
+
+static int
+should_sample(void)
+{
+    size_t n = atomic_fetch_add_explicit(&allocations, 1, memory_order_relaxed);
+
+    if (sample_every > 1 && n % sample_every)
+        return 0;
+    atomic_fetch_add_explicit(&sampled, 1, memory_order_relaxed);
+    return 1;
+}
+
+/* Record a mismatch; return 1 if the block was quarantined. */
+static int
+report(void *ptr, size_t size, int alloc_domain, int free_domain, int realloc)
+{
+    int kept = 0;
+
+    table_lock();
+    mismatch_count++;
+    if (nreports < QUARANTINE_SIZE) {
+        Report *r = &reports[nreports++];
+        r->ptr = ptr;
+        r->size = size;
+        r->alloc_domain = alloc_domain;
+        r->free_domain = free_domain;
+        r->realloc = realloc;
+        kept = (ptr != NULL);
+    }
+    else {
+        dropped_reports++;
+    }
+    table_unlock();
+    return kept;
+}
+
+
+/* Hooks; ctx is the domain number. */
+
+static void *
+hook_malloc(void *ctx, size_t size)
+{
+    int domain = (int)(intptr_t)ctx;
+    void *ptr = original[domain].malloc(original[domain].ctx, size);
+
+    if (ptr != NULL && should_sample())
+        track(ptr, size, domain);
+    return ptr;
+}
+
+static void *
+hook_calloc(void *ctx, size_t nelem, size_t elsize)
+{
+    int domain = (int)(intptr_t)ctx;
+    void *ptr = original[domain].calloc(original[domain].ctx, nelem, elsize);
+
+    if (ptr != NULL && should_sample())
+        track(ptr, nelem * elsize, domain);
+    return ptr;
+}
+
+static void *
+hook_realloc(void *ctx, void *ptr, size_t new_size)
+{
+    int domain = (int)(intptr_t)ctx;
+    int owner = domain;
+    Entry entry;
+    void *result;
+    int tracked;
+
+    if (ptr == NULL)
+        return hook_malloc(ctx, new_size);
+
+    tracked = untrack(ptr, &entry);
+    if (tracked && entry.domain != domain) {
+        owner = entry.domain;
+        report(NULL, entry.size, entry.domain, domain, 1);
+    }
+    result = original[owner].realloc(original[owner].ctx, ptr, new_size);
+    if (result == NULL) {
+        if (tracked)
+            track(ptr, entry.size, entry.domain);
+    }
+    else if (tracked) {
+        track(result, new_size, owner);
+    }
+    return result;
+}
+
+static void
+hook_free(void *ctx, void *ptr)
+{
+    int domain = (int)(intptr_t)ctx;
+    Entry entry;
+
+    if (ptr != NULL && untrack(ptr, &entry) && entry.domain != domain) {
+        if (report(ptr, entry.size, entry.domain, domain, 0))
+            return;
+        /* quarantine full: release it through its own family now */
+        original[entry.domain].free(original[entry.domain].ctx, ptr);
+        return;
+    }
+    original[domain].free(original[domain].ctx, ptr);
+}
+
+
+/* Module functions */
+
+static PyObject *
+allocguard_install(PyObject *module, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"sample", "capacity", NULL};
+    Py_ssize_t sample = 1, initial = 1 << 12;
+    PyMemAllocatorEx hook;
+    int domain;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|nn:install", kwlist,
+                                     &sample, &initial))
+        return NULL;
+    if (installed) {
+        PyErr_SetString(PyExc_RuntimeError, "allocguard is already installed");
+        return NULL;
+    }
+    if (sample < 1) {
+        PyErr_SetString(PyExc_ValueError, "sample must be >= 1");
+        return NULL;
+    }
+
+    capacity = 16;
+    while ((Py_ssize_t)capacity < initial)
+        capacity *= 2;
+    table = PyMem_RawCalloc(capacity, sizeof(Entry));
+    if (table == NULL)
+        return PyErr_NoMemory();
+
+    sample_every = (size_t)sample;
+    atomic_store(&count, 0);
+    atomic_store(&allocations, 0);
+    atomic_store(&sampled, 0);
+
+    for (domain = 0; domain < NDOMAINS; domain++)
+        PyMem_GetAllocator((PyMemAllocatorDomain)domain, &original[domain]);
+    for (domain = 0; domain < NDOMAINS; domain++) {
+        hook.ctx = (void *)(intptr_t)domain;
+        hook.malloc = hook_malloc;
+        hook.calloc = hook_calloc;
+        hook.realloc = hook_realloc;
+        hook.free = hook_free;
+        PyMem_SetAllocator((PyMemAllocatorDomain)domain, &hook);
+    }
+    installed = 1;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+build_reports(void)
+{
+    PyObject *result = PyList_New(0);
+    Report pending[QUARANTINE_SIZE];
+    size_t n, i;
+
+    if (result == NULL)
+        return NULL;
+
+    table_lock();
+    n = nreports;
+    memcpy(pending, reports, n * sizeof(Report));
+    nreports = 0;
+    table_unlock();
+
+    for (i = 0; i < n; i++) {
+        Report *r = &pending[i];
+        PyObject *traceback = NULL, *item;
+
+        if (r->ptr != NULL)
+            traceback = _PyTraceMalloc_GetTraceback(0, (uintptr_t)r->ptr);
+        if (traceback == NULL) {
+            PyErr_Clear();
+            traceback = Py_NewRef(Py_None);
+        }
+        item = Py_BuildValue("{s:s,s:s,s:n,s:N}",
+                             "allocated", alloc_names[r->alloc_domain],
+                             "freed", (r->realloc ? realloc_names
+                                                  : free_names)[r->free_domain],
+                             "size", (Py_ssize_t)r->size,
+                             "traceback", traceback);
+
+        /* the traceback is known now: release the block through the
+           family that allocated it */
+        if (r->ptr != NULL)
+            original[r->alloc_domain].free(original[r->alloc_domain].ctx, r->ptr);
+
+        if (item == NULL || PyList_Append(result, item) < 0) {
+            Py_XDECREF(item);
+            for (i++; i < n; i++) {
+                if (pending[i].ptr != NULL)
+                    original[pending[i].alloc_domain].free(
+                        original[pending[i].alloc_domain].ctx, pending[i].ptr);
+            }
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(item);
+    }
+    return result;
+}
+
+static PyObject *
+allocguard_mismatches(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    return build_reports();
+}
+
+static PyObject *
+allocguard_uninstall(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    PyObject *result;
+    Entry *old;
+    int domain;
+
+    if (!installed) {
+        PyErr_SetString(PyExc_RuntimeError, "allocguard is not installed");
+        return NULL;
+    }
+    result = build_reports();
+
+    for (domain = 0; domain < NDOMAINS; domain++)
+        PyMem_SetAllocator((PyMemAllocatorDomain)domain, &original[domain]);
+    installed = 0;
+
+    table_lock();
+    old = table;
+    table = NULL;
+    capacity = 0;
+    atomic_store(&count, 0);
+    table_unlock();
+    PyMem_RawFree(old);
+    return result;
+}
+
+static PyObject *
+allocguard_stats(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    return Py_BuildValue("{s:O,s:n,s:n,s:n,s:n,s:n,s:n,s:n}",
+                         "installed", installed ? Py_True : Py_False,
+                         "sample", (Py_ssize_t)sample_every,
+                         "allocations", (Py_ssize_t)atomic_load(&allocations),
+                         "sampled", (Py_ssize_t)atomic_load(&sampled),
+                         "tracked", (Py_ssize_t)atomic_load(&count),
+                         "capacity", (Py_ssize_t)capacity,
+                         "mismatches", (Py_ssize_t)mismatch_count,
+                         "dropped_reports", (Py_ssize_t)dropped_reports);
+}
+
+static int
+domain_from_name(const char *name)
+{
+    if (strcmp(name, "raw") == 0)
+        return PYMEM_DOMAIN_RAW;
+    if (strcmp(name, "mem") == 0)
+        return PYMEM_DOMAIN_MEM;
+    if (strcmp(name, "obj") == 0)
+        return PYMEM_DOMAIN_OBJ;
+    PyErr_Format(PyExc_ValueError,
+                 "unknown family %s, expected 'raw', 'mem' or 'obj'", name);
+    return -1;
+}
+
+static PyObject *
+allocguard_mix(PyObject *module, PyObject *args)
+{
+    const char *alloc_name, *free_name;
+    Py_ssize_t size = BUFSIZ;
+    int alloc_domain, free_domain;
+    void *buf;
+
+    if (!PyArg_ParseTuple(args, "ss|n:mix", &alloc_name, &free_name, &size))
+        return NULL;
+    if ((alloc_domain = domain_from_name(alloc_name)) < 0
+        || (free_domain = domain_from_name(free_name)) < 0)
+        return NULL;
+    if (!installed) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "mix() would corrupt the heap without allocguard installed");
+        return NULL;
+    }
+
+    buf = alloc_domain == PYMEM_DOMAIN_RAW ? PyMem_RawMalloc(size)
+          : alloc_domain == PYMEM_DOMAIN_MEM ? PyMem_Malloc(size)
+          : PyObject_Malloc(size);
+    if (buf == NULL)
+        return PyErr_NoMemory();
+
+    /* with install(sample=N) the hook may have skipped this block, and an
+       untracked block would reach the wrong allocator: track it here */
+    if (!track(buf, (size_t)size, alloc_domain)) {
+        if (alloc_domain == PYMEM_DOMAIN_RAW)
+            PyMem_RawFree(buf);
+        else if (alloc_domain == PYMEM_DOMAIN_MEM)
+            PyMem_Free(buf);
+        else
+            PyObject_Free(buf);
+        return PyErr_NoMemory();
+    }
+
+    if (free_domain == PYMEM_DOMAIN_RAW)
+        PyMem_RawFree(buf);
+    else if (free_domain == PYMEM_DOMAIN_MEM)
+        PyMem_Free(buf);
+    else
+        PyObject_Free(buf);
+    Py_RETURN_NONE;
+}
+
+
+static PyMethodDef allocguard_methods[] = {
+    {"install", (PyCFunction)(void (*)(void))allocguard_install,
+     METH_VARARGS | METH_KEYWORDS,
+     "install(sample=1, capacity=4096)\n\nWrap the allocators; track one allocation in sample."},
+    {"uninstall", allocguard_uninstall, METH_NOARGS,
+     "Restore the previous allocators; return the pending mismatch reports."},
+    {"mismatches", allocguard_mismatches, METH_NOARGS,
+     "Return and clear the mismatch reports; release quarantined blocks."},
+    {"stats", allocguard_stats, METH_NOARGS,
+     "Return the guard counters."},
+    {"mix", allocguard_mix, METH_VARARGS,
+     "mix(alloc, free, size=BUFSIZ)\n\nAllocate with one family ('raw', 'mem', 'obj') and free with another."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef allocguard_module = {
+    PyModuleDef_HEAD_INIT,
+    "allocguard",
+    "Detect blocks released with a different memory API family than the one that allocated them.",
+    -1,
+    allocguard_methods,
+};
+
+PyMODINIT_FUNC
+PyInit_allocguard(void)
+{
+    return PyModule_Create(&allocguard_module);
+}
@@ -0,0 +1,41 @@
+# Python Memory Management
+# It is required to use the same memory API family for a given memory block, so that the risk of mixing different allocators is reduced to a
+# minimum. The Malloc example shows a block allocated with PyMem_New() and released with free(): nothing in the interpreter catches it.
+#
+# Python_Memory_Management_C_Allocator_Guard.c builds the "allocguard" extension module. It installs PyMem_SetAllocator() hooks that tag
+# every tracked block with the family that allocated it, in an open-addressing hash keyed by pointer, and reports blocks released through
+# another family together with the traceback where they were allocated. install(sample=N) tracks only one allocation in N.
+#
+# Build it next to this file with:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Memory_Management_C_Allocator_Guard.c \
+#       -o allocguard$(python3-config --extension-suffix)
+#
+# Example:
+#
+
+import tracemalloc
+
+import allocguard
+
+# start tracemalloc first, so the allocating traceback is still known when a mismatch is reported
+
+tracemalloc.start(25)
+
+allocguard.install()
+
+# ... run your application ...
+
+allocguard.mix("mem", "obj")   # PyMem_Malloc() block released with PyObject_Free()
+
+for mismatch in allocguard.mismatches():
+
+    print("%s block of %s bytes released with %s"
+          % (mismatch["allocated"], mismatch["size"], mismatch["freed"]))
+
+    for filename, lineno in mismatch["traceback"] or ():
+        print('  File "%s", line %s' % (filename, lineno))
+
+print(allocguard.stats())
+
+allocguard.uninstall()
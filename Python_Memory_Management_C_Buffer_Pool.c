@@ -0,0 +1,475 @@
+/********************************************************* CPython Memory Management ***********************************************************************
+
+# The I/O examples (Python_Memory_Management_C_IO_Buffer.c, Python_Memory_Management_C_Type_Oriented_Function_Set.c) allocate a fresh BUFSIZ
+# buffer with PyMem_Malloc()/PyMem_New() on every call, copy it into a new bytes object with PyBytes_FromString() and free it again.
+# Under high request rates that allocate/copy/free churn shows up in profiles.
+#
+# This extension module, "bufferpool", keeps the buffers instead:
+#
+# > BufferPool(size_classes=(4096, 16384, 65536, 262144), max_free=64) keeps one free list per size class. Blocks are still allocated from
+#   the Python heap with PyMem_Malloc() and released with PyMem_Free(), so the memory API family stays consistent.
+# > pool.acquire(size) returns a PooledBuffer of exactly size bytes backed by a block of the smallest class that fits; a block from the free
+#   list is a hit, a new allocation a miss. Sizes above the largest class are allocated and freed directly.
+# > PooledBuffer exports the writable buffer protocol, so it can be passed to readinto()/recv_into() and sliced with memoryview() without
+#   copying. release() (or leaving a with block, or dropping the last reference) puts the block back on its free list; it raises
+#   BufferError while memoryviews of the buffer are still alive.
+# > pool.stats() returns per-class hits, misses, blocks in use, high-water mark of blocks in use and free blocks.
+#
+# The free lists are protected by a PyThread lock, so a pool can be shared by threads.
+#
+# Build:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Memory_Management_C_Buffer_Pool.c \
+#       -o bufferpool$(python3-config --extension-suffix)
+
+**********************************************************************************************************************************************************/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include "pythread.h"
+#include <string.h>
+
+#define MAX_CLASSES 32
+
+typedef struct {
+    Py_ssize_t size;
+    Py_ssize_t nfree;
+    char **free;            /* max_free entries, allocated with PyMem_New */
+    Py_ssize_t hits;
+    Py_ssize_t misses;
+    Py_ssize_t in_use;
+    Py_ssize_t high_water;
+} SizeClass;
+
+typedef struct {
+    PyObject_HEAD
+    PyThread_type_lock lock;
+    Py_ssize_t max_free;
+    int nclasses;
+    SizeClass classes[MAX_CLASSES];
+    SizeClass oversize;     /* counters only, never pooled */
+} PoolObject;
+
+typedef struct {
+    PyObject_HEAD
+    PoolObject *pool;
+    char *data;             /* NULL once released */
+    Py_ssize_t len;
+    int cls;                /* index in pool->classes, -1 for oversize */
+    Py_ssize_t exports;
+} PooledBufferObject;
+
+static PyTypeObject Pool_Type;
+static PyTypeObject PooledBuffer_Type;
+
+
+/* PooledBuffer */
+
+static void
+return_block(PooledBufferObject *self)
+{
+    PoolObject *pool = self->pool;
+    SizeClass *sc;
+    char *data = self->data;
+
+    self->data = NULL;
+    sc = self->cls >= 0 ? &pool->classes[self->cls] : &pool->oversize;
+
+    PyThread_acquire_lock(pool->lock, WAIT_LOCK);
+    sc->in_use--;
+    if (self->cls >= 0 && sc->nfree < pool->max_free) {
+        sc->free[sc->nfree++] = data;
+        data = NULL;
+    }
+    PyThread_release_lock(pool->lock);
+
+    if (data != NULL)
+        PyMem_Free(data);
+}
+
+static PyObject *
+PooledBuffer_release(PooledBufferObject *self, PyObject *Py_UNUSED(ignored))
+{
+    if (self->exports > 0) {
+        PyErr_SetString(PyExc_BufferError,
+                        "cannot release a buffer with active exports");
+        return NULL;
+    }
+    if (self->data != NULL)
+        return_block(self);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+PooledBuffer_enter(PooledBufferObject *self, PyObject *Py_UNUSED(ignored))
+{
+    Py_INCREF(self);
+    return (PyObject *)self;
+}
+
+static PyObject *
+PooledBuffer_exit(PooledBufferObject *self, PyObject *args)
+{
+    return PooledBuffer_release(self, NULL);
+}
+
+static void
+PooledBuffer_dealloc(PooledBufferObject *self)
+{
+    if (self->data != NULL)
+        return_block(self);
+    Py_XDECREF(self->pool);
+    PyObject_Free(self);
+}
+
+static int
+PooledBuffer_getbuffer(PooledBufferObject *self, Py_buffer *view, int flags)
+{
+    if (self->data == NULL) {
+        PyErr_SetString(PyExc_ValueError, "operation on a released buffer");
+        return -1;
+    }
+    if (PyBuffer_FillInfo(view, (PyObject *)self, self->data, self->len,
+                          0, flags) < 0)
+        return -1;
+    self->exports++;
+    return 0;
+}
+
+static void
+PooledBuffer_releasebuffer(PooledBufferObject *self, Py_buffer *view)
+{
+    self->exports--;
+}
+
+static Py_ssize_t
+PooledBuffer_length(PooledBufferObject *self)
+{
+    return self->data != NULL ? self->len : 0;
+}
+
+static PyObject *
+PooledBuffer_get_capacity(PooledBufferObject *self, void *closure)
+{
+    if (self->cls < 0)
+        return PyLong_FromSsize_t(self->len);
+    return PyLong_FromSsize_t(self->pool->classes[self->cls].size);
+}
+
+static PyObject *
+PooledBuffer_get_released(PooledBufferObject *self, void *closure)
+{
+    return PyBool_FromLong(self->data == NULL);
+}
+
+static PyMethodDef PooledBuffer_methods[] = {
+    {"release", (PyCFunction)PooledBuffer_release, METH_NOARGS,
+     "Return the block to its pool."},
+    {"__enter__", (PyCFunction)PooledBuffer_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction)PooledBuffer_exit, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef PooledBuffer_getset[] = {
+    {"capacity", (getter)PooledBuffer_get_capacity, NULL,
+     "size of the underlying block", NULL},
+    {"released", (getter)PooledBuffer_get_released, NULL,
+     "True once the block went back to the pool", NULL},
+    {NULL}
+};
+
+static PyBufferProcs PooledBuffer_as_buffer = {
+    (getbufferproc)PooledBuffer_getbuffer,
+    (releasebufferproc)PooledBuffer_releasebuffer,
+};
+
+static PySequenceMethods PooledBuffer_as_sequence = {
+    .sq_length = (lenfunc)PooledBuffer_length,
+};
+
+static PyTypeObject PooledBuffer_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "bufferpool.PooledBuffer",
+    .tp_basicsize = sizeof(PooledBufferObject),
+    .tp_dealloc = (destructor)PooledBuffer_dealloc,
+    .tp_as_sequence = &PooledBuffer_as_sequence,
+    .tp_as_buffer = &PooledBuffer_as_buffer,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "Writable buffer borrowed from a BufferPool.",
+    .tp_methods = PooledBuffer_methods,
+    .tp_getset = PooledBuffer_getset,
+};
+
+
+/* BufferPool */
+
+static PyObject *
+Pool_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"size_classes", "max_free", NULL};
+    PyObject *size_classes = NULL, *seq;
+    Py_ssize_t max_free = 64, i;
+    PoolObject *self;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|On:BufferPool", kwlist,
+                                     &size_classes, &max_free))
+        return NULL;
+    if (max_free < 0) {
+        PyErr_SetString(PyExc_ValueError, "max_free must be >= 0");
+        return NULL;
+    }
+
+    if (size_classes == NULL)
+        seq = Py_BuildValue("(nnnn)", (Py_ssize_t)4096, (Py_ssize_t)16384,
+                            (Py_ssize_t)65536, (Py_ssize_t)262144);
+    else
+        seq = PySequence_Fast(size_classes, "size_classes must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    if (PySequence_Fast_GET_SIZE(seq) < 1
+        || PySequence_Fast_GET_SIZE(seq) > MAX_CLASSES) {
+        PyErr_Format(PyExc_ValueError,
+                     "between 1 and %d size classes are supported", MAX_CLASSES);
+        Py_DECREF(seq);
+        return NULL;
+    }
+
+    self = (PoolObject *)type->tp_alloc(type, 0);
+    if (self == NULL) {
+        Py_DECREF(seq);
+        return NULL;
+    }
+    self->max_free = max_free;
+    self->nclasses = (int)PySequence_Fast_GET_SIZE(seq);
+
+    for (i = 0; i < self->nclasses; i++) {
+        Py_ssize_t size = PyNumber_AsSsize_t(PySequence_Fast_GET_ITEM(seq, i),
+                                             PyExc_OverflowError);
+        if (size == -1 && PyErr_Occurred())
+            goto error;
+        if (size <= 0 || (i > 0 && size <= self->classes[i - 1].size)) {
+            PyErr_SetString(PyExc_ValueError,
+                            "size_classes must be positive and increasing");
+            goto error;
+        }
+        self->classes[i].size = size;
+        self->classes[i].free = PyMem_New(char *, max_free + 1);
+        if (self->classes[i].free == NULL) {
+            PyErr_NoMemory();
+            goto error;
+        }
+    }
+
+    self->lock = PyThread_allocate_lock();
+    if (self->lock == NULL) {
+        PyErr_SetString(PyExc_MemoryError, "cannot allocate lock");
+        goto error;
+    }
+    Py_DECREF(seq);
+    return (PyObject *)self;
+
+error:
+    Py_DECREF(seq);
+    Py_DECREF(self);
+    return NULL;
+}
+
+static void
+Pool_dealloc(PoolObject *self)
+{
+    int i;
+    Py_ssize_t j;
+
+    for (i = 0; i < self->nclasses; i++) {
+        SizeClass *sc = &self->classes[i];
+        if (sc->free == NULL)
+            continue;
+        for (j = 0; j < sc->nfree; j++)
+            PyMem_Free(sc->free[j]);
+        PyMem_Del(sc->free);
+    }
+    if (self->lock != NULL)
+        PyThread_free_lock(self->lock);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+Pool_acquire(PoolObject *self, PyObject *arg)
+{
+    Py_ssize_t size = PyNumber_AsSsize_t(arg, PyExc_OverflowError);
+    PooledBufferObject *buffer;
+    SizeClass *sc = NULL;
+    char *data = NULL;
+    int cls;
+
+    if (size == -1 && PyErr_Occurred())
+        return NULL;
+    if (size < 0) {
+        PyErr_SetString(PyExc_ValueError, "size must be >= 0");
+        return NULL;
+    }
+
+    for (cls = 0; cls < self->nclasses; cls++) {
+        if (size <= self->classes[cls].size) {
+            sc = &self->classes[cls];
+            break;
+        }
+    }
+    if (sc == NULL) {
+        cls = -1;
+        sc = &self->oversize;
+    }
+
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    if (cls >= 0 && sc->nfree > 0) {
+        data = sc->free[--sc->nfree];
+        sc->hits++;
+    }
+    else {
+        sc->misses++;
+    }
+    if (++sc->in_use > sc->high_water)
+        sc->high_water = sc->in_use;
+    PyThread_release_lock(self->lock);
+
+    if (data == NULL) {
+        data = (char *)PyMem_Malloc(cls >= 0 ? sc->size : (size ? size : 1));
+        if (data == NULL) {
+            PyThread_acquire_lock(self->lock, WAIT_LOCK);
+            sc->in_use--;
+            PyThread_release_lock(self->lock);
+            return PyErr_NoMemory();
+        }
+    }
+
+    buffer = PyObject_New(PooledBufferObject, &PooledBuffer_Type);
+    if (buffer == NULL) {
+        PyThread_acquire_lock(self->lock, WAIT_LOCK);
+        sc->in_use--;
+        PyThread_release_lock(self->lock);
+        PyMem_Free(data);
+        return NULL;
+    }
+    Py_INCREF(self);
+    buffer->pool = self;
+    buffer->data = data;
+    buffer->len = size;
+    buffer->cls = cls;
+    buffer->exports = 0;
+    return (PyObject *)buffer;
+}
+
+static PyObject *
+Pool_stats(PoolObject *self, PyObject *Py_UNUSED(ignored))
+{
+    SizeClass counters[MAX_CLASSES + 1];
+    PyObject *result, *key, *item;
+    int i;
+
+    /* copy the counters under the lock, build the dict without it */
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    memcpy(counters, self->classes, self->nclasses * sizeof(SizeClass));
+    counters[self->nclasses] = self->oversize;
+    PyThread_release_lock(self->lock);
+
+    result = PyDict_New();
+    if (result == NULL)
+        return NULL;
+
+    for (i = 0; i <= self->nclasses; i++) {
+        SizeClass *sc = &counters[i];
+
+        key = i < self->nclasses ? PyLong_FromSsize_t(sc->size)
+                                 : PyUnicode_FromString("oversize");
+        item = Py_BuildValue("{s:n,s:n,s:n,s:n,s:n}",
+                             "hits", sc->hits,
+                             "misses", sc->misses,
+                             "in_use", sc->in_use,
+                             "high_water", sc->high_water,
+                             "free", sc->nfree);
+        if (key == NULL || item == NULL || PyDict_SetItem(result, key, item) < 0) {
+            Py_XDECREF(key);
+            Py_XDECREF(item);
+            Py_DECREF(result);
+            return NULL;
+        }
+        Py_DECREF(key);
+        Py_DECREF(item);
+    }
+    return result;
+}
+
+static PyObject *
+Pool_trim(PoolObject *self, PyObject *Py_UNUSED(ignored))
+{
+    Py_ssize_t freed = 0, j;
+    int i;
+
+    PyThread_acquire_lock(self->lock, WAIT_LOCK);
+    for (i = 0; i < self->nclasses; i++) {
+        SizeClass *sc = &self->classes[i];
+        for (j = 0; j < sc->nfree; j++) {
+            PyMem_Free(sc->free[j]);
+            freed += sc->size;
+        }
+        sc->nfree = 0;
+    }
+    PyThread_release_lock(self->lock);
+    return PyLong_FromSsize_t(freed);
+}
+
+static PyMethodDef Pool_methods[] = {
+    {"acquire", (PyCFunction)Pool_acquire, METH_O,
+     "acquire(size)\n\nBorrow a writable buffer of size bytes."},
+    {"stats", (PyCFunction)Pool_stats, METH_NOARGS,
+     "Return per size class hit/miss/in-use/high-water/free counters."},
+    {"trim", (PyCFunction)Pool_trim, METH_NOARGS,
+     "Free every pooled block; return the number of bytes freed."},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject Pool_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "bufferpool.BufferPool",
+    .tp_basicsize = sizeof(PoolObject),
+    .tp_dealloc = (destructor)Pool_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "BufferPool(size_classes=(4096, 16384, 65536, 262144), max_free=64)\n\n"
+              "Size-classed pool of reusable I/O buffers.",
+    .tp_methods = Pool_methods,
+    .tp_new = Pool_new,
+};
+
+
+static struct PyModuleDef bufferpool_module = {
+    PyModuleDef_HEAD_INIT,
+    "bufferpool",
+    "Pool of reusable, size-classed I/O buffers exporting the buffer protocol.",
+    -1,
+    NULL,
+};
+
+PyMODINIT_FUNC
+PyInit_bufferpool(void)
+{
+    PyObject *module;
+
+    if (PyType_Ready(&Pool_Type) < 0 || PyType_Ready(&PooledBuffer_Type) < 0)
+        return NULL;
+    module = PyModule_Create(&bufferpool_module);
+    if (module == NULL)
+        return NULL;
+    Py_INCREF(&Pool_Type);
+    if (PyModule_AddObject(module, "BufferPool", (PyObject *)&Pool_Type) < 0) {
+        Py_DECREF(&Pool_Type);
+        Py_DECREF(module);
+        return NULL;
+    }
+    Py_INCREF(&PooledBuffer_Type);
+    if (PyModule_AddObject(module, "PooledBuffer", (PyObject *)&PooledBuffer_Type) < 0) {
+        Py_DECREF(&PooledBuffer_Type);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
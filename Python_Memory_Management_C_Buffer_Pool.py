@@ -0,0 +1,41 @@
+# Python Memory Management
+# The I/O examples allocate a fresh BUFSIZ buffer with PyMem_Malloc() or PyMem_New() for every I/O call, copy it into a new bytes object
+# with PyBytes_FromString() and free it again.
+#
+# Python_Memory_Management_C_Buffer_Pool.c builds the "bufferpool" extension module: a thread-safe pool of reusable, size-classed I/O
+# buffers allocated with PyMem_Malloc(). The buffers export the buffer protocol, so data can be read into them with readinto() and handed
+# out as zero-copy memoryviews instead of new bytes objects.
+#
+# Build it next to this file with:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Memory_Management_C_Buffer_Pool.c \
+#       -o bufferpool$(python3-config --extension-suffix)
+#
+# Example:
+#
+
+import io
+
+import bufferpool
+
+pool = bufferpool.BufferPool()
+
+stream = io.BytesIO(b"Hello Python!\n" * 2000)
+
+for _ in range(3):
+
+    # the block goes back to the pool at the end of the with block
+
+    with pool.acquire(8190) as buf:
+
+        n = stream.readinto(buf)
+
+        # zero-copy view of the bytes just read
+
+        view = memoryview(buf)[:n]
+
+        print(bytes(view[:14]))
+
+        view.release()
+
+print(pool.stats()[16384])  # prints {'hits': 2, 'misses': 1, 'in_use': 0, 'high_water': 1, 'free': 1}
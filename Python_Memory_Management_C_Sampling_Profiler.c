@@ -0,0 +1,612 @@
+/********************************************************* CPython Memory Management ***********************************************************************
+
+# tracemalloc.start() traces every memory block: each allocation stores its traceback and every free looks it up, which costs a lot of CPU
+# and memory on a busy service.
+#
+# This extension module, "allocsample", is a sampling alternative in the style of heap profilers. install() wraps the PYMEM_DOMAIN_MEM and
+# PYMEM_DOMAIN_OBJ allocators with PyMem_SetAllocator() hooks that sample the allocated bytes as a Poisson process with a mean of one sample
+# every rate bytes:
+#
+# > the hooks count down the bytes until the next sample point, drawn from an exponential distribution; most allocations only subtract
+#   their size from the counter,
+# > the block that crosses a sample point is sampled: a block of size bytes is sampled with probability p = 1 - exp(-size / rate), so it
+#   stands for size / p bytes and 1 / p blocks (Horvitz-Thompson estimate),
+# > only a sampled block captures the Python stack (up to max_frames frames, walked like tracemalloc does, without creating frame objects);
+#   identical stacks are interned, so each distinct traceback is stored once,
+# > sampled blocks are kept in an open-addressing hash keyed by pointer, and removed when they are released or reallocated.
+#
+# traces() returns the live sampled blocks in the tracemalloc raw trace format, (domain, estimated size, frames, total_nframe), followed by
+# the estimated block count; Python_Memory_Management_C_Sampling_Profiler.py turns them into a tracemalloc.Snapshot for display_top().
+#
+# The hooks rely on the GIL, which the MEM and OBJ domains require; the RAW domain can be used without it and is not sampled.
+#
+# Build:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Memory_Management_C_Sampling_Profiler.c \
+#       -o allocsample$(python3-config --extension-suffix)
+
+**********************************************************************************************************************************************************/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <math.h>
+#include <stdint.h>
+#include <string.h>
+
+/* the stack is walked like tracemalloc does, over the interpreter frames */
+#define Py_BUILD_CORE
+#include "internal/pycore_frame.h"
+#undef Py_BUILD_CORE
+
+#define MAX_FRAMES 128
+
+typedef struct {
+    PyObject *filename;     /* strong reference */
+    int lineno;             /* 0 if unknown, like tracemalloc */
+} Frame;
+
+typedef struct {
+    Py_uhash_t hash;
+    int nframe;
+    int total_nframe;
+    Frame frames[1];        /* most recent first */
+} Traceback;
+
+typedef struct {
+    uintptr_t key;          /* 0: empty slot */
+    size_t size;
+    double weight;          /* 1 / sampling probability */
+    Traceback *traceback;
+} Sample;
+
+static PyMemAllocatorEx original[2];    /* MEM, OBJ */
+static PyMemAllocatorEx raw;
+static int installed = 0;
+
+static double rate = 512 * 1024;
+static int max_frames = 25;
+static Py_ssize_t until_sample = 0;
+static uint64_t rng_state = 0x9E3779B97F4A7C15ULL;
+
+static Sample *samples = NULL;
+static size_t samples_capacity = 0;     /* power of two */
+static size_t samples_count = 0;
+
+static Traceback **tracebacks = NULL;
+static size_t tracebacks_capacity = 0;  /* power of two */
+static size_t tracebacks_count = 0;
+
+static size_t allocations = 0;
+static size_t sampled = 0;
+static size_t lost = 0;                 /* samples not recorded: out of memory */
+
+static Frame scratch[MAX_FRAMES];
+
+
+static void *
+raw_malloc(size_t size)
+{
+    return raw.malloc(raw.ctx, size);
+}
+
+static void *
+raw_calloc(size_t nelem, size_t elsize)
+{
+    return raw.calloc(raw.ctx, nelem, elsize);
+}
+
+static void
+raw_free(void *ptr)
+{
+    raw.free(raw.ctx, ptr);
+}
+
+/* xorshift64*, then an exponential draw with mean rate */
+static Py_ssize_t
+next_interval(void)
+{
+    double u;
+
+    if (rate <= 1)
+        return 0;
+    rng_state ^= rng_state >> 12;
+    rng_state ^= rng_state << 25;
+    rng_state ^= rng_state >> 27;
+    u = ((rng_state * 0x2545F4914F6CDD1DULL) >> 11) * (1.0 / 9007199254740992.0);
+    return (Py_ssize_t)(-log(1.0 - u) * rate) + 1;
+}
+
+static size_t
+slot_of(uintptr_t key, size_t capacity)
+{
+    return (size_t)(((uint64_t)(key >> 4) * 0x9E3779B97F4A7C15ULL) >> 17)
+           & (capacity - 1);
+}
+
+
+/* Interned tracebacks */
+
+static Py_uhash_t
+hash_frames(Frame *frames, int nframe, int total_nframe)
+{
+    Py_uhash_t hash = 0x345678UL ^ (Py_uhash_t)total_nframe;
+    int i;
+
+    for (i = 0; i < nframe; i++) {
+        hash = (hash ^ (Py_uhash_t)(uintptr_t)frames[i].filename) * 1000003UL;
+        hash = (hash ^ (Py_uhash_t)frames[i].lineno) * 1000003UL;
+    }
+    return hash;
+}
+
+static int
+tracebacks_grow(void)
+{
+    size_t capacity = tracebacks_capacity ? tracebacks_capacity * 2 : 1024;
+    Traceback **grown = raw_calloc(capacity, sizeof(Traceback *));
+    size_t i, j;
+
+    if (grown == NULL)
+        return -1;
+    for (i = 0; i < tracebacks_capacity; i++) {
+        Traceback *traceback = tracebacks[i];
+        if (traceback == NULL)
+            continue;
+        j = traceback->hash & (capacity - 1);
+        while (grown[j] != NULL)
+            j = (j + 1) & (capacity - 1);
+        grown[j] = traceback;
+    }
+    raw_free(tracebacks);
+    tracebacks = grown;
+    tracebacks_capacity = capacity;
+    return 0;
+}
+
+static Traceback *
+intern_traceback(Frame *frames, int nframe, int total_nframe)
+{
+    Py_uhash_t hash = hash_frames(frames, nframe, total_nframe);
+    Traceback *traceback;
+    size_t i;
+    int k;
+
+    if (2 * (tracebacks_count + 1) > tracebacks_capacity
+        && tracebacks_grow() < 0)
+        return NULL;
+
+    i = hash & (tracebacks_capacity - 1);
+    while ((traceback = tracebacks[i]) != NULL) {
+        if (traceback->hash == hash && traceback->nframe == nframe
+            && traceback->total_nframe == total_nframe
+            && memcmp(traceback->frames, frames, nframe * sizeof(Frame)) == 0)
+            return traceback;
+        i = (i + 1) & (tracebacks_capacity - 1);
+    }
+
+    traceback = raw_malloc(sizeof(Traceback) + (nframe - 1) * sizeof(Frame));
+    if (traceback == NULL)
+        return NULL;
+    traceback->hash = hash;
+    traceback->nframe = nframe;
+    traceback->total_nframe = total_nframe;
+    memcpy(traceback->frames, frames, nframe * sizeof(Frame));
+    for (k = 0; k < nframe; k++)
+        Py_INCREF(frames[k].filename);
+    tracebacks[i] = traceback;
+    tracebacks_count++;
+    return traceback;
+}
+
+/* Walk the interpreter frames of the current thread, without creating
+   frame objects, and intern the result. */
+static Traceback *
+capture_traceback(void)
+{
+    PyThreadState *tstate = PyGILState_GetThisThreadState();
+    _PyInterpreterFrame *frame;
+    int nframe = 0, total_nframe = 0;
+
+    if (tstate == NULL)
+        return NULL;
+#if PY_VERSION_HEX >= 0x030D0000
+    frame = tstate->current_frame;
+#else
+    frame = tstate->cframe->current_frame;
+#endif
+    for (; frame != NULL; frame = frame->previous) {
+#if PY_VERSION_HEX >= 0x030D0000
+        PyCodeObject *code = (PyCodeObject *)frame->f_executable;
+        if (!PyCode_Check(code))
+            continue;
+#else
+        PyCodeObject *code = frame->f_code;
+#endif
+#if PY_VERSION_HEX >= 0x030C0000
+        if (frame->owner == FRAME_OWNED_BY_CSTACK)
+            continue;
+#endif
+        if (nframe < max_frames) {
+            int lineno = PyCode_Addr2Line(
+                code, _PyInterpreterFrame_LASTI(frame) * sizeof(_Py_CODEUNIT));
+            scratch[nframe].filename = code->co_filename;
+            scratch[nframe].lineno = lineno < 0 ? 0 : lineno;
+            nframe++;
+        }
+        total_nframe++;
+    }
+    if (nframe == 0)
+        return NULL;
+    return intern_traceback(scratch, nframe, total_nframe);
+}
+
+
+/* Sampled blocks */
+
+static int
+samples_grow(void)
+{
+    size_t capacity = samples_capacity * 2, i, j;
+    Sample *grown = raw_calloc(capacity, sizeof(Sample));
+
+    if (grown == NULL)
+        return -1;
+    for (i = 0; i < samples_capacity; i++) {
+        if (samples[i].key == 0)
+            continue;
+        j = slot_of(samples[i].key, capacity);
+        while (grown[j].key != 0)
+            j = (j + 1) & (capacity - 1);
+        grown[j] = samples[i];
+    }
+    raw_free(samples);
+    samples = grown;
+    samples_capacity = capacity;
+    return 0;
+}
+
+static void
+sample_block(void *ptr, size_t size)
+{
+    Traceback *traceback;
+    double p;
+    size_t i;
+
+    until_sample = next_interval();
+    sampled++;
+
+    if (2 * (samples_count + 1) > samples_capacity && samples_grow() < 0) {
+        lost++;
+        return;
+    }
+    traceback = capture_traceback();
+    if (traceback == NULL) {
+        lost++;
+        return;
+    }
+
+    p = rate <= 1 ? 1.0 : -expm1(-(double)size / rate);
+    i = slot_of((uintptr_t)ptr, samples_capacity);
+    while (samples[i].key != 0 && samples[i].key != (uintptr_t)ptr)
+        i = (i + 1) & (samples_capacity - 1);
+    if (samples[i].key == 0)
+        samples_count++;
+    samples[i].key = (uintptr_t)ptr;
+    samples[i].size = size;
+    samples[i].weight = p > 0 ? 1.0 / p : 0.0;
+    samples[i].traceback = traceback;
+}
+
+static inline void
+account(void *ptr, size_t size)
+{
+    allocations++;
+    until_sample -= (Py_ssize_t)size;
+    if (until_sample <= 0)
+        sample_block(ptr, size);
+}
+
+static void
+forget(void *ptr)
+{
+    uintptr_t key = (uintptr_t)ptr;
+    size_t i, j, k;
+
+    i = slot_of(key, samples_capacity);
+    while (samples[i].key != 0 && samples[i].key != key)
+        i = (i + 1) & (samples_capacity - 1);
+    if (samples[i].key == 0)
+        return;
+    samples_count--;
+
+    /* backward-shift deletion */
+    j = i;
+    for (;;) {
+        samples[i].key = 0;
+        for (;;) {
+            j = (j + 1) & (samples_capacity - 1);
+            if (samples[j].key == 0)
+                return;
+            k = slot_of(samples[j].key, samples_capacity);
+            if (i <= j ? (i < k && k <= j) : (i < k || k <= j))
+                continue;
+            break;
+        }
+        samples[i] = samples[j];
+        i = j;
+    }
+}
+
+
+/* Hooks; ctx points to the wrapped allocator. */
+
+static void *
+hook_malloc(void *ctx, size_t size)
+{
+    PyMemAllocatorEx *alloc = ctx;
+    void *ptr = alloc->malloc(alloc->ctx, size);
+
+    if (ptr != NULL)
+        account(ptr, size);
+    return ptr;
+}
+
+static void *
+hook_calloc(void *ctx, size_t nelem, size_t elsize)
+{
+    PyMemAllocatorEx *alloc = ctx;
+    void *ptr = alloc->calloc(alloc->ctx, nelem, elsize);
+
+    if (ptr != NULL)
+        account(ptr, nelem * elsize);
+    return ptr;
+}
+
+static void *
+hook_realloc(void *ctx, void *ptr, size_t new_size)
+{
+    PyMemAllocatorEx *alloc = ctx;
+    void *result = alloc->realloc(alloc->ctx, ptr, new_size);
+
+    if (result != NULL) {
+        /* like tracemalloc: the old block is gone, the new one is counted
+           as a fresh allocation */
+        if (ptr != NULL && samples_count)
+            forget(ptr);
+        account(result, new_size);
+    }
+    return result;
+}
+
+static void
+hook_free(void *ctx, void *ptr)
+{
+    PyMemAllocatorEx *alloc = ctx;
+
+    if (ptr != NULL && samples_count)
+        forget(ptr);
+    alloc->free(alloc->ctx, ptr);
+}
+
+
+/* Module functions */
+
+static void
+clear_samples(void)
+{
+    Traceback **old = tracebacks;
+    size_t capacity = tracebacks_capacity, i;
+    int k;
+
+    if (samples != NULL)
+        memset(samples, 0, samples_capacity * sizeof(Sample));
+    samples_count = 0;
+
+    /* detach the interned tracebacks first: releasing a filename frees
+       memory, and the hooks may sample again meanwhile */
+    tracebacks = NULL;
+    tracebacks_capacity = 0;
+    tracebacks_count = 0;
+    for (i = 0; i < capacity; i++) {
+        Traceback *traceback = old[i];
+        if (traceback == NULL)
+            continue;
+        for (k = 0; k < traceback->nframe; k++)
+            Py_DECREF(traceback->frames[k].filename);
+        raw_free(traceback);
+    }
+    raw_free(old);
+}
+
+static PyObject *
+allocsample_install(PyObject *module, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"rate", "max_frames", NULL};
+    Py_ssize_t sample_rate = 512 * 1024;
+    int frames = 25;
+    PyMemAllocatorEx hook;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|ni:install", kwlist,
+                                     &sample_rate, &frames))
+        return NULL;
+    if (installed) {
+        PyErr_SetString(PyExc_RuntimeError, "allocsample is already installed");
+        return NULL;
+    }
+    if (sample_rate < 0) {
+        PyErr_SetString(PyExc_ValueError, "rate must be >= 0");
+        return NULL;
+    }
+    if (frames < 1 || frames > MAX_FRAMES) {
+        PyErr_Format(PyExc_ValueError, "max_frames must be in 1..%d", MAX_FRAMES);
+        return NULL;
+    }
+
+    PyMem_GetAllocator(PYMEM_DOMAIN_RAW, &raw);
+    if (samples == NULL) {
+        samples_capacity = 1024;
+        samples = raw_calloc(samples_capacity, sizeof(Sample));
+        if (samples == NULL)
+            return PyErr_NoMemory();
+    }
+
+    rate = (double)sample_rate;
+    max_frames = frames;
+    until_sample = next_interval();
+    allocations = sampled = lost = 0;
+
+    PyMem_GetAllocator(PYMEM_DOMAIN_MEM, &original[0]);
+    PyMem_GetAllocator(PYMEM_DOMAIN_OBJ, &original[1]);
+    hook.malloc = hook_malloc;
+    hook.calloc = hook_calloc;
+    hook.realloc = hook_realloc;
+    hook.free = hook_free;
+    hook.ctx = &original[0];
+    PyMem_SetAllocator(PYMEM_DOMAIN_MEM, &hook);
+    hook.ctx = &original[1];
+    PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, &hook);
+    installed = 1;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+allocsample_uninstall(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    if (!installed) {
+        PyErr_SetString(PyExc_RuntimeError, "allocsample is not installed");
+        return NULL;
+    }
+    PyMem_SetAllocator(PYMEM_DOMAIN_MEM, &original[0]);
+    PyMem_SetAllocator(PYMEM_DOMAIN_OBJ, &original[1]);
+    installed = 0;
+    clear_samples();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+allocsample_clear(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    clear_samples();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+build_frames(Traceback *traceback)
+{
+    PyObject *frames = PyTuple_New(traceback->nframe);
+    int k;
+
+    if (frames == NULL)
+        return NULL;
+    for (k = 0; k < traceback->nframe; k++) {
+        PyObject *frame = Py_BuildValue("(Oi)", traceback->frames[k].filename,
+                                        traceback->frames[k].lineno);
+        if (frame == NULL) {
+            Py_DECREF(frames);
+            return NULL;
+        }
+        PyTuple_SET_ITEM(frames, k, frame);
+    }
+    return frames;
+}
+
+static PyObject *
+allocsample_traces(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    PyObject *result = NULL, *cache = NULL;
+    Sample *copy;
+    size_t n = 0, i;
+
+    /* copy the live samples first: building the result allocates, which
+       changes the table; interned tracebacks stay valid until clear() */
+    copy = PyMem_RawMalloc((samples_count ? samples_count : 1) * sizeof(Sample));
+    if (copy == NULL)
+        return PyErr_NoMemory();
+    for (i = 0; i < samples_capacity; i++) {
+        if (samples[i].key != 0)
+            copy[n++] = samples[i];
+    }
+
+    if ((result = PyList_New(0)) == NULL || (cache = PyDict_New()) == NULL)
+        goto error;
+    for (i = 0; i < n; i++) {
+        Sample *s = &copy[i];
+        PyObject *key = PyLong_FromVoidPtr(s->traceback), *frames, *item;
+
+        if (key == NULL)
+            goto error;
+        frames = PyDict_GetItemWithError(cache, key);
+        if (frames != NULL) {
+            Py_INCREF(frames);
+        }
+        else if (PyErr_Occurred()
+                 || (frames = build_frames(s->traceback)) == NULL
+                 || PyDict_SetItem(cache, key, frames) < 0) {
+            Py_XDECREF(frames);
+            Py_DECREF(key);
+            goto error;
+        }
+        Py_DECREF(key);
+        item = Py_BuildValue("(inNid)", 0,
+                             (Py_ssize_t)(s->size * s->weight + 0.5), frames,
+                             s->traceback->total_nframe, s->weight);
+        if (item == NULL || PyList_Append(result, item) < 0) {
+            Py_XDECREF(item);
+            goto error;
+        }
+        Py_DECREF(item);
+    }
+    Py_DECREF(cache);
+    PyMem_RawFree(copy);
+    return result;
+
+error:
+    Py_XDECREF(cache);
+    Py_XDECREF(result);
+    PyMem_RawFree(copy);
+    return NULL;
+}
+
+static PyObject *
+allocsample_stats(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    return Py_BuildValue("{s:O,s:n,s:i,s:n,s:n,s:n,s:n,s:n}",
+                         "installed", installed ? Py_True : Py_False,
+                         "rate", (Py_ssize_t)rate,
+                         "max_frames", max_frames,
+                         "allocations", (Py_ssize_t)allocations,
+                         "sampled", (Py_ssize_t)sampled,
+                         "live", (Py_ssize_t)samples_count,
+                         "tracebacks", (Py_ssize_t)tracebacks_count,
+                         "lost", (Py_ssize_t)lost);
+}
+
+
+static PyMethodDef allocsample_methods[] = {
+    {"install", (PyCFunction)(void (*)(void))allocsample_install,
+     METH_VARARGS | METH_KEYWORDS,
+     "install(rate=524288, max_frames=25)\n\nSample one allocation every rate bytes on average."},
+    {"uninstall", allocsample_uninstall, METH_NOARGS,
+     "Restore the previous allocators and drop the samples."},
+    {"clear", allocsample_clear, METH_NOARGS,
+     "Drop the samples collected so far."},
+    {"traces", allocsample_traces, METH_NOARGS,
+     "Return the live samples: (domain, estimated size, frames, total_nframe, estimated count)."},
+    {"stats", allocsample_stats, METH_NOARGS,
+     "Return the profiler counters."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef allocsample_module = {
+    PyModuleDef_HEAD_INIT,
+    "allocsample",
+    "Poisson byte-sampling allocation profiler.",
+    -1,
+    allocsample_methods,
+};
+
+PyMODINIT_FUNC
+PyInit_allocsample(void)
+{
+    return PyModule_Create(&allocsample_module);
+}
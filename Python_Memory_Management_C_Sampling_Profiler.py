@@ -0,0 +1,69 @@
+# Python Memory Management
+# tracemalloc.start() and tracemalloc.start(25) trace every memory block, which is too expensive to leave on in a busy service.
+#
+# Python_Memory_Management_C_Sampling_Profiler.c builds the "allocsample" extension module. Its PyMem_SetAllocator() hooks sample about one
+# allocation every rate bytes (Poisson sampling of the allocated bytes) and capture the Python stack only for the sampled blocks.
+#
+# snapshot() turns the live samples into a tracemalloc.Snapshot whose sizes are scaled up to estimates, so display_top() and the other
+# report scripts work on it unchanged; a Statistic count there is the number of samples. statistics() returns Statistic instances with the
+# estimated block counts instead.
+#
+# Build it next to this file with:
+#
+#   gcc -shared -fPIC -O2 $(python3-config --includes) Python_Memory_Management_C_Sampling_Profiler.c \
+#       -o allocsample$(python3-config --extension-suffix)
+#
+# Example:
+#
+
+import tracemalloc
+
+import allocsample
+
+
+def snapshot():
+    """Return the live samples as a tracemalloc.Snapshot with estimated sizes."""
+
+    traces = [trace[:4] for trace in allocsample.traces()]
+    return tracemalloc.Snapshot(traces, allocsample.stats()["max_frames"])
+
+
+def statistics(key_type='lineno', cumulative=False):
+    """Like Snapshot.statistics(), with estimated sizes and block counts."""
+
+    traces = allocsample.traces()
+    limit = allocsample.stats()["max_frames"]
+
+    sizes = tracemalloc.Snapshot([trace[:4] for trace in traces], limit)
+    # group the estimated counts the same way, carried in the size field
+    counts = tracemalloc.Snapshot(
+        [(domain, round(count), frames, total_nframe)
+         for domain, size, frames, total_nframe, count in traces], limit)
+    estimated = {stat.traceback: stat.size
+                 for stat in counts.statistics(key_type, cumulative)}
+
+    stats = [tracemalloc.Statistic(stat.traceback, stat.size,
+                                   estimated.get(stat.traceback, 0))
+             for stat in sizes.statistics(key_type, cumulative)]
+    stats.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+    return stats
+
+
+if __name__ == "__main__":
+
+    # about one sample every 64 KiB allocated
+
+    allocsample.install(rate=64 * 1024, max_frames=25)
+
+    # ... run your application ...
+
+    data = [str(i) * 10 for i in range(100000)]
+
+    print("[ Top 10 (estimated) ]")
+
+    for stat in statistics('lineno')[:10]:
+        print(stat)
+
+    print(allocsample.stats())
+
+    allocsample.uninstall()
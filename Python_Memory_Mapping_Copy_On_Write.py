@@ -0,0 +1,522 @@
+# Python Memory Mapping.
+# mmap - Memory-mapped file support.
+# The last example of Python_Memory_Mapping_Mmap.py shares an mmap.mmap(-1, 13) between a process and the child it forks. Every private page
+# of the parent is shared the same way after fork(), until one side writes to it and the kernel copies it (copy-on-write). CPython writes
+# to objects it only reads: every reference taken updates ob_refcnt, and every gc collection updates the gc header of the objects it
+# visits, so the workers of a pre-fork server slowly turn the parent's shared heap into private copies.
+#
+# Copy-on-write accounting for pre-fork workers.
+#
+# > read_smaps(pid) parses /proc/<pid>/smaps into Mapping objects (rss, pss, shared and private bytes per mapping), usage_by_name() sums
+#   them per file or anonymous region, and CowMonitor samples a parent and its workers on each sample() call, so the private and shared
+#   bytes of each mapping can be followed over time.
+# > copied_pages(parent, worker) reads /proc/<pid>/pagemap for both processes and returns the pages of the worker's private writable
+#   mappings that are no longer shared with the parent: both present with different page frames, or, when the page frames are hidden
+#   (reading them needs CAP_SYS_ADMIN), present in the parent and mapped exclusively in the worker.
+# > cow_statistics(worker, marker) runs in the parent: the objects the parent allocated before fork() sit at the same addresses in the
+#   worker, so the parent's objects lying on the worker's copied pages are grouped by their tracemalloc allocation site. Only the objects
+#   recorded by mark_fork() right before fork() are counted: an object the parent allocated afterwards may reuse an address that holds
+#   something else in the worker. The result is a list of Statistic instances (bytes and number of objects on copied pages) that
+#   display_cow_statistics() prints like display_top().
+# > freeze_before_fork() runs a last collection and moves every tracked object to the permanent generation with gc.freeze(), so the
+#   workers' collections do not touch them; measure_freeze() forks workers with and without it and returns the private bytes each worker
+#   ends up with.
+#
+# Reading another process's smaps and pagemap needs the same permissions as ptrace; a parent reading its own workers has them.
+#
+
+import gc
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+from Python_Memory_Frame_Render import short_filename, source_line
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+_PRESENT = 1 << 63
+_EXCLUSIVE = 1 << 56
+_PFN_MASK = (1 << 55) - 1
+
+_FIELDS = {
+    "Rss:": "rss",
+    "Pss:": "pss",
+    "Shared_Clean:": "shared_clean",
+    "Shared_Dirty:": "shared_dirty",
+    "Private_Clean:": "private_clean",
+    "Private_Dirty:": "private_dirty",
+    "Swap:": "swap",
+}
+
+
+class Mapping:
+    """One line of /proc/<pid>/maps with its smaps counters, in bytes."""
+
+    __slots__ = ("start", "end", "perms", "name", "rss", "pss",
+                 "shared_clean", "shared_dirty", "private_clean",
+                 "private_dirty", "swap")
+
+    def __init__(self, start, end, perms, name):
+        self.start = start
+        self.end = end
+        self.perms = perms
+        self.name = name
+        self.rss = self.pss = self.swap = 0
+        self.shared_clean = self.shared_dirty = 0
+        self.private_clean = self.private_dirty = 0
+
+    @property
+    def shared(self):
+        return self.shared_clean + self.shared_dirty
+
+    @property
+    def private(self):
+        return self.private_clean + self.private_dirty
+
+    @property
+    def copy_on_write(self):
+        """Private writable mapping: shared with a fork until written."""
+        return "w" in self.perms and self.perms.endswith("p")
+
+    def __repr__(self):
+        return ("<Mapping %x-%x %s %s private=%i shared=%i>"
+                % (self.start, self.end, self.perms, self.name,
+                   self.private, self.shared))
+
+
+def read_smaps(pid="self"):
+    mappings = []
+    mapping = None
+    with open("/proc/%s/smaps" % pid, encoding="utf-8",
+              errors="surrogateescape") as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            field = _FIELDS.get(fields[0])
+            if field is not None:
+                setattr(mapping, field, int(fields[1]) * 1024)
+            elif "-" in fields[0] and not fields[0].endswith(":"):
+                start, end = fields[0].split("-")
+                name = fields[5] if len(fields) > 5 else "[anon]"
+                mapping = Mapping(int(start, 16), int(end, 16), fields[1], name)
+                mappings.append(mapping)
+    return mappings
+
+
+def usage_by_name(mappings):
+    """Return {name: [rss, pss, private, shared]}; anonymous mappings
+    (Python's arenas among them) are summed under "[anon]"."""
+
+    usage = {}
+    for mapping in mappings:
+        try:
+            entry = usage[mapping.name]
+        except KeyError:
+            entry = usage[mapping.name] = [0, 0, 0, 0]
+        entry[0] += mapping.rss
+        entry[1] += mapping.pss
+        entry[2] += mapping.private
+        entry[3] += mapping.shared
+    return usage
+
+
+def worker_pids(parent_pid=None):
+    """Return the pids of the children of parent_pid (this process if None)."""
+
+    if parent_pid is None:
+        parent_pid = os.getpid()
+    pids = []
+    try:
+        for task in os.listdir("/proc/%s/task" % parent_pid):
+            with open("/proc/%s/task/%s/children" % (parent_pid, task)) as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        return sorted(pids)
+    except FileNotFoundError:
+        pass
+    # kernels without CONFIG_PROC_CHILDREN: scan every process
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/%s/stat" % entry, "rb") as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            # the command name may contain spaces: ppid follows the last ')'
+            if int(stat[stat.rindex(b")") + 2:].split()[1]) == parent_pid:
+                pids.append(int(entry))
+    return sorted(pids)
+
+
+def _read_pagemap(fd, start, end):
+    npages = (end - start) // PAGE_SIZE
+    data = os.pread(fd, npages * 8, start // PAGE_SIZE * 8)
+    return struct.unpack("%iQ" % (len(data) // 8), data)
+
+
+def copied_pages(parent_pid, worker_pid, mappings=None):
+    """Return ({name: [shared_pages, copied_pages]}, set of copied page
+    addresses) for the private writable mappings of worker_pid."""
+
+    if mappings is None:
+        mappings = read_smaps(worker_pid)
+    by_name = {}
+    copied = set()
+
+    parent_fd = os.open("/proc/%s/pagemap" % parent_pid, os.O_RDONLY)
+    try:
+        worker_fd = os.open("/proc/%s/pagemap" % worker_pid, os.O_RDONLY)
+        try:
+            for mapping in mappings:
+                if not mapping.copy_on_write:
+                    continue
+                worker = _read_pagemap(worker_fd, mapping.start, mapping.end)
+                parent = _read_pagemap(parent_fd, mapping.start, mapping.end)
+                entry = by_name.setdefault(mapping.name, [0, 0])
+                address = mapping.start
+                for mine, theirs in zip(worker, parent):
+                    if mine & _PRESENT and theirs & _PRESENT:
+                        frame = mine & _PFN_MASK
+                        if frame:
+                            is_copy = frame != theirs & _PFN_MASK
+                        else:
+                            is_copy = bool(mine & _EXCLUSIVE)
+                        if is_copy:
+                            entry[1] += 1
+                            copied.add(address)
+                        else:
+                            entry[0] += 1
+                    address += PAGE_SIZE
+        finally:
+            os.close(worker_fd)
+    finally:
+        os.close(parent_fd)
+    return by_name, copied
+
+
+class CowSample:
+    __slots__ = ("timestamp", "usage")
+
+    def __init__(self, timestamp, usage):
+        self.timestamp = timestamp
+        self.usage = usage     # {pid: {name: [rss, pss, private, shared]}}
+
+
+class CowMonitor:
+    """Sample the smaps of a parent and its workers over time."""
+
+    def __init__(self, parent_pid=None, workers=None):
+        self.parent_pid = os.getpid() if parent_pid is None else parent_pid
+        self.workers = workers
+        self.samples = []
+
+    def pids(self):
+        workers = self.workers
+        if workers is None:
+            workers = worker_pids(self.parent_pid)
+        return [self.parent_pid] + list(workers)
+
+    def sample(self):
+        usage = {}
+        for pid in self.pids():
+            try:
+                usage[pid] = usage_by_name(read_smaps(pid))
+            except (FileNotFoundError, ProcessLookupError):
+                # the worker exited
+                continue
+        sample = CowSample(time.time(), usage)
+        self.samples.append(sample)
+        return sample
+
+    def series(self, pid, name="[anon]"):
+        """Return [(timestamp, private, shared)] of one mapping name."""
+
+        return [(sample.timestamp,) + tuple(sample.usage[pid][name][2:])
+                for sample in self.samples
+                if name in sample.usage.get(pid, ())]
+
+    def display(self, limit=5):
+        """Print the mappings with the most private bytes per process,
+        with their change since the first sample."""
+
+        if not self.samples:
+            return
+        first, last = self.samples[0], self.samples[-1]
+        for pid, usage in last.usage.items():
+            role = "parent" if pid == self.parent_pid else "worker"
+            total_private = sum(entry[2] for entry in usage.values())
+            total_shared = sum(entry[3] for entry in usage.values())
+            print("%s %s: private %.1f KiB, shared %.1f KiB"
+                  % (role, pid, total_private / 1024, total_shared / 1024))
+            before = first.usage.get(pid, {})
+            top = sorted(usage.items(), key=lambda item: item[1][2],
+                         reverse=True)[:limit]
+            for name, (rss, pss, private, shared) in top:
+                old_private = before.get(name, (0, 0, 0, 0))[2]
+                print("    %s: private %.1f KiB (%+.1f KiB), shared %.1f KiB"
+                      % (name, private / 1024, (private - old_private) / 1024,
+                         shared / 1024))
+
+
+def _walk_objects(own=()):
+    """Yield every object gc knows of, frozen ones included, and the
+    untracked objects (strings, numbers, atomic tuples and dicts) they
+    refer to; the objects whose id is in own are left out."""
+
+    if gc.get_freeze_count():
+        # gc.get_objects() skips the permanent generation: walk it too,
+        # which freezes again every object tracked at this point
+        gc.unfreeze()
+        objects = gc.get_objects()
+        gc.freeze()
+    else:
+        objects = gc.get_objects()
+
+    seen = set()
+    own = set(own)
+    own.update((id(objects), id(seen), id(own)))
+    for obj in objects:
+        if id(obj) in own:
+            continue
+        yield obj
+        pending = gc.get_referents(obj)
+        while pending:
+            ref = pending.pop()
+            if not gc.is_tracked(ref) and id(ref) not in seen:
+                seen.add(id(ref))
+                yield ref
+                pending.extend(gc.get_referents(ref))
+
+
+class ForkMarker:
+    """The objects of this process at the time it was created, by address
+    and type; create it with mark_fork() right before fork()."""
+
+    def __init__(self):
+        types = self._types = {}
+        for obj in _walk_objects((id(types), id(self))):
+            types[id(obj)] = type(obj)
+
+    def __len__(self):
+        return len(self._types)
+
+    def __contains__(self, obj):
+        # an object allocated since at a freed address of another type is
+        # told apart by its type
+        return self._types.get(id(obj)) is type(obj)
+
+
+def mark_fork():
+    """Call right before forking workers; return the ForkMarker that
+    cow_statistics() needs."""
+
+    return ForkMarker()
+
+
+def cow_statistics(worker_pid, marker, key_type='lineno', copied=None):
+    """Group this (parent) process's objects lying on the pages worker_pid
+    copied by allocation site: Statistic(traceback, bytes, objects). Only
+    the objects in marker, made by mark_fork() before the fork, count.
+
+    Return (stats, copied bytes, copied bytes attributed to objects)."""
+
+    if key_type not in ('lineno', 'filename', 'traceback'):
+        raise ValueError("unknown key_type: %r" % (key_type,))
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("the tracemalloc module must be tracing memory "
+                           "allocations to attribute copied pages")
+    if copied is None:
+        copied = copied_pages(os.getpid(), worker_pid)[1]
+
+    getsizeof = sys.getsizeof
+    get_traceback = tracemalloc.get_object_traceback
+    stats = {}
+    attributed = set()
+
+    def account(obj):
+        if obj not in marker:
+            # allocated after the fork
+            return
+        address = id(obj)
+        size = getsizeof(obj)
+        page = address - address % PAGE_SIZE
+        last = address + size - 1
+        last -= last % PAGE_SIZE
+        if page == last:
+            if page not in copied:
+                return
+            attributed.add(page)
+        else:
+            pages = [p for p in range(page, last + 1, PAGE_SIZE) if p in copied]
+            if not pages:
+                return
+            attributed.update(pages)
+        traceback = get_traceback(obj)
+        if traceback is None:
+            return
+        # a Traceback is sorted from the oldest frame to the most recent
+        if key_type == 'lineno':
+            frame = traceback[-1]
+            traceback = tracemalloc.Traceback(((frame.filename, frame.lineno),))
+        elif key_type == 'filename':
+            traceback = tracemalloc.Traceback(((traceback[-1].filename, 0),))
+        try:
+            stat = stats[traceback]
+            stat[0] += size
+            stat[1] += 1
+        except KeyError:
+            stats[traceback] = [size, 1]
+
+    # strings, numbers and untracked tuples and dicts are written too;
+    # this report's own containers are left out
+    for obj in _walk_objects((id(copied), id(stats), id(attributed))):
+        account(obj)
+
+    result = [tracemalloc.Statistic(traceback, size, count)
+              for traceback, (size, count) in stats.items()]
+    result.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+    return result, len(copied) * PAGE_SIZE, len(attributed) * PAGE_SIZE
+
+
+def display_cow_statistics(worker_pid, marker, key_type='lineno', limit=10):
+    top_stats, copied, attributed = cow_statistics(worker_pid, marker,
+                                                   key_type)
+
+    print("Top %s lines on pages copied by worker %s" % (limit, worker_pid))
+
+    for index, stat in enumerate(top_stats[:limit], 1):
+        frame = stat.traceback[0]
+        print("#%s: %s:%s: %.1f KiB in %i objects"
+              % (index, short_filename(frame.filename), frame.lineno,
+                 stat.size / 1024, stat.count))
+        line = source_line(frame.filename, frame.lineno)
+        if line:
+            print('    %s' % line)
+
+    print("Copied: %.1f KiB, %.1f KiB of it on pages holding Python objects"
+          % (copied / 1024, attributed / 1024))
+
+
+def freeze_before_fork():
+    """Call right before forking workers; return the number of objects
+    moved to the permanent generation."""
+
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
+
+
+def _private_dirty(pid):
+    return sum(mapping.private_dirty for mapping in read_smaps(pid)
+               if mapping.copy_on_write)
+
+
+def _fork_workers(work, workers):
+    """Fork workers that collect garbage and run work(), and return the
+    private dirty bytes of each once it is done."""
+
+    private = []
+    children = []
+    for _ in range(workers):
+        ready_r, ready_w = os.pipe()
+        go_r, go_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(ready_r)
+                os.close(go_w)
+                gc.collect()
+                if work is not None:
+                    work()
+                os.write(ready_w, b"r")
+                os.read(go_r, 1)    # stay alive until measured
+            except BaseException:
+                code = 1
+            os._exit(code)
+        os.close(ready_w)
+        os.close(go_r)
+        children.append((pid, ready_r, go_w))
+
+    for pid, ready_r, go_w in children:
+        if os.read(ready_r, 1):
+            private.append(_private_dirty(pid))
+        os.write(go_w, b"g")
+        os.close(ready_r)
+        os.close(go_w)
+        os.waitpid(pid, 0)
+    return private
+
+
+def measure_freeze(work=None, workers=2):
+    """Fork workers without, then with freeze_before_fork(), and return
+    {"default": [bytes], "frozen": [bytes], "saved": bytes per worker}."""
+
+    default = _fork_workers(work, workers)
+    frozen_count = freeze_before_fork()
+    try:
+        frozen = _fork_workers(work, workers)
+    finally:
+        gc.unfreeze()
+    return {
+        "default": default,
+        "frozen": frozen,
+        "frozen_objects": frozen_count,
+        "saved": (sum(default) - sum(frozen)) // max(len(default), 1),
+    }
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start()
+
+    # ... load long-lived data before forking the workers ...
+
+    table = {i: "value %d" % i for i in range(200000)}
+
+    # a worker that only reads the table
+
+    def work():
+        total = 0
+        for key, value in table.items():
+            total += len(value)
+
+    print(measure_freeze(work))
+
+    monitor = CowMonitor()
+
+    freeze_before_fork()
+
+    marker = mark_fork()
+
+    r, w = os.pipe()
+
+    pid = os.fork()
+
+    if pid == 0:  # In a child process
+
+        os.close(w)
+
+        work()
+
+        gc.collect()
+
+        os.read(r, 1)
+
+        os._exit(0)
+
+    os.close(r)
+
+    time.sleep(1.0)  # let the worker run
+
+    monitor.sample()
+
+    monitor.display(limit=3)
+
+    display_cow_statistics(pid, marker, limit=5)
+
+    os.write(w, b"q")
+
+    os.waitpid(pid, 0)
@@ -0,0 +1,142 @@
+# Python Memory Mapping.
+# mmap - Memory-mapped file support.
+# You can use mmap objects in most places where bytearray are expected; for example, you can use the re module to search through
+# a memory-mapped file.
+#
+# Parallel search over a memory-mapped file.
+#
+# re.finditer() over a mmap scans the whole mapping on one core, and the re module holds the GIL, so threads do not help. search() splits
+# the file into chunks aligned to mmap.ALLOCATIONGRANULARITY and searches them on a process pool; every worker maps only its own chunk of the
+# same file, so nothing is copied between processes except the match offsets.
+#
+# > each worker maps one granule before its chunk, so ^, \b and look-behind assertions see the real preceding bytes, and overlap bytes after
+#   it, so a match starting in the chunk can end in the next one; overlap must be at least the longest match the pattern can produce,
+# > a worker reports only the matches that start inside its own chunk,
+# > results come back in file order and search() yields (start, end) offsets as a generator,
+# > a worker starts matching at the start of its chunk, while a single finditer() pass resumes where the previous match ended; when the
+#   previous match ends inside the chunk, the worker can be out of phase (its first match starts before that end). search() then runs
+#   finditer() itself from the end of the previous match until it produces a match the worker also found - from there both agree - or
+#   leaves the chunk, so the result is always the one a single finditer() pass over the whole file gives.
+#
+
+import concurrent.futures
+import mmap
+import os
+import re
+
+
+def _search_chunk(path, pattern, flags, start, end, overlap):
+    regex = re.compile(pattern, flags)
+    size = os.path.getsize(path)
+    map_start = max(start - mmap.ALLOCATIONGRANULARITY, 0)
+    map_end = min(end + overlap, size)
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), map_end - map_start, access=mmap.ACCESS_READ,
+                       offset=map_start) as mm:
+            return [(match.start() + map_start, match.end() + map_start)
+                    for match in regex.finditer(mm, start - map_start)
+                    if match.start() + map_start < end or end == size]
+
+
+def chunks(size, chunk_size):
+    """Split size bytes into (start, end) chunks aligned to ALLOCATIONGRANULARITY."""
+
+    granularity = mmap.ALLOCATIONGRANULARITY
+    chunk_size = max(granularity, chunk_size // granularity * granularity)
+    return [(start, min(start + chunk_size, size))
+            for start in range(0, size, chunk_size)]
+
+
+def search(path, pattern, flags=0, chunk_size=64 << 20, overlap=1 << 16,
+           processes=None):
+    """Yield the (start, end) offsets of the matches of pattern (bytes) in
+    the file at path, in file order."""
+
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    re.compile(pattern, flags)  # report a bad pattern here, not in a worker
+
+    parts = chunks(size, chunk_size)
+    last_end = 0
+
+    if len(parts) == 1 or processes == 1:
+        results = (_search_chunk(path, pattern, flags, start, end, overlap)
+                   for start, end in parts)
+        executor = None
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(processes)
+        results = executor.map(_search_chunk,
+                               *zip(*((path, pattern, flags, start, end, overlap)
+                                      for start, end in parts)))
+    regex = None
+    f = mm = None
+    last = None
+    try:
+        for (_, chunk_end), matches in zip(parts, results):
+            if matches and matches[0][0] < last_end:
+                # out of phase: rescan from the end of the previous match
+                if mm is None:
+                    regex = re.compile(pattern, flags)
+                    f = open(path, "rb")
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                phase = {match: i for i, match in enumerate(matches)}
+                rescanned = []
+                for match in regex.finditer(mm, last_end):
+                    span = match.span()
+                    if span[0] >= chunk_end and chunk_end != size:
+                        matches = rescanned
+                        break
+                    if span in phase and span != last:
+                        matches = rescanned + matches[phase[span]:]
+                        break
+                    rescanned.append(span)
+                else:
+                    matches = rescanned
+
+            for start, end in matches:
+                if start < last_end or (start, end) == last:
+                    continue
+                # an empty match never blocks the next one
+                last_end = end if end > start else start
+                last = start, end
+                yield start, end
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if mm is not None:
+            mm.close()
+            f.close()
+
+
+if __name__ == "__main__":
+
+    # write a simple example file
+
+    with open("hello.txt", "wb") as f:
+        for i in range(200000):
+            f.write(b"Hello Python! line %d\n" % i)
+
+    # count the lines ending in 999, searching 1 MiB chunks of the file in parallel
+
+    matches = list(search("hello.txt", rb"^Hello Python! line \d*999$",
+                          re.MULTILINE, chunk_size=1 << 20))
+
+    print(len(matches))  # prints 200
+
+    # matches crossing chunk boundaries: runs of "a" longer than a chunk put the workers out of phase, search() still agrees with
+    # a single finditer() pass
+
+    with open("hello.txt", "wb") as f:
+        for i in range(64):
+            f.write(b"a" * (4000 + 37 * i) + b"b")
+
+    with open("hello.txt", "rb") as f:
+        expected = [match.span() for match in re.finditer(rb"(?:ab|a{500})", f.read())]
+
+    matches = list(search("hello.txt", rb"(?:ab|a{500})", chunk_size=4096, overlap=8192))
+
+    print(matches == expected)  # prints True
+
+    os.remove("hello.txt")
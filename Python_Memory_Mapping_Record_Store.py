@@ -0,0 +1,258 @@
+# Python Memory Mapping.
+# mmap - Memory-mapped file support.
+# Memory-mapped file objects behave like both bytearray and like file objects.
+# Slices of a mmap object copy the data; a memoryview of a mmap object gives zero-copy slices of the mapped pages instead.
+#
+# Memory-mapped record store.
+#
+# RecordStore keeps records in a memory-mapped file, either fixed-size (record_size bytes each) or length-prefixed (a uint32 length followed
+# by the payload):
+# > append() writes at the end of the mapping; when the mapping is full, the file is grown to twice its size (rounded to mmap.PAGESIZE) and
+#   remapped, so appends are amortised O(1),
+# > store[i] returns a zero-copy memoryview of record i; a fixed-size record is found by arithmetic, a length-prefixed one through an offset
+#   index kept in a second mapped file (path + ".idx"), so lookups are O(1) in both layouts,
+# > advise('sequential') / advise('random') passes MADV_SEQUENTIAL / MADV_RANDOM to the kernel for scans and point lookups.
+#
+# Views handed out before a remap keep the old mapping alive until they are released, so growing never invalidates them. close() truncates
+# the file to the bytes in use; it raises BufferError while views are still alive, like mmap.close(), and can be called again once they
+# are released.
+#
+# File layout (little-endian):
+#
+#   data:   magic b"MMRECS1\0", uint64 record_size (0: length-prefixed), uint64 used bytes, then the records
+#   index:  magic b"MMRIDX1\0", uint64 count, then count uint64 record offsets
+#
+
+import mmap
+import os
+import struct
+
+_DATA_HEADER = struct.Struct("<8sQQ")
+_INDEX_HEADER = struct.Struct("<8sQ")
+_OFFSET = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+
+DATA_MAGIC = b"MMRECS1\0"
+INDEX_MAGIC = b"MMRIDX1\0"
+
+_ADVICE = {
+    'normal': getattr(mmap, "MADV_NORMAL", None),
+    'sequential': getattr(mmap, "MADV_SEQUENTIAL", None),
+    'random': getattr(mmap, "MADV_RANDOM", None),
+    'willneed': getattr(mmap, "MADV_WILLNEED", None),
+}
+
+
+def _round_up(size):
+    return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+class _MappedFile:
+    """A file mapped in full, grown by doubling and remapping."""
+
+    def __init__(self, path, header, readonly):
+        self.readonly = readonly
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if readonly and not exists:
+            raise FileNotFoundError(path)
+        self.file = open(path, "rb" if readonly else ("r+b" if exists else "w+b"))
+        if not exists:
+            self.file.write(header)
+            self.file.truncate(_round_up(len(header)))
+        self.advice = None
+        self.map()
+
+    def map(self):
+        access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+        # the previous mapping is not closed: views still using it keep it alive
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=access)
+        if self.advice is not None:
+            self.mm.madvise(self.advice)
+
+    def reserve(self, size):
+        if size <= len(self.mm):
+            return
+        self.mm.flush()
+        self.file.truncate(_round_up(max(size, 2 * len(self.mm))))
+        self.map()
+
+    def close(self, used):
+        if self.file.closed:
+            return
+        self.mm.close()
+        if not self.readonly:
+            self.file.truncate(used)
+        self.file.close()
+
+
+class RecordStore:
+
+    def __init__(self, path, record_size=None, readonly=False, advice=None):
+        self.path = path
+        self._data = _MappedFile(path, _DATA_HEADER.pack(
+            DATA_MAGIC, record_size or 0, _DATA_HEADER.size), readonly)
+
+        magic, stored_size, self._used = _DATA_HEADER.unpack_from(self._data.mm)
+        if magic != DATA_MAGIC:
+            self._data.close(len(self._data.mm))
+            raise ValueError("%s is not a record store" % path)
+        if record_size is not None and stored_size != record_size:
+            self._data.close(self._used)
+            raise ValueError("%s holds records of %s bytes, not %s"
+                             % (path, stored_size or "variable", record_size))
+        self.record_size = stored_size or None
+
+        self._index = None
+        if self.record_size is None:
+            try:
+                self._index = _MappedFile(path + ".idx", _INDEX_HEADER.pack(
+                    INDEX_MAGIC, 0), readonly)
+            except BaseException:
+                self._data.close(self._used)
+                raise
+            magic, self._count = _INDEX_HEADER.unpack_from(self._index.mm)
+            if magic != INDEX_MAGIC:
+                self._index.close(len(self._index.mm))
+                self._data.close(self._used)
+                raise ValueError("%s.idx is not a record index" % path)
+        else:
+            self._count = (self._used - _DATA_HEADER.size) // self.record_size
+
+        if advice is not None:
+            self.advise(advice)
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, index):
+        if self.record_size is not None:
+            return _DATA_HEADER.size + index * self.record_size
+        return _OFFSET.unpack_from(self._index.mm,
+                                   _INDEX_HEADER.size + index * _OFFSET.size)[0]
+
+    def __getitem__(self, index):
+        """Return a zero-copy memoryview of record index."""
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("record index out of range")
+
+        offset = self._offset(index)
+        if self.record_size is not None:
+            length = self.record_size
+        else:
+            length, = _LENGTH.unpack_from(self._data.mm, offset)
+            offset += _LENGTH.size
+        return memoryview(self._data.mm)[offset:offset + length]
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def append(self, record):
+        """Append one record (any bytes-like object); return its index."""
+
+        if self._data.readonly:
+            raise PermissionError("record store opened read-only")
+
+        record = memoryview(record).cast("B")
+        offset = self._used
+        if self.record_size is not None:
+            if len(record) != self.record_size:
+                raise ValueError("record must be %s bytes, not %s"
+                                 % (self.record_size, len(record)))
+            end = offset + self.record_size
+            self._data.reserve(end)
+            self._data.mm[offset:end] = record
+        else:
+            end = offset + _LENGTH.size + len(record)
+            self._data.reserve(end)
+            _LENGTH.pack_into(self._data.mm, offset, len(record))
+            self._data.mm[offset + _LENGTH.size:end] = record
+
+            position = _INDEX_HEADER.size + self._count * _OFFSET.size
+            self._index.reserve(position + _OFFSET.size)
+            _OFFSET.pack_into(self._index.mm, position, offset)
+            _INDEX_HEADER.pack_into(self._index.mm, 0, INDEX_MAGIC,
+                                    self._count + 1)
+
+        self._used = end
+        _DATA_HEADER.pack_into(self._data.mm, 0, DATA_MAGIC,
+                               self.record_size or 0, end)
+        self._count += 1
+        return self._count - 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def advise(self, advice):
+        """Hint the access pattern: 'normal', 'sequential', 'random' or 'willneed'."""
+
+        try:
+            flag = _ADVICE[advice]
+        except KeyError:
+            raise ValueError("unknown advice %r" % (advice,)) from None
+        if flag is None or not hasattr(mmap.mmap, "madvise"):
+            return
+        for mapped in (self._data, self._index):
+            if mapped is not None:
+                mapped.advice = flag
+                mapped.mm.madvise(flag)
+
+    def flush(self):
+        self._data.mm.flush()
+        if self._index is not None:
+            self._index.mm.flush()
+
+    def close(self):
+        # the data mapping first: the views are views of it, and while they
+        # are alive BufferError leaves both files open for a retry
+        self._data.close(self._used)
+        if self._index is not None:
+            self._index.close(_INDEX_HEADER.size + self._count * _OFFSET.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+
+    # length-prefixed records
+
+    with RecordStore("records.dat") as store:
+        for i in range(1000):
+            store.append(b"Hello Python! #%d\n" % i)
+
+    # scan them back without copying
+
+    with RecordStore("records.dat", readonly=True, advice='sequential') as store:
+
+        print(len(store))  # prints 1000
+
+        view = store[42]
+
+        print(bytes(view))  # prints b"Hello Python! #42\n"
+
+        view.release()
+
+    # close() with a live view fails, and succeeds once the view is released
+
+    store = RecordStore("records.dat")
+    view = store[7]
+    try:
+        store.close()
+    except BufferError:
+        print("close() refused: a view is alive")  # prints close() refused: a view is alive
+    view.release()
+    store.close()
+
+    with RecordStore("records.dat", readonly=True) as store:
+        print(len(store), bytes(store[7]))  # prints 1000 b"Hello Python! #7\n"
+
+    os.remove("records.dat")
+    os.remove("records.dat.idx")
@@ -0,0 +1,277 @@
+# Python Memory Mapping.
+# mmap - Memory-mapped file support.
+# The last example of Python_Memory_Mapping_Mmap.py writes b"Hello world!" into mmap.mmap(-1, 13) and lets a forked child read it back,
+# with no framing and no synchronisation.
+#
+# Shared-memory ring buffer between forked processes.
+#
+# SharedRing is a single-producer / multi-consumer message queue laid out in one mmap, anonymous or backed by a file, created before fork():
+# > a header holds three cursors: head (where the producer writes next), claim (the next message a consumer will take) and tail (the oldest
+#   message whose space is still in use); cursors are absolute byte offsets, positions in the ring are cursor % capacity,
+# > each message is a uint32 length and a uint32 state word followed by the payload, padded to 8 bytes; a message never wraps: when it does
+#   not fit before the end of the ring, the producer writes a wrap marker and starts again at offset 0,
+# > consumers claim messages in order under a multiprocessing.Lock and get a zero-copy memoryview of the payload; when a consumer releases a
+#   message it is marked done, and tail moves over every consecutive done message, so consumers may finish out of order; space is only
+#   reclaimed up to the oldest unreleased message, so a consumer should release a message before waiting for the next one,
+# > waiting never polls: the producer posts one token per message on an eventfd in semaphore mode (a pipe where os.eventfd() is missing) and
+#   a consumer takes one token before claiming; consumers post a token on a second eventfd when they free space, which wakes a producer
+#   blocked on a full ring. The pipe of messages blocks the producer when it is full, until consumers take tokens: a lost token would
+#   leave a message no consumer is woken for.
+#
+# The producer publishes a message by storing the new head after the payload is written. Cursors are aligned native 8-byte fields in the
+# mapping, read and written through a memoryview cast to "Q", which copies each one with a single load or store on the platforms mmap
+# shares pages on (struct.pack_into() is not used: it clears a field before writing it).
+#
+
+import mmap
+import multiprocessing
+import os
+import struct
+
+_MESSAGE = struct.Struct("<II")      # length, state
+
+HEADER_SIZE = 64
+WRAP = 0xFFFFFFFF
+READY = 0
+DONE = 1
+
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+
+class _Tokens:
+    """Counting wake-up channel: eventfd in semaphore mode, or a pipe."""
+
+    def __init__(self, semaphore):
+        if hasattr(os, "eventfd"):
+            flags = os.EFD_SEMAPHORE if semaphore else 0
+            self.read_fd = self.write_fd = os.eventfd(0, flags)
+            self.eventfd = True
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            if not semaphore:
+                # a wake-up only: when the pipe is full, the waiter wakes
+                # anyway, so a token may be dropped rather than block
+                os.set_blocking(self.write_fd, False)
+            self.eventfd = False
+        self.semaphore = semaphore
+
+    def post(self, count=1):
+        try:
+            if self.eventfd:
+                os.eventfd_write(self.write_fd, count)
+            else:
+                os.write(self.write_fd, b"\0" * count)
+        except BlockingIOError:
+            # wake-up pipe full (the semaphore pipe blocks instead: every
+            # token stands for a message and must not be lost)
+            pass
+
+    def wait(self):
+        if self.eventfd:
+            os.eventfd_read(self.read_fd)
+        else:
+            os.read(self.read_fd, 1 if self.semaphore else 4096)
+
+    def close(self):
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
+
+
+class Message:
+    """A claimed message; view is a zero-copy memoryview of its payload."""
+
+    __slots__ = ("ring", "offset", "view")
+
+    def __init__(self, ring, offset, view):
+        self.ring = ring
+        self.offset = offset
+        self.view = view
+
+    def release(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            self.ring._release(self.offset)
+
+    def __enter__(self):
+        return self.view
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class SharedRing:
+
+    def __init__(self, capacity=1 << 20, path=None):
+        capacity = _aligned(capacity)
+        if capacity < 2 * _MESSAGE.size:
+            raise ValueError("capacity too small")
+        self.capacity = capacity
+        if path is None:
+            self.mm = mmap.mmap(-1, HEADER_SIZE + capacity)
+        else:
+            with open(path, "w+b") as f:
+                f.truncate(HEADER_SIZE + capacity)
+                self.mm = mmap.mmap(f.fileno(), HEADER_SIZE + capacity)
+        # head, claim, tail, closed
+        self._cursor_view = memoryview(self.mm)[:32].cast("Q")
+        self._lock = multiprocessing.Lock()
+        self._messages = _Tokens(semaphore=True)
+        self._space = _Tokens(semaphore=False)
+
+    def _cursors(self):
+        return tuple(self._cursor_view)
+
+    def _store(self, index, value):
+        # not struct.pack_into(): it clears the field before writing it,
+        # and a consumer could read the cleared cursor
+        self._cursor_view[index] = value
+
+    # producer side
+
+    def send(self, data):
+        """Copy data (any bytes-like object) into the ring, waiting for
+        space if the ring is full."""
+
+        data = memoryview(data).cast("B")
+        size = _aligned(_MESSAGE.size + len(data))
+        if size > self.capacity:
+            raise ValueError("message of %s bytes does not fit in the ring"
+                             % len(data))
+
+        head = self._cursors()[0]
+        position = head % self.capacity
+        padding = self.capacity - position if position + size > self.capacity else 0
+
+        while True:
+            head, claim, tail, closed = self._cursors()
+            if closed:
+                raise ValueError("send on a closed ring")
+            if self.capacity - (head - tail) >= padding + size:
+                break
+            self._space.wait()
+
+        if padding:
+            _MESSAGE.pack_into(self.mm, HEADER_SIZE + position, WRAP, DONE)
+            position = 0
+        start = HEADER_SIZE + position + _MESSAGE.size
+        self.mm[start:start + len(data)] = data
+        _MESSAGE.pack_into(self.mm, HEADER_SIZE + position, len(data), READY)
+
+        self._store(0, head + padding + size)
+        self._messages.post()
+
+    def close(self):
+        """Tell consumers no more messages will come."""
+
+        self._store(3, 1)
+        self._messages.post()
+
+    # consumer side
+
+    def receive(self):
+        """Wait for the next message and claim it.
+
+        Return a Message, or None once the ring is closed and drained.
+        """
+
+        while True:
+            self._messages.wait()
+            with self._lock:
+                head, claim, tail, closed = self._cursors()
+                while claim < head:
+                    position = claim % self.capacity
+                    length, state = _MESSAGE.unpack_from(
+                        self.mm, HEADER_SIZE + position)
+                    if length == WRAP:
+                        claim += self.capacity - position
+                        continue
+                    self._store(1, claim + _aligned(_MESSAGE.size + length))
+                    start = HEADER_SIZE + position + _MESSAGE.size
+                    return Message(self, claim,
+                                   memoryview(self.mm)[start:start + length])
+                self._store(1, claim)
+            if closed:
+                # pass the wake-up on to the next waiting consumer
+                self._messages.post()
+                return None
+
+    def _release(self, offset):
+        with self._lock:
+            position = offset % self.capacity
+            length, state = _MESSAGE.unpack_from(self.mm, HEADER_SIZE + position)
+            _MESSAGE.pack_into(self.mm, HEADER_SIZE + position, length, DONE)
+
+            head, claim, tail, closed = self._cursors()
+            start = tail
+            while tail < claim:
+                position = tail % self.capacity
+                length, state = _MESSAGE.unpack_from(
+                    self.mm, HEADER_SIZE + position)
+                if state != DONE:
+                    break
+                if length == WRAP:
+                    tail += self.capacity - position
+                else:
+                    tail += _aligned(_MESSAGE.size + length)
+            if tail != start:
+                self._store(2, tail)
+        if tail != start:
+            self._space.post()
+
+    def receive_bytes(self):
+        """Like receive(), but return a copy of the payload (or None)."""
+
+        message = self.receive()
+        if message is None:
+            return None
+        with message as view:
+            return bytes(view)
+
+    def __iter__(self):
+        """Yield zero-copy views of the messages until the ring is closed;
+        each view is released when the loop moves on."""
+
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            with message as view:
+                yield view
+
+    def dispose(self):
+        self._cursor_view.release()
+        self._messages.close()
+        self._space.close()
+        self.mm.close()
+
+
+if __name__ == "__main__":
+
+    ring = SharedRing(1 << 16)
+
+    pids = []
+    for _ in range(2):
+        pid = os.fork()
+
+        if pid == 0:  # In a consumer process
+            count = sum(1 for view in ring if view[:5] == b"Hello")
+
+            print("consumer %s got %s messages" % (os.getpid(), count))
+
+            os._exit(0)
+
+        pids.append(pid)
+
+    for i in range(10000):
+        ring.send(b"Hello world! #%d" % i)
+
+    ring.close()
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    ring.dispose()
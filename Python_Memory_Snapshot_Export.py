@@ -0,0 +1,360 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Streaming snapshot export.
+#
+# display_top() needs a full tracemalloc.take_snapshot() in memory, then builds a filtered copy of it with filter_traces() and groups it with
+# statistics(), all inside the traced process. With millions of live traces this stalls the process and roughly doubles its memory.
+#
+# dump_traces() instead takes the raw trace list (the same list take_snapshot() wraps) and streams it to disk in chunks, using a compact columnar
+# format:
+# > every filename is written once, every (filename, lineno) frame is written once as a pair of integers,
+# > every distinct traceback is written once as a list of frame ids,
+# > traces sharing a (domain, traceback) are folded into one record; records are stored as arrays of traceback ids, domains, counts and sizes,
+# > each block can be compressed with zlib.
+#
+# load_statistics() reads such a file from another process and groups it by 'lineno', 'filename' or 'traceback' without rebuilding the traces:
+# it only keeps the interned tables and one counter per key, and returns the same sorted list of Statistic instances as Snapshot.statistics().
+# display_top_file() prints it exactly like display_top().
+#
+# File layout (little-endian):
+#
+#   header:  magic b"TMSNAP1\0", uint32 traceback_limit, uint8 flags (bit 0: blocks are zlib-compressed)
+#   blocks:  char tag, uint32 payload length, payload
+#            b"S"  new filenames, UTF-8 (surrogateescape), separated by NUL bytes
+#            b"F"  new frames, uint32 pairs (filename id, lineno)
+#            b"T"  new tracebacks, uint32 runs (total_nframe, nframe, frame id, ...), frames sorted from most recent to oldest
+#            b"R"  records, uint32 n, then n uint32 traceback ids, n uint32 domains, n uint32 counts, n uint64 sizes
+#            b"E"  end of file
+#
+
+import array
+import struct
+import sys
+import tracemalloc
+import zlib
+
+from Python_Memory_Frame_Render import format_top, split_top
+from Python_Memory_Trace_Fold import compile_filters
+
+MAGIC = b"TMSNAP1\0"
+FLAG_COMPRESSED = 0x01
+
+_HEADER = struct.Struct("<8sIB")
+_BLOCK = struct.Struct("<cI")
+_COUNT = struct.Struct("<I")
+
+
+def _array_bytes(typecode, values):
+    data = array.array(typecode, values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _array_from(typecode, payload, start, count):
+    data = array.array(typecode)
+    end = start + count * data.itemsize
+    data.frombytes(payload[start:end])
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data, end
+
+
+class SnapshotWriter:
+    """Write raw tracemalloc traces to a file in the columnar format.
+
+    Filenames, frames and tracebacks are interned across the whole file,
+    so each one is written only once even when traces are added in many
+    chunks.
+    """
+
+    def __init__(self, fp, traceback_limit, compress=True):
+        self._fp = fp
+        self._compress = compress
+        self._filenames = {}
+        self._frames = {}
+        self._tracebacks = {}
+        fp.write(_HEADER.pack(MAGIC, traceback_limit,
+                              FLAG_COMPRESSED if compress else 0))
+
+    def _write_block(self, tag, payload):
+        if self._compress:
+            payload = zlib.compress(payload)
+        self._fp.write(_BLOCK.pack(tag, len(payload)))
+        self._fp.write(payload)
+
+    def _intern_traceback(self, traceback, total_nframe, new_filenames,
+                          new_frames, new_tracebacks):
+        frame_ids = []
+        for frame in traceback:
+            try:
+                frame_id = self._frames[frame]
+            except KeyError:
+                filename, lineno = frame
+                try:
+                    filename_id = self._filenames[filename]
+                except KeyError:
+                    filename_id = self._filenames[filename] = len(self._filenames)
+                    new_filenames.append(filename)
+                frame_id = self._frames[frame] = len(self._frames)
+                new_frames.extend((filename_id, lineno))
+            frame_ids.append(frame_id)
+
+        traceback_id = self._tracebacks[traceback] = len(self._tracebacks)
+        if total_nframe is None:
+            total_nframe = len(frame_ids)
+        new_tracebacks.append(total_nframe)
+        new_tracebacks.append(len(frame_ids))
+        new_tracebacks.extend(frame_ids)
+        return traceback_id
+
+    def write_traces(self, traces):
+        """Write a chunk of raw trace tuples
+        (domain, size, traceback, total_nframe)."""
+
+        new_filenames = []
+        new_frames = []
+        new_tracebacks = []
+        records = {}
+
+        for domain, size, traceback, total_nframe in traces:
+            try:
+                traceback_id = self._tracebacks[traceback]
+            except KeyError:
+                traceback_id = self._intern_traceback(
+                    traceback, total_nframe,
+                    new_filenames, new_frames, new_tracebacks)
+            key = (traceback_id, domain)
+            try:
+                record = records[key]
+                record[0] += 1
+                record[1] += size
+            except KeyError:
+                records[key] = [1, size]
+
+        if new_filenames:
+            self._write_block(b"S", b"\0".join(
+                filename.encode("utf-8", "surrogateescape")
+                for filename in new_filenames))
+        if new_frames:
+            self._write_block(b"F", _array_bytes("I", new_frames))
+        if new_tracebacks:
+            self._write_block(b"T", _array_bytes("I", new_tracebacks))
+        if records:
+            keys = list(records)
+            values = list(records.values())
+            self._write_block(b"R", b"".join((
+                _COUNT.pack(len(keys)),
+                _array_bytes("I", [key[0] for key in keys]),
+                _array_bytes("I", [key[1] for key in keys]),
+                _array_bytes("I", [value[0] for value in values]),
+                _array_bytes("Q", [value[1] for value in values]),
+            )))
+
+    def close(self):
+        self._write_block(b"E", b"")
+
+
+def dump_traces(filename, traces=None, traceback_limit=None,
+                compress=True, chunk_size=65536):
+    """Stream traces to filename in the columnar snapshot format.
+
+    If traces is None, read the raw traces of the running tracemalloc
+    module directly instead of building a Snapshot.  A Snapshot can be
+    exported with dump_traces(filename, snapshot.traces._traces,
+    snapshot.traceback_limit).
+    """
+
+    if traces is None:
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("the tracemalloc module must be tracing memory "
+                               "allocations to dump traces")
+        traces = tracemalloc._get_traces()
+        traceback_limit = tracemalloc.get_traceback_limit()
+    elif traceback_limit is None:
+        traceback_limit = 0
+
+    with open(filename, "wb") as fp:
+        writer = SnapshotWriter(fp, traceback_limit, compress)
+        for start in range(0, len(traces), chunk_size):
+            writer.write_traces(traces[start:start + chunk_size])
+        writer.close()
+
+
+class SnapshotReader:
+    """Read a file written by SnapshotWriter block by block.
+
+    Only the interned filename, frame and traceback tables are kept in
+    memory; records are yielded as they are decoded.
+    """
+
+    def __init__(self, fp):
+        header = fp.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise ValueError("truncated snapshot header")
+        magic, self.traceback_limit, flags = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("not a tracemalloc snapshot export: %r" % magic)
+        self._fp = fp
+        self._compressed = bool(flags & FLAG_COMPRESSED)
+        self.filenames = []
+        self.frames = []
+        self.tracebacks = []
+
+    def _read_blocks(self):
+        while True:
+            header = self._fp.read(_BLOCK.size)
+            if len(header) != _BLOCK.size:
+                raise ValueError("truncated snapshot block")
+            tag, length = _BLOCK.unpack(header)
+            if tag == b"E":
+                return
+            payload = self._fp.read(length)
+            if len(payload) != length:
+                raise ValueError("truncated snapshot block")
+            if self._compressed:
+                payload = zlib.decompress(payload)
+            yield tag, payload
+
+    def _traceback_frames(self, traceback_id):
+        frame_ids = self.tracebacks[traceback_id][1]
+        return tuple(self.frames[frame_id] for frame_id in frame_ids)
+
+    def iter_records(self):
+        """Yield (traceback_id, domain, count, size) record columns.
+
+        Traceback ids index self.tracebacks, a list of
+        (total_nframe, frame_ids) tuples; frame ids index self.frames.
+        """
+
+        for tag, payload in self._read_blocks():
+            if tag == b"S":
+                self.filenames.extend(
+                    name.decode("utf-8", "surrogateescape")
+                    for name in payload.split(b"\0"))
+            elif tag == b"F":
+                values, _ = _array_from("I", payload, 0, len(payload) // 4)
+                filenames = self.filenames
+                for index in range(0, len(values), 2):
+                    self.frames.append((filenames[values[index]],
+                                        values[index + 1]))
+            elif tag == b"T":
+                values, _ = _array_from("I", payload, 0, len(payload) // 4)
+                index = 0
+                while index < len(values):
+                    total_nframe = values[index]
+                    nframe = values[index + 1]
+                    frame_ids = tuple(values[index + 2:index + 2 + nframe])
+                    self.tracebacks.append((total_nframe, frame_ids))
+                    index += 2 + nframe
+            elif tag == b"R":
+                count, = _COUNT.unpack_from(payload)
+                traceback_ids, pos = _array_from("I", payload, _COUNT.size, count)
+                domains, pos = _array_from("I", payload, pos, count)
+                counts, pos = _array_from("I", payload, pos, count)
+                sizes, pos = _array_from("Q", payload, pos, count)
+                yield from zip(traceback_ids, domains, counts, sizes)
+            else:
+                raise ValueError("unknown snapshot block %r" % tag)
+
+
+def load_statistics(filename, key_type='lineno', cumulative=False,
+                    filters=None):
+    """Group an exported snapshot by key_type.
+
+    Return a sorted list of Statistic instances, as
+    Snapshot.filter_traces(filters).statistics(key_type, cumulative)
+    would on the original snapshot.  The filter verdict is computed once
+    per (domain, traceback) record key, not once per trace.
+    """
+
+    if key_type not in ('traceback', 'filename', 'lineno'):
+        raise ValueError("unknown key_type: %r" % (key_type,))
+    if cumulative and key_type not in ('lineno', 'filename'):
+        raise ValueError("cumulative mode cannot by used "
+                         "with key type %r" % key_type)
+
+    filter_set = compile_filters(filters)
+    verdicts = {}
+    sizes = {}
+    counts = {}
+
+    with open(filename, "rb") as fp:
+        reader = SnapshotReader(fp)
+        tracebacks = reader.tracebacks
+        frames = reader.frames
+
+        for traceback_id, domain, count, size in reader.iter_records():
+            if filter_set:
+                try:
+                    verdict = verdicts[traceback_id, domain]
+                except KeyError:
+                    verdict = verdicts[traceback_id, domain] = filter_set.match(
+                        domain, reader._traceback_frames(traceback_id))
+                if not verdict:
+                    continue
+
+            frame_ids = tracebacks[traceback_id][1]
+            if key_type == 'traceback':
+                keys = (traceback_id,)
+            elif cumulative:
+                keys = frame_ids
+            else:
+                keys = frame_ids[:1]
+            for key in keys:
+                if key_type == 'filename':
+                    key = frames[key][0]
+                sizes[key] = sizes.get(key, 0) + size
+                counts[key] = counts.get(key, 0) + count
+
+        statistics = []
+        for key, size in sizes.items():
+            if key_type == 'traceback':
+                frames_key = reader._traceback_frames(key)
+            elif key_type == 'lineno':
+                frames_key = (frames[key],)
+            else:
+                frames_key = ((key, 0),)
+            statistics.append(tracemalloc.Statistic(
+                tracemalloc.Traceback(frames_key), size, counts[key]))
+
+    statistics.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+    return statistics
+
+
+def display_top_file(filename, key_type='lineno', limit=10):
+
+    top_stats = load_statistics(filename, key_type, filters=(
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+    print("\n".join(format_top(*split_top(top_stats, limit), limit, key_type)))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+
+        # off-process report: python Python_Memory_Snapshot_Export.py snapshot.tms [key_type] [limit]
+
+        display_top_file(sys.argv[1],
+                         sys.argv[2] if len(sys.argv) > 2 else 'lineno',
+                         int(sys.argv[3]) if len(sys.argv) > 3 else 10)
+
+    else:
+        tracemalloc.start()
+
+        # ... run your application ...
+
+        dump_traces("snapshot.tms")
+
+        display_top_file("snapshot.tms")
@@ -0,0 +1,228 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Background snapshot sampling.
+#
+# Instead of taking two snapshots by hand and calling compare_to(), a SnapshotSampler takes filtered snapshots on a schedule, from a daemon
+# thread (start()) or from an asyncio task (run_async()), and keeps the last N of them in a ring buffer:
+# > the newest keep_full samples keep their full Snapshot,
+# > older samples are downsampled to per-line aggregates ({traceback: [size, count]}) and their traces are released.
+#
+# The sampler has an overhead budget: after each capture it waits max(interval, capture_time / overhead_budget), so over the long run the
+# time spent taking and filtering snapshots stays below overhead_budget of the wall time (2% by default) even when the heap grows. The
+# limit is amortised: the first capture is taken at once, before its cost is known, so over the first intervals overhead() can be well
+# above the budget.
+#
+# top_growers() compares the newest sample with the oldest sample of the window and returns StatisticDiff instances, the same objects
+# compare_to() returns; print_top_growers() prints them like the "Top 10 differences" example.
+#
+
+import asyncio
+import collections
+import threading
+import time
+import tracemalloc
+
+DEFAULT_FILTERS = (
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+)
+
+
+class Sample:
+    """One entry of the ring buffer.
+
+    snapshot is None once the sample has been downsampled; stats always
+    holds the per-key aggregates as {Traceback: [size, count]}.
+    """
+
+    __slots__ = ("timestamp", "duration", "snapshot", "stats")
+
+    def __init__(self, timestamp, snapshot, key_type):
+        self.timestamp = timestamp
+        self.duration = 0.0
+        self.snapshot = snapshot
+        self.stats = {stat.traceback: [stat.size, stat.count]
+                      for stat in snapshot.statistics(key_type)}
+
+    def downsample(self):
+        self.snapshot = None
+
+
+class SnapshotSampler:
+
+    def __init__(self, interval=60.0, retain=10, keep_full=2,
+                 key_type='lineno', filters=DEFAULT_FILTERS,
+                 overhead_budget=0.02):
+        if retain < 2:
+            raise ValueError("retain must be at least 2")
+        if not 0 < overhead_budget <= 1:
+            raise ValueError("overhead_budget must be in (0, 1]")
+        self.interval = interval
+        self.keep_full = keep_full
+        self.key_type = key_type
+        self.filters = filters
+        self.overhead_budget = overhead_budget
+        self.samples = collections.deque(maxlen=retain)
+        self.capture_time = 0.0
+        self.delayed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = None    # (loop, asyncio.Event) while run_async() runs
+        self._thread = None
+        self._started = None
+
+    def sample(self):
+        """Take one filtered snapshot and push it into the ring buffer.
+
+        Return the time the capture took, in seconds.
+        """
+
+        start = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot()
+        if self.filters:
+            snapshot = snapshot.filter_traces(self.filters)
+        entry = Sample(time.time(), snapshot, self.key_type)
+        entry.duration = time.perf_counter() - start
+
+        with self._lock:
+            self.samples.append(entry)
+            if self.keep_full < len(self.samples):
+                self.samples[-self.keep_full - 1].downsample()
+            self.capture_time += entry.duration
+        return entry.duration
+
+    def next_delay(self, duration):
+        """Delay before the next capture, respecting the overhead budget."""
+
+        delay = max(self.interval, duration / self.overhead_budget)
+        if delay > self.interval:
+            self.delayed += 1
+        return delay
+
+    def overhead(self):
+        """Fraction of the wall time spent capturing since start."""
+
+        if self._started is None:
+            return 0.0
+        elapsed = time.perf_counter() - self._started
+        return self.capture_time / elapsed if elapsed else 0.0
+
+    def _run(self):
+        while not self._stop.is_set():
+            duration = self.sample()
+            self._stop.wait(self.next_delay(duration))
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("the tracemalloc module must be tracing memory "
+                               "allocations to sample snapshots")
+        if self._thread is not None:
+            raise RuntimeError("sampler already started")
+        self._stop.clear()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run,
+                                        name="snapshot-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._wakeup is not None:
+            loop, wakeup = self._wakeup
+            loop.call_soon_threadsafe(wakeup.set)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def run_async(self):
+        """Sample from an asyncio task until stop() is called or the task
+        is cancelled.  Captures run in the default executor so the event
+        loop is not blocked while the snapshot is grouped."""
+
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self._stop.clear()
+        self._wakeup = (loop, wakeup)
+        self._started = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                duration = await loop.run_in_executor(None, self.sample)
+                # stop() sets wakeup: do not sleep out the interval
+                try:
+                    await asyncio.wait_for(wakeup.wait(),
+                                           self.next_delay(duration))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = None
+
+    def top_growers(self, window=None, limit=10):
+        """Compare the newest sample with the oldest sample of the last
+        window samples (all retained samples by default).
+
+        Return a list of StatisticDiff instances sorted like
+        Snapshot.compare_to().
+        """
+
+        if window is not None and window < 1:
+            raise ValueError("window must be at least 1")
+        with self._lock:
+            samples = list(self.samples)
+        if window is not None:
+            samples = samples[-window:]
+        if len(samples) < 2:
+            return []
+
+        old_stats = samples[0].stats
+        new_stats = samples[-1].stats
+        diffs = []
+        for traceback, (size, count) in new_stats.items():
+            old_size, old_count = old_stats.get(traceback, (0, 0))
+            diffs.append(tracemalloc.StatisticDiff(
+                traceback, size, size - old_size, count, count - old_count))
+        for traceback, (old_size, old_count) in old_stats.items():
+            if traceback not in new_stats:
+                diffs.append(tracemalloc.StatisticDiff(
+                    traceback, 0, -old_size, 0, -old_count))
+
+        diffs.sort(reverse=True, key=tracemalloc.StatisticDiff._sort_key)
+        return diffs[:limit] if limit is not None else diffs
+
+    def print_top_growers(self, window=None, limit=10):
+
+        top_stats = self.top_growers(window, limit)
+
+        print("[ Top %s differences ]" % limit)
+
+        for stat in top_stats:
+            print(stat)
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start()
+
+    sampler = SnapshotSampler(interval=0.5, retain=5)
+    sampler.start()
+
+    # ... run your application ...
+
+    leak = []
+    for _ in range(6):
+        leak.extend(str(i) for i in range(10000))
+        time.sleep(0.5)
+
+    sampler.stop()
+
+    sampler.print_top_growers()
+
+    # a few seconds is a short run: the first capture, taken at once, still weighs above the 2% budget
+    print("Capture overhead: %.2f%%" % (sampler.overhead() * 100))
@@ -0,0 +1,312 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Bounded top-K statistics.
+#
+# display_top() filters the snapshot (a copy of the traces), builds a Statistic object for every distinct site, sorts all of them, then walks
+# top_stats[limit:] again for the "other" line and the whole list for the total.
+#
+# top_statistics() does it in one pass over the raw traces:
+# > traces are summed per domain and traceback with fold_traces(), and the filters are evaluated once per pair by a FilterSet, without
+#   copying the traces (both from Python_Memory_Trace_Fold.py),
+# > sites are grouped by their raw key (a frame tuple, a filename or the traceback tuple), and the total size is summed on the way,
+# > heapq.nlargest() selects the limit biggest sites, O(sites log limit) instead of a full sort, and only those become Statistic objects;
+#   "N other" and the total come from the running totals; sites tied with the smallest selected one on size and count are ordered by
+#   traceback, like Statistic._sort_key, so the same sites are kept as with a full sort,
+# display_top_k() prints exactly what display_top() prints.
+#
+# For the traceback key, the number of distinct sites can be as large as the number of traces. heavy_hitters() keeps the counters in fixed
+# memory instead (the traces are folded per traceback first, like top_statistics() does, and counted by their frames):
+# > SpaceSaving(capacity) counts the bytes of at most capacity tracebacks; when a new traceback arrives and the table is full, it takes the
+#   slot of the smallest one and inherits its count as an error bound, so every traceback holding more than total / capacity bytes is
+#   found, and its size is overestimated by at most the reported error,
+# > CountMinSketch(width, depth) estimates the bytes of any key in width * depth counters (overestimates by at most e * total / width with
+#   probability 1 - exp(-depth)); with a heap of the limit best candidates it finds the heavy hitters too.
+#
+
+import heapq
+import math
+import random
+import tracemalloc
+
+from Python_Memory_Frame_Render import format_top, format_traceback
+from Python_Memory_Trace_Fold import compile_filters, fold_traces
+
+DISPLAY_FILTERS = (
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _traces(snapshot):
+    if snapshot is None:
+        return tracemalloc._get_traces()
+    return snapshot.traces._traces
+
+
+def top_statistics(snapshot=None, key_type='lineno', limit=10,
+                   filters=DISPLAY_FILTERS):
+    """Return (top, other_count, other_size, total_size).
+
+    top is the limit biggest sites as sorted Statistic instances, as
+    snapshot.filter_traces(filters).statistics(key_type)[:limit] returns;
+    snapshot None means the live traces.
+    """
+
+    if key_type not in ('traceback', 'filename', 'lineno'):
+        raise ValueError("unknown key_type: %r" % (key_type,))
+
+    filter_set = compile_filters(filters)
+    by_id = fold_traces(_traces(snapshot))
+
+    sites = {}
+    total_size = 0
+    for trace, size, count in by_id.values():
+        if filter_set and not filter_set.match_trace(trace):
+            continue
+        if key_type == 'lineno':
+            key = trace[2][0]
+        elif key_type == 'filename':
+            key = trace[2][0][0]
+        else:
+            key = trace[2]
+        total_size += size
+        try:
+            site = sites[key]
+            site[0] += size
+            site[1] += count
+        except KeyError:
+            sites[key] = [size, count]
+    del by_id
+
+    best = heapq.nlargest(limit, sites.items(), key=lambda item: item[1])
+    if best and len(sites) > limit:
+        # the sites tied with the last one are ordered by traceback
+        edge = best[-1][1]
+        best = [item for item in best if item[1] != edge]
+        best.extend(item for item in sites.items() if item[1] == edge)
+
+    top = []
+    for key, (size, count) in best:
+        if key_type == 'lineno':
+            frames = (key,)
+        elif key_type == 'filename':
+            frames = ((key, 0),)
+        else:
+            frames = key
+        top.append(tracemalloc.Statistic(tracemalloc.Traceback(frames),
+                                         size, count))
+    top.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+    del top[limit:]
+    top_size = sum(stat.size for stat in top)
+
+    return top, len(sites) - len(top), total_size - top_size, total_size
+
+
+def display_top_k(snapshot, key_type='lineno', limit=10):
+    """display_top() in one pass, with a bounded sort."""
+
+    top, other_count, other_size, total = top_statistics(snapshot, key_type,
+                                                         limit)
+
+    print("\n".join(format_top(top, other_count, other_size, total, limit,
+                               key_type)))
+
+
+# Heavy hitters
+
+class SpaceSaving:
+    """Weighted space-saving counters for at most capacity keys."""
+
+    def __init__(self, capacity=1000):
+        if capacity < 1:
+            raise ValueError("capacity must be >= 1")
+        self.capacity = capacity
+        self.total = 0
+        self._counters = {}    # key -> [weight, error, count, value]
+        self._heap = []        # (weight, serial, key), stale entries skipped
+        self._serial = 0
+
+    def add(self, key, weight, count=1, value=None):
+        """Count weight (and count blocks) for key; value is kept with the
+        key, e.g. the object the key stands for."""
+
+        self.total += weight
+        counters = self._counters
+        counter = counters.get(key)
+        if counter is None:
+            if len(counters) < self.capacity:
+                counter = counters[key] = [0, 0, 0, value]
+            else:
+                # take over the smallest counter
+                heap = self._heap
+                while True:
+                    old_weight, _, old_key = heapq.heappop(heap)
+                    old = counters.get(old_key)
+                    if old is not None and old[0] == old_weight:
+                        break
+                del counters[old_key]
+                counter = counters[key] = [old_weight, old_weight, 0, value]
+        counter[0] += weight
+        counter[2] += count
+
+        self._serial += 1
+        heapq.heappush(self._heap, (counter[0], self._serial, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c[0], i, k) for i, (k, c) in enumerate(counters.items())]
+            heapq.heapify(self._heap)
+
+    def top(self, limit=10):
+        """Return the limit heaviest (key, weight, error, count, value)."""
+
+        best = heapq.nlargest(limit, self._counters.items(),
+                              key=lambda item: item[1][0])
+        return [(key, c[0], c[1], c[2], c[3]) for key, c in best]
+
+
+class CountMinSketch:
+    """width x depth counters estimating the weight of any key; the limit
+    heaviest keys seen are kept as candidates."""
+
+    def __init__(self, width=2048, depth=4, limit=10, seed=None):
+        self.width = width
+        self.depth = depth
+        self.limit = limit
+        self.total = 0
+        self._rows = [[0] * width for _ in range(depth)]
+        rng = random.Random(seed)
+        self._salts = [rng.getrandbits(61) for _ in range(depth)]
+        self._counts = [[0] * width for _ in range(depth)]
+        self._candidates = {}  # key -> value
+
+    @classmethod
+    def for_error(cls, epsilon=0.001, delta=0.01, limit=10, seed=None):
+        """Size the sketch for an error of epsilon * total with
+        probability 1 - delta."""
+
+        return cls(int(math.ceil(math.e / epsilon)),
+                   int(math.ceil(math.log(1 / delta))), limit, seed)
+
+    def _columns(self, key):
+        h = hash(key)
+        width = self.width
+        return [((h ^ salt) * 0x9E3779B97F4A7C15 >> 17) % width
+                for salt in self._salts]
+
+    def add(self, key, weight, count=1, value=None):
+        self.total += weight
+        estimate = None
+        for row, counts, column in zip(self._rows, self._counts,
+                                       self._columns(key)):
+            row[column] += weight
+            counts[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+
+        candidates = self._candidates
+        if key in candidates or len(candidates) < self.limit:
+            candidates[key] = value
+        else:
+            smallest = min(candidates, key=self.estimate)
+            if estimate > self.estimate(smallest):
+                del candidates[smallest]
+                candidates[key] = value
+
+    def estimate(self, key):
+        return min(row[column] for row, column in zip(self._rows,
+                                                      self._columns(key)))
+
+    def estimate_count(self, key):
+        return min(counts[column] for counts, column in zip(self._counts,
+                                                            self._columns(key)))
+
+    def top(self, limit=10):
+        """Return the limit heaviest candidates as (key, weight, error,
+        count, value); error is the e * total / width bound."""
+
+        error = int(math.e * self.total / self.width)
+        best = sorted(self._candidates, key=self.estimate, reverse=True)[:limit]
+        return [(key, self.estimate(key), error, self.estimate_count(key),
+                 self._candidates[key]) for key in best]
+
+
+def heavy_hitters(snapshot=None, limit=10, capacity=1000, method='space-saving',
+                  filters=DISPLAY_FILTERS):
+    """Find the biggest tracebacks with fixed memory.
+
+    Return (stats, errors, total): Statistic instances with estimated
+    sizes and counts, the matching error bounds in bytes, and the total.
+    """
+
+    if method == 'space-saving':
+        counter = SpaceSaving(capacity)
+    elif method == 'count-min':
+        counter = CountMinSketch(width=capacity, limit=limit)
+    else:
+        raise ValueError("unknown method: %r" % (method,))
+
+    filter_set = compile_filters(filters)
+    verdicts = {}
+
+    for trace, size, count in fold_traces(_traces(snapshot)).values():
+        # the key is the frames, not the id of the tuple: tracemalloc has
+        # one tuple per (frames, total_nframe), so a site reached through
+        # stacks of different depths has several tuples once truncated
+        frames = trace[2]
+        if filter_set:
+            # the verdict depends on the domain too; bounded like the
+            # counters: forget the verdicts when full
+            try:
+                verdict = verdicts[trace[0], frames]
+            except KeyError:
+                if len(verdicts) >= capacity:
+                    verdicts.clear()
+                verdict = verdicts[trace[0], frames] = filter_set.match_trace(trace)
+            if not verdict:
+                continue
+        counter.add(frames, size, count, frames)
+
+    stats = []
+    errors = []
+    for key, size, error, count, traceback in counter.top(limit):
+        stats.append(tracemalloc.Statistic(tracemalloc.Traceback(traceback),
+                                           size, count))
+        errors.append(error)
+    return stats, errors, counter.total
+
+
+def display_heavy_hitters(snapshot, limit=10, capacity=1000,
+                          method='space-saving'):
+    stats, errors, total = heavy_hitters(snapshot, limit, capacity, method)
+
+    print("Top %s tracebacks (%s, %s counters)" % (limit, method, capacity))
+
+    for index, (stat, error) in enumerate(zip(stats, errors), 1):
+        print("#%s: %.1f KiB (+/- %.1f KiB), %s blocks"
+              % (index, stat.size / 1024, error / 1024, stat.count))
+        for line in format_traceback(stat.traceback):
+            print(line)
+
+    print("Total allocated size: %.1f KiB" % (total / 1024))
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start(25)
+
+    # ... run your application ...
+
+    data = [str(i) * 10 for i in range(100000)]
+
+    snapshot = tracemalloc.take_snapshot()
+
+    display_top_k(snapshot)
+
+    display_heavy_hitters(snapshot, limit=3, capacity=100)
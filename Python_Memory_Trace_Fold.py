@@ -0,0 +1,140 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Folding raw traces and evaluating filters.
+#
+# The modules working on the raw traces (snapshot.traces._traces, or tracemalloc._get_traces() for the live traces) instead of Snapshot
+# objects share two helpers:
+# > fold_traces() sums the traces per domain and traceback in one pass. tracemalloc shares one tuple per traceback, so the id() of that
+#   tuple is the key, and each distinct traceback is then converted, filtered and grouped once however many blocks it holds. The domain is
+#   part of the key: a DomainFilter, or a Filter with a domain, can accept the blocks of a traceback in one domain and not in another.
+# > FilterSet(filters) evaluates a sequence of Filter and DomainFilter objects with the semantics of Snapshot.filter_traces(). The pattern
+#   matches are cached per filename (filenames are interned by tracemalloc, so there are few of them), and when the verdict depends on the
+#   filename only - no lineno, no all_frames, no domain, the usual case - the verdict itself is cached per filename. A FilterSet can be
+#   kept and reused for every snapshot.
+#
+
+import fnmatch
+import tracemalloc
+
+
+def fold_traces(traces=None, totals=None):
+    """Sum raw traces (the live traces if None) per domain and traceback.
+
+    Return a dict of [trace, size, count] lists, trace being the first
+    trace of its key; pass it back as totals to fold more traces into it.
+    """
+
+    if traces is None:
+        traces = tracemalloc._get_traces()
+    if totals is None:
+        totals = {}
+    for trace in traces:
+        # domain 0 (Python) is the common case: keyed by id() alone; the
+        # trace kept in the totals keeps the traceback, so the id, alive
+        key = (trace[0], id(trace[2])) if trace[0] else id(trace[2])
+        try:
+            total = totals[key]
+            total[1] += trace[1]
+            total[2] += 1
+        except KeyError:
+            totals[key] = [trace, trace[1], 1]
+    return totals
+
+
+class FilterSet:
+    """Filters compiled for repeated matching; same semantics as
+    Snapshot.filter_traces(filters)."""
+
+    def __init__(self, filters):
+        self.filters = tuple(filters)
+        for trace_filter in self.filters:
+            if not isinstance(trace_filter, tracemalloc.BaseFilter):
+                raise TypeError("filters must be a list of filters, not %s"
+                                % type(trace_filter).__name__)
+        self._patterns = [trace_filter for trace_filter in self.filters
+                          if isinstance(trace_filter, tracemalloc.Filter)]
+        self._include = [f for f in self.filters if f.inclusive]
+        self._exclude = [f for f in self.filters if not f.inclusive]
+        self._by_filename = all(
+            isinstance(f, tracemalloc.Filter) and f.lineno is None
+            and not f.all_frames and f.domain is None
+            for f in self.filters)
+        self._matches = {}     # filename -> {filter: pattern matches}
+        self._verdicts = {}    # filename -> verdict, when _by_filename
+
+    def __bool__(self):
+        return bool(self.filters)
+
+    def _pattern_matches(self, filename):
+        try:
+            return self._matches[filename]
+        except KeyError:
+            normalized = tracemalloc._normalize_filename(filename)
+            matches = self._matches[filename] = {
+                f: fnmatch.fnmatch(normalized, f._filename_pattern)
+                for f in self._patterns}
+            return matches
+
+    def _match_frame(self, trace_filter, frame):
+        return (self._pattern_matches(frame[0])[trace_filter]
+                and (trace_filter.lineno is None
+                     or frame[1] == trace_filter.lineno))
+
+    def _match(self, trace_filter, domain, frames):
+        # Filter._match() and DomainFilter._match()
+        if not isinstance(trace_filter, tracemalloc.Filter):
+            return (domain == trace_filter.domain) ^ (not trace_filter.inclusive)
+        if trace_filter.all_frames:
+            if any(self._match_frame(trace_filter, frame) for frame in frames):
+                result = trace_filter.inclusive
+            else:
+                result = not trace_filter.inclusive
+        else:
+            result = (self._match_frame(trace_filter, frames[0])
+                      ^ (not trace_filter.inclusive))
+        if trace_filter.domain is not None:
+            if trace_filter.inclusive:
+                return result and domain == trace_filter.domain
+            return result or domain != trace_filter.domain
+        return result
+
+    def _verdict(self, domain, frames):
+        # Snapshot._filter_trace()
+        if self._include:
+            if not any(self._match(f, domain, frames) for f in self._include):
+                return False
+        if self._exclude:
+            if any(not self._match(f, domain, frames) for f in self._exclude):
+                return False
+        return True
+
+    def match(self, domain, frames):
+        """Return True if a trace of domain allocated at frames passes."""
+
+        if not self._by_filename:
+            return self._verdict(domain, frames)
+        filename = frames[0][0]
+        try:
+            return self._verdicts[filename]
+        except KeyError:
+            verdict = self._verdicts[filename] = self._verdict(domain, frames)
+            return verdict
+
+    def match_trace(self, trace):
+        return self.match(trace[0], trace[2])
+
+
+def compile_filters(filters):
+    """Return filters as a FilterSet; a FilterSet is returned as is."""
+
+    if isinstance(filters, FilterSet):
+        return filters
+    return FilterSet(filters or ())
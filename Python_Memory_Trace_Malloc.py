@@ -23,6 +23,9 @@
 # 
 # Example:
 # 
+# Reports that format many tracebacks can use format_traceback() from Python_Memory_Frame_Render.py, which returns the same lines but caches
+# the source lines per (filename, lineno).
+# 
 
 print("Traceback (most recent call first):")
 
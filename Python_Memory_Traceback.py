@@ -15,6 +15,8 @@
 
 import tracemalloc
 
+from Python_Memory_Frame_Render import format_traceback
+
 # Store 25 frames
 
 tracemalloc.start(25)
@@ -30,5 +32,7 @@ stat = top_stats[0]
 
 print("%s memory blocks: %.1f KiB" % (stat.count, stat.size / 1024))
 
-for line in stat.traceback.format():
+# format_traceback() gives the same lines as stat.traceback.format(), with source lines cached
+
+for line in format_traceback(stat.traceback):
     print(line)
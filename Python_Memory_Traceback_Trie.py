@@ -0,0 +1,406 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Traceback prefix trie.
+#
+# With tracemalloc.start(25) (Python_Memory_Traceback.py), every distinct traceback is a tuple of up to 25 frames, and the tracebacks of one
+# program share most of their outer frames: main(), the server loop, the request handler... statistics('traceback') keeps every one of
+# them in full, and answering "how much memory is allocated under this call" means rescanning all of them.
+#
+# TracebackTrie stores the tracebacks as paths from the outermost frame down, in a trie whose nodes are integer ids:
+# > each node is one frame under its parent; a shared prefix is stored once, and the nodes live in flat arrays (parent, frame id, first
+#   child, next sibling, sizes and counts), not in Python objects,
+# > each node keeps its own size and count (the blocks allocated by the traceback ending there) and the totals of its subtree, updated when
+#   a traceback is added, so total(node) - "everything allocated under this call" - is a lookup, and children() drills down one level,
+# > frame_total(filename, lineno) sums every subtree rooted at that frame, counting recursive calls once,
+# > traceback(node) rebuilds the tracemalloc.Traceback of a node, and format(node) the lines of Traceback.format(),
+# > statistics() returns the same sorted Statistic list as Snapshot.statistics('traceback'),
+# > dump() and load() write and read the trie itself: filenames and frames once, then four integers per node.
+#
+# A traceback cut by the frame limit starts with a "<truncated>" frame, so its outermost recorded frame is not mistaken for a root.
+#
+# File layout (little-endian, zlib-compressed after the header):
+#
+#   header:  magic b"TMTRIE1\0", uint32 filenames, uint32 frames, uint32 nodes
+#   payload: filenames, UTF-8 (surrogateescape), each followed by a NUL byte
+#            frames, uint32 pairs (filename id, lineno)
+#            nodes, uint32 parent ids, uint32 frame ids, uint64 own sizes, uint64 own counts (node 0, the root, excluded)
+#
+
+import array
+import struct
+import sys
+import tracemalloc
+import zlib
+
+from Python_Memory_Frame_Render import format_traceback, short_filename
+from Python_Memory_Trace_Fold import fold_traces
+
+MAGIC = b"TMTRIE1\0"
+TRUNCATED = ("<truncated>", 0)
+ROOT = 0
+
+_HEADER = struct.Struct("<8sIII")
+_NONE = 0xFFFFFFFF
+
+
+def _path(traceback):
+    """Frames of a tracemalloc.Traceback or of a raw trace traceback
+    (most recent first), oldest first."""
+
+    if isinstance(traceback, tracemalloc.Traceback):
+        return traceback._frames
+    return traceback[::-1]
+
+
+class TracebackTrie:
+
+    def __init__(self):
+        self._frame_ids = {}           # (filename, lineno) -> frame id
+        self._frames = []
+        self._edges = {}               # (parent id, frame id) -> node id
+        self._by_frame = {}            # frame id -> [node ids]
+        # node columns; node 0 is the root, above the outermost frames
+        self._parent = array.array("I", [_NONE])
+        self._frame = array.array("I", [_NONE])
+        self._first_child = array.array("I", [_NONE])
+        self._next_sibling = array.array("I", [_NONE])
+        self._depth = array.array("I", [0])
+        self._own_size = array.array("Q", [0])
+        self._own_count = array.array("Q", [0])
+        self._size = array.array("Q", [0])
+        self._count = array.array("Q", [0])
+
+    def __len__(self):
+        return len(self._parent)
+
+    def _frame_id(self, frame):
+        try:
+            return self._frame_ids[frame]
+        except KeyError:
+            frame_id = self._frame_ids[frame] = len(self._frames)
+            self._frames.append(frame)
+            return frame_id
+
+    def _child(self, parent, frame_id):
+        try:
+            return self._edges[(parent, frame_id)]
+        except KeyError:
+            node = self._edges[(parent, frame_id)] = len(self._parent)
+            self._parent.append(parent)
+            self._frame.append(frame_id)
+            self._first_child.append(_NONE)
+            self._next_sibling.append(self._first_child[parent])
+            self._first_child[parent] = node
+            self._depth.append(self._depth[parent] + 1)
+            for column in (self._own_size, self._own_count, self._size,
+                           self._count):
+                column.append(0)
+            self._by_frame.setdefault(frame_id, []).append(node)
+            return node
+
+    def add(self, traceback, size, count=1, total_nframe=None):
+        """Add count blocks of size bytes in total allocated at traceback
+        (a tracemalloc.Traceback or raw frames, most recent first); return
+        the node of the traceback."""
+
+        frames = _path(traceback)
+        if total_nframe is None and isinstance(traceback, tracemalloc.Traceback):
+            total_nframe = traceback.total_nframe
+        node = ROOT
+        path = [ROOT]
+        if total_nframe is not None and total_nframe > len(frames):
+            node = self._child(node, self._frame_id(TRUNCATED))
+            path.append(node)
+        for frame in frames:
+            node = self._child(node, self._frame_id(frame))
+            path.append(node)
+
+        self._own_size[node] += size
+        self._own_count[node] += count
+        for ancestor in path:
+            self._size[ancestor] += size
+            self._count[ancestor] += count
+        return node
+
+    def add_traces(self, traces=None):
+        """Add raw traces: the live traces if None, else e.g.
+        snapshot.traces._traces."""
+
+        # walk each path once per domain and traceback
+        for trace, size, count in fold_traces(traces).values():
+            self.add(trace[2], size, count, trace[3])
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        trie = cls()
+        trie.add_traces(snapshot.traces._traces)
+        return trie
+
+    # Nodes
+
+    def _find(self, frames):
+        node = ROOT
+        for frame in frames:
+            frame_id = self._frame_ids.get(tuple(frame))
+            if frame_id is None:
+                return None
+            node = self._edges.get((node, frame_id))
+            if node is None:
+                return None
+        return node
+
+    def find(self, traceback):
+        """Return the node of a traceback or a call path prefix (oldest
+        frame first when given as a list of (filename, lineno)), or None."""
+
+        if isinstance(traceback, list):
+            return self._find(traceback)
+        frames = _path(traceback)
+        total_nframe = getattr(traceback, "total_nframe", None)
+        if total_nframe is None or total_nframe <= len(frames):
+            node = self._find(frames)
+            if node is not None or total_nframe is not None:
+                return node
+        # Snapshot.statistics() drops total_nframe: try the truncated path
+        return self._find([TRUNCATED] + list(frames))
+
+    def frame(self, node):
+        """(filename, lineno) of node; None for the root."""
+
+        if node == ROOT:
+            return None
+        return self._frames[self._frame[node]]
+
+    def parent(self, node):
+        parent = self._parent[node]
+        return None if parent == _NONE else parent
+
+    def depth(self, node):
+        return self._depth[node]
+
+    def children(self, node=ROOT):
+        """Child nodes, biggest subtree first."""
+
+        result = []
+        child = self._first_child[node]
+        while child != _NONE:
+            result.append(child)
+            child = self._next_sibling[child]
+        result.sort(key=lambda child: (self._size[child], self._count[child]),
+                    reverse=True)
+        return result
+
+    def own(self, node):
+        """(size, count) allocated by the traceback ending at node."""
+
+        return self._own_size[node], self._own_count[node]
+
+    def total(self, node=ROOT):
+        """(size, count) allocated at node and under it."""
+
+        return self._size[node], self._count[node]
+
+    def frame_total(self, filename, lineno):
+        """(size, count) allocated under every call of a frame; a frame
+        repeated in one path (recursion) is counted once."""
+
+        frame_id = self._frame_ids.get((filename, lineno))
+        size = count = 0
+        for node in self._by_frame.get(frame_id, ()):
+            ancestor = self._parent[node]
+            while ancestor != ROOT and self._frame[ancestor] != frame_id:
+                ancestor = self._parent[ancestor]
+            if ancestor == ROOT:
+                size += self._size[node]
+                count += self._count[node]
+        return size, count
+
+    def path(self, node):
+        """Frames from the outermost one down to node."""
+
+        frames = []
+        while node != ROOT:
+            frames.append(self._frames[self._frame[node]])
+            node = self._parent[node]
+        frames.reverse()
+        return frames
+
+    def traceback(self, node):
+        frames = self.path(node)
+        total_nframe = None
+        if frames and frames[0] == TRUNCATED:
+            del frames[0]
+            # more frames were cut, how many is not kept
+            total_nframe = len(frames) + 1
+        return tracemalloc.Traceback(tuple(reversed(frames)), total_nframe)
+
+    def format(self, node, limit=None, most_recent_first=False):
+        """The lines of self.traceback(node).format()."""
+
+        return format_traceback(self.traceback(node), limit, most_recent_first)
+
+    def label(self, node):
+        if node == ROOT:
+            return "all"
+        filename, lineno = self.frame(node)
+        if (filename, lineno) == TRUNCATED:
+            return filename
+        return "%s:%s" % (short_filename(filename), lineno)
+
+    def statistics(self):
+        """Same result as Snapshot.statistics('traceback')."""
+
+        stats = []
+        own_size = self._own_size
+        own_count = self._own_count
+        for node in range(1, len(self._parent)):
+            if own_count[node]:
+                stats.append(tracemalloc.Statistic(self.traceback(node),
+                                                   own_size[node],
+                                                   own_count[node]))
+        stats.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+        return stats
+
+    # Files
+
+    def dump(self, filename):
+        filenames = {}
+        frames = []
+        for name, lineno in self._frames:
+            frames.append(filenames.setdefault(name, len(filenames)))
+            frames.append(lineno)
+
+        def column(typecode, values):
+            data = array.array(typecode, values)
+            if sys.byteorder != "little":
+                data.byteswap()
+            return data.tobytes()
+
+        payload = b"".join((
+            b"".join(name.encode("utf-8", "surrogateescape") + b"\0"
+                     for name in filenames),
+            column("I", frames),
+            column("I", self._parent[1:]),
+            column("I", self._frame[1:]),
+            column("Q", self._own_size[1:]),
+            column("Q", self._own_count[1:]),
+        ))
+        with open(filename, "wb") as fp:
+            fp.write(_HEADER.pack(MAGIC, len(filenames), len(self._frames),
+                                  len(self._parent) - 1))
+            fp.write(zlib.compress(payload))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as fp:
+            magic, nfilenames, nframes, nnodes = _HEADER.unpack(
+                fp.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("not a traceback trie file")
+            payload = zlib.decompress(fp.read())
+
+        names = payload.split(b"\0", nfilenames)
+        offset = sum(len(name) + 1 for name in names[:nfilenames])
+        names = [name.decode("utf-8", "surrogateescape")
+                 for name in names[:nfilenames]]
+
+        def column(typecode, count):
+            nonlocal offset
+            data = array.array(typecode)
+            end = offset + count * data.itemsize
+            data.frombytes(payload[offset:end])
+            if sys.byteorder != "little":
+                data.byteswap()
+            offset = end
+            return data
+
+        frames = column("I", 2 * nframes)
+        parents = column("I", nnodes)
+        frame_ids = column("I", nnodes)
+        own_sizes = column("Q", nnodes)
+        own_counts = column("Q", nnodes)
+
+        trie = cls()
+        for index in range(nframes):
+            trie._frame_id((sys.intern(names[frames[2 * index]]),
+                            frames[2 * index + 1]))
+        # parents always come before their children
+        for index in range(nnodes):
+            node = trie._child(parents[index], frame_ids[index])
+            size = own_sizes[index]
+            count = own_counts[index]
+            if count:
+                trie._own_size[node] = size
+                trie._own_count[node] = count
+                while node != _NONE:
+                    trie._size[node] += size
+                    trie._count[node] += count
+                    node = trie._parent[node]
+        return trie
+
+
+def display_tree(trie, node=ROOT, limit=3, depth=4, min_share=0.01):
+    """Print the biggest subtrees under node, limit children per level."""
+
+    total = trie.total(ROOT)[0] or 1
+
+    def walk(node, indent, levels):
+        size, count = trie.total(node)
+        print("%s%s: %.1f KiB (%.1f%%), %s blocks"
+              % ("  " * indent, trie.label(node), size / 1024,
+                 size * 100 / total, count))
+        if levels:
+            for child in trie.children(node)[:limit]:
+                if trie.total(child)[0] >= min_share * total:
+                    walk(child, indent + 1, levels - 1)
+
+    walk(node, 0, depth)
+
+
+if __name__ == "__main__":
+
+    # Store 25 frames
+
+    tracemalloc.start(25)
+
+    # ... run your application ...
+
+    def load(n):
+        return [str(i) * 10 for i in range(n)]
+
+    def handle(request):
+        return load(request * 100)
+
+    data = [handle(request) for request in range(1, 30)]
+
+    snapshot = tracemalloc.take_snapshot()
+
+    trie = TracebackTrie.from_snapshot(snapshot)
+
+    print("%s nodes for %s tracebacks"
+          % (len(trie), len(snapshot.statistics('traceback'))))
+
+    display_tree(trie)
+
+    # everything allocated under handle()
+
+    code = handle.__code__
+
+    size, count = trie.frame_total(code.co_filename, code.co_firstlineno + 1)
+
+    print("handle(): %.1f KiB in %s blocks" % (size / 1024, count))
+
+    # the biggest traceback, formatted like Traceback.format()
+
+    stat = trie.statistics()[0]
+
+    for line in trie.format(trie.find(stat.traceback)):
+        print(line)
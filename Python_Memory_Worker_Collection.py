@@ -0,0 +1,344 @@
+# Python Memory Allocation, Partitioning and Mapping
+# tracemalloc - Trace memory allocations
+# The tracemalloc module is a debug tool to trace memory blocks allocated by Python. It provides the following information:
+# > Traceback where an object was allocated
+# > Statistics on allocated memory blocks per filename and per line number: total size, number and average size of allocated memory blocks
+# > Compute the differences between two snapshots to detect memory leaks
+# To trace most memory blocks allocated by Python, the module should be started as early as possible by setting the PYTHONTRACEMALLOC environment
+# variable to 1, or by using -X tracemalloc command line option. The tracemalloc.start() function can be called at runtime to start tracing Python
+# memory allocations.
+#
+# Collecting statistics from forked workers.
+#
+# tracemalloc only sees the process it runs in. In a pre-fork worker pool each worker publishes its per-line aggregates, and the parent merges
+# them into one report:
+# > through a SharedRegion, an anonymous mmap created before fork() (as in Python_Memory_Mapping_Mmap.py) with one fixed-size slot per worker,
+# > or through one file per worker in a directory (publish_file()).
+#
+# Aggregates are encoded compactly: a table of filenames followed by arrays of filename ids, line numbers, counts and sizes. A slot is guarded
+# by a generation counter, odd while the worker is writing, so the parent never decodes a half-written slot. A busy slot is read again after
+# an exponentially growing sleep; a slot still busy after the read timeout (a worker publishing in a loop, or killed while writing) is
+# skipped with a warning instead of failing the whole merge.
+#
+# merge_region() and merge_files() decode and sum the aggregates on a process pool, each pool task merging a batch of workers, and return
+# Statistic instances sorted like Snapshot.statistics(); display_top_merged() and compare_merged() print and diff them like display_top() and
+# compare_to().
+#
+
+import array
+import concurrent.futures
+import glob
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import warnings
+
+from Python_Memory_Frame_Render import format_top, split_top
+
+DEFAULT_FILTERS = (
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+_AGGREGATE = struct.Struct("<III")
+_SLOT = struct.Struct("<QII")
+
+
+def worker_aggregates(key_type='lineno', filters=DEFAULT_FILTERS):
+    """Return {(filename, lineno): (size, count)} for this process.
+
+    lineno is 0 when key_type is 'filename'.
+    """
+
+    if key_type not in ('lineno', 'filename'):
+        raise ValueError("key_type must be 'lineno' or 'filename', not %r"
+                         % (key_type,))
+    snapshot = tracemalloc.take_snapshot()
+    if filters:
+        snapshot = snapshot.filter_traces(filters)
+    aggregates = {}
+    for stat in snapshot.statistics(key_type):
+        frame = stat.traceback[0]
+        aggregates[frame.filename, frame.lineno] = (stat.size, stat.count)
+    return aggregates
+
+
+def encode_aggregates(aggregates):
+    filenames = {}
+    filename_ids = array.array("I")
+    linenos = array.array("I")
+    counts = array.array("Q")
+    sizes = array.array("Q")
+    for (filename, lineno), (size, count) in aggregates.items():
+        try:
+            filename_id = filenames[filename]
+        except KeyError:
+            filename_id = filenames[filename] = len(filenames)
+        filename_ids.append(filename_id)
+        linenos.append(lineno)
+        counts.append(count)
+        sizes.append(size)
+
+    names = b"\0".join(filename.encode("utf-8", "surrogateescape")
+                       for filename in filenames)
+    if sys.byteorder != "little":
+        for data in (filename_ids, linenos, counts, sizes):
+            data.byteswap()
+    return b"".join((_AGGREGATE.pack(len(names), len(filenames), len(sizes)),
+                     names, filename_ids.tobytes(), linenos.tobytes(),
+                     counts.tobytes(), sizes.tobytes()))
+
+
+def decode_aggregates(data, into=None):
+    """Decode encode_aggregates() output, adding it to the into dict."""
+
+    if into is None:
+        into = {}
+    names_len, nfilenames, nentries = _AGGREGATE.unpack_from(data)
+    pos = _AGGREGATE.size
+    names = data[pos:pos + names_len]
+    pos += names_len
+    filenames = ([name.decode("utf-8", "surrogateescape")
+                  for name in bytes(names).split(b"\0")]
+                 if nfilenames else [])
+
+    columns = []
+    for typecode in ("I", "I", "Q", "Q"):
+        column = array.array(typecode)
+        end = pos + nentries * column.itemsize
+        column.frombytes(data[pos:end])
+        if sys.byteorder != "little":
+            column.byteswap()
+        columns.append(column)
+        pos = end
+
+    for filename_id, lineno, count, size in zip(*columns):
+        key = (filenames[filename_id], lineno)
+        try:
+            total = into[key]
+            total[0] += size
+            total[1] += count
+        except KeyError:
+            into[key] = [size, count]
+    return into
+
+
+class SlotBusy(RuntimeError):
+    """A slot was being rewritten for the whole read timeout."""
+
+
+class SharedRegion:
+    """Anonymous shared mapping with one slot per worker.
+
+    Create it in the parent before forking; worker n publishes into
+    slot n with publish(n), the parent reads every slot.
+    """
+
+    def __init__(self, nworkers, slot_size=1 << 20):
+        if slot_size <= _SLOT.size:
+            raise ValueError("slot_size too small")
+        self.nworkers = nworkers
+        self.slot_size = slot_size
+        self.mm = mmap.mmap(-1, nworkers * slot_size)
+
+    def publish(self, index, aggregates=None):
+        if aggregates is None:
+            aggregates = worker_aggregates()
+        payload = encode_aggregates(aggregates)
+        if _SLOT.size + len(payload) > self.slot_size:
+            raise ValueError("aggregates (%s bytes) do not fit in a %s bytes "
+                             "slot" % (len(payload), self.slot_size))
+
+        start = index * self.slot_size
+        generation = _SLOT.unpack_from(self.mm, start)[0]
+        # odd generation: write in progress
+        _SLOT.pack_into(self.mm, start, generation + 1, 0, os.getpid())
+        self.mm[start + _SLOT.size:start + _SLOT.size + len(payload)] = payload
+        _SLOT.pack_into(self.mm, start, generation + 2, len(payload),
+                        os.getpid())
+
+    def read(self, index, timeout=1.0):
+        """Return the published payload of a slot, or None if empty; raise
+        SlotBusy if it is still being rewritten after timeout seconds."""
+
+        start = index * self.slot_size
+        deadline = time.monotonic() + timeout
+        delay = 0.0001
+        view = memoryview(self.mm)
+        try:
+            while True:
+                generation, length, pid = _SLOT.unpack_from(self.mm, start)
+                if not generation % 2:
+                    payload = bytes(view[start + _SLOT.size:
+                                         start + _SLOT.size + length])
+                    if _SLOT.unpack_from(self.mm, start)[0] == generation:
+                        return payload if generation else None
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        finally:
+            view.release()
+        raise SlotBusy("slot %s (pid %s) is still being rewritten after %s "
+                       "seconds" % (index, pid, timeout))
+
+    def close(self):
+        self.mm.close()
+
+
+def publish_file(directory, aggregates=None):
+    """Write this worker's aggregates to directory/tracemalloc-<pid>.agg."""
+
+    if aggregates is None:
+        aggregates = worker_aggregates()
+    path = os.path.join(directory, "tracemalloc-%s.agg" % os.getpid())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(encode_aggregates(aggregates))
+    os.replace(tmp_path, path)
+    return path
+
+
+# region inherited by fork()ed pool processes
+_region = None
+_timeout = 1.0
+
+
+def _set_region(region, timeout=1.0):
+    global _region, _timeout
+    _region = region
+    _timeout = timeout
+
+
+def _merge_slots(indexes):
+    merged = {}
+    for index in indexes:
+        try:
+            payload = _region.read(index, _timeout)
+        except SlotBusy as exc:
+            warnings.warn("%s: skipped" % exc, RuntimeWarning)
+            continue
+        if payload is not None:
+            decode_aggregates(payload, merged)
+    return merged
+
+
+def _merge_paths(paths):
+    merged = {}
+    for path in paths:
+        with open(path, "rb") as fp:
+            decode_aggregates(fp.read(), merged)
+    return merged
+
+
+def _batches(items, nbatches):
+    return [items[index::nbatches] for index in range(nbatches)
+            if items[index::nbatches]]
+
+
+def _to_statistics(merged):
+    statistics = [tracemalloc.Statistic(tracemalloc.Traceback((key,)),
+                                        size, count)
+                  for key, (size, count) in merged.items()]
+    statistics.sort(reverse=True, key=tracemalloc.Statistic._sort_key)
+    return statistics
+
+
+def _merge(function, batches, processes, initializer=None, initargs=()):
+    merged = {}
+    if processes == 1 or len(batches) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        partials = map(function, batches)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("fork"),
+            initializer=initializer, initargs=initargs)
+        with executor:
+            partials = list(executor.map(function, batches))
+    for partial in partials:
+        for key, (size, count) in partial.items():
+            try:
+                total = merged[key]
+                total[0] += size
+                total[1] += count
+            except KeyError:
+                merged[key] = [size, count]
+    return _to_statistics(merged)
+
+
+def merge_region(region, processes=None, timeout=1.0):
+    """Merge every slot of a SharedRegion into sorted Statistic instances;
+    a slot still busy after timeout seconds is skipped."""
+
+    processes = processes or os.cpu_count() or 1
+    batches = _batches(list(range(region.nworkers)), processes)
+    return _merge(_merge_slots, batches, processes, _set_region,
+                  (region, timeout))
+
+
+def merge_files(directory, processes=None):
+    """Merge every tracemalloc-*.agg file of directory."""
+
+    processes = processes or os.cpu_count() or 1
+    paths = sorted(glob.glob(os.path.join(directory, "tracemalloc-*.agg")))
+    return _merge(_merge_paths, _batches(paths, processes), processes)
+
+
+def display_top_merged(top_stats, limit=10, key_type='lineno'):
+
+    print("\n".join(format_top(*split_top(top_stats, limit), limit, key_type)))
+
+
+def compare_merged(new_stats, old_stats):
+    """Diff two merged reports like Snapshot.compare_to()."""
+
+    old = {stat.traceback: stat for stat in old_stats}
+    diffs = []
+    for stat in new_stats:
+        previous = old.pop(stat.traceback, None)
+        old_size = previous.size if previous is not None else 0
+        old_count = previous.count if previous is not None else 0
+        diffs.append(tracemalloc.StatisticDiff(
+            stat.traceback, stat.size, stat.size - old_size,
+            stat.count, stat.count - old_count))
+    for stat in old.values():
+        diffs.append(tracemalloc.StatisticDiff(
+            stat.traceback, 0, -stat.size, 0, -stat.count))
+    diffs.sort(reverse=True, key=tracemalloc.StatisticDiff._sort_key)
+    return diffs
+
+
+if __name__ == "__main__":
+
+    tracemalloc.start()
+
+    nworkers = 4
+    region = SharedRegion(nworkers)
+
+    pids = []
+    for index in range(nworkers):
+        pid = os.fork()
+
+        if pid == 0:  # In a worker process
+
+            # ... serve requests ...
+
+            data = [str(i) * (index + 1) for i in range(1000 * (index + 1))]
+
+            region.publish(index)
+
+            os._exit(0)
+
+        pids.append(pid)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    display_top_merged(merge_region(region))
+
+    region.close()